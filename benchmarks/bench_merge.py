@@ -0,0 +1,187 @@
+"""Benchmarks the fetch, merge and categorization paths against synthetic data.
+
+Run from the project root:
+
+    python -m benchmarks.bench_merge --days 1 14 365
+    python -m benchmarks.bench_merge --save baseline.json
+    python -m benchmarks.bench_merge --compare baseline.json
+    python -m benchmarks.bench_merge --days 14 --profile traces/
+
+For each case it reports the throughput in window events per second, the peak memory
+allocated by Python while it ran, and the number of requests made to the stub client.
+With --compare it exits with status 1 if any case got slower than the tolerance allows.
+With --profile each case is run once more with the instrumentation enabled, its summary
+is printed and its Chrome trace written to the given directory.
+"""
+from argparse import ArgumentParser
+from datetime import timedelta
+import json
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from benchmarks.synthetic import StubClient, SyntheticData
+from src.afk_split import bucket_merge_df
+from src.aw_merge import afk_gen, bucket_merge, bucket_merge_iter, event_iter
+from src.instrumentation import InstrumentedClient, recording
+from src.user_events import build_event_df
+
+
+def cases(data: SyntheticData, history_db: Path) -> Dict[str, Callable[[Any], Any]]:
+    """the benchmarked calls, each taking a fresh stub client"""
+    hostname, start, end = data.hostname, data.start, data.end
+    app_map = {"google-chrome": data.web_bucket}
+
+    def consume(iterator):
+        for _ in iterator:
+            pass
+
+    return {
+        "afk_gen": lambda client: consume(afk_gen(client, hostname, start, end)),
+        "event_iter": lambda client: consume(
+            event_iter(client, hostname, app_map, start, end)
+        ),
+        "event_iter[batched]": lambda client: consume(
+            event_iter(client, hostname, app_map, start, end, batched=True)
+        ),
+        "bucket_merge": lambda client: bucket_merge(
+            client, hostname, app_map, start, end
+        ),
+        "bucket_merge[batched]": lambda client: bucket_merge(
+            client, hostname, app_map, start, end, batched=True
+        ),
+        "bucket_merge_iter[paged]": lambda client: consume(
+            bucket_merge_iter(
+                client, hostname, app_map, start, end, True, timedelta(days=1)
+            )
+        ),
+        "bucket_merge_df": lambda client: bucket_merge_df(
+            client, hostname, app_map, start, end
+        ),
+        "build_event_df": lambda client: build_event_df(
+            client, hostname, start, end, history_db=history_db
+        ),
+    }
+
+
+def measure(
+    data: SyntheticData, run: Callable[[Any], Any], latency: float
+) -> Dict[str, float]:
+    client = StubClient(data, latency)
+    tracemalloc.start()
+    began = perf_counter()
+    run(client)
+    seconds = perf_counter() - began
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": seconds,
+        "events_per_second": data.window_events / seconds,
+        "peak_mib": peak / 2**20,
+        "requests": client.requests,
+    }
+
+
+def profile(
+    data: SyntheticData,
+    run: Callable[[Any], Any],
+    latency: float,
+    trace: Path,
+):
+    with recording() as recorder:
+        run(InstrumentedClient(StubClient(data, latency)))
+    print(recorder.summary(), end="\n\n")
+    recorder.write_chrome_trace(trace)
+
+
+def run_benchmarks(
+    days: List[int],
+    only: List[str],
+    seed: int,
+    latency: float = 0.0,
+    profile_dir: Path | None = None,
+) -> Dict[str, dict]:
+    results: Dict[str, dict] = {}
+    print(
+        f"{'case':<28}{'days':>6}{'events':>10}{'seconds':>10}"
+        f"{'events/s':>12}{'peak MiB':>10}{'requests':>10}"
+    )
+    for day_count in days:
+        data = SyntheticData(days=day_count, seed=seed)
+        with TemporaryDirectory() as directory:
+            history_db = data.write_atuin_db(Path(directory) / "history.db")
+            for name, run in cases(data, history_db).items():
+                if only and name not in only:
+                    continue
+                result = measure(data, run, latency)
+                results[f"{name}@{day_count}d"] = result
+                print(
+                    f"{name:<28}{day_count:>6}{data.window_events:>10}"
+                    f"{result['seconds']:>10.3f}{result['events_per_second']:>12.0f}"
+                    f"{result['peak_mib']:>10.1f}{result['requests']:>10}"
+                )
+                if profile_dir is not None:
+                    profile_dir.mkdir(parents=True, exist_ok=True)
+                    profile(
+                        data, run, latency, profile_dir / f"{name}@{day_count}d.json"
+                    )
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float):
+    """returns the cases whose throughput dropped by more than the tolerance"""
+    return [
+        f"{case}: {result['events_per_second']:.0f} events/s, "
+        f"baseline {baseline[case]['events_per_second']:.0f}"
+        for case, result in results.items()
+        if case in baseline
+        and result["events_per_second"]
+        < baseline[case]["events_per_second"] * (1 - tolerance)
+    ]
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, nargs="+", default=[1, 14, 365])
+    parser.add_argument("--only", nargs="+", default=[], help="cases to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds added to every request, to model aw-server's round trip",
+    )
+    parser.add_argument("--save", type=Path, help="write the results to a json file")
+    parser.add_argument("--compare", type=Path, help="json file of a previous run")
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        help="directory the Chrome trace of each case is written to",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative drop in throughput when comparing",
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.days, args.only, args.seed, args.latency, args.profile
+    )
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+    if args.compare:
+        if regressions := compare(
+            results, json.loads(args.compare.read_text()), args.tolerance
+        ):
+            print("regressions:", *regressions, sep="\n  ")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
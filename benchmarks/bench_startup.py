@@ -0,0 +1,105 @@
+"""Benchmarks the startup time of the command line, which is meant to run from cron.
+
+Run from the project root:
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 20 --budget 0.15
+
+Each command is started as a fresh interpreter `--runs` times and the median wall time
+is reported next to that of a bare `python -c pass`, along with the modules it imported
+which a fast start can't afford. It exits with status 1 if a command takes longer than
+the budget or imports one of those modules.
+"""
+from argparse import ArgumentParser
+from datetime import date, datetime, time, timedelta, timezone
+import json
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import List
+
+# modules which take tens of milliseconds to import each
+heavy_modules = ["polars", "aw_client", "aw_core", "requests", "pyarrow", "plotly"]
+
+
+def complete_store(cache_dir: Path, hostname: str, days: int):
+    """writes a rollup store which has every recent day, so sync has nothing to do"""
+    store_dir = cache_dir / "rollups" / hostname
+    manifest = {}
+    today = date.today()
+    for n in range(days + 1):
+        day = today - timedelta(days=n)
+        for kind in ("hourly", "daily"):
+            path = store_dir / kind / f"{day.isoformat()}.parquet"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        manifest[day.isoformat()] = datetime.combine(
+            today + timedelta(days=2), time(), timezone.utc
+        ).isoformat()
+    (store_dir / "manifest.json").write_text(json.dumps(manifest))
+
+
+def measure(command: List[str], runs: int) -> float:
+    seconds = []
+    for _ in range(runs):
+        began = perf_counter()
+        subprocess.run(command, check=True, capture_output=True)
+        seconds.append(perf_counter() - began)
+    return statistics.median(seconds)
+
+
+def imported(command: List[str]) -> List[str]:
+    """the heavy modules imported by the command, from python -X importtime"""
+    stderr = subprocess.run(
+        [command[0], "-X", "importtime", *command[1:]],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    modules = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return [module for module in heavy_modules if module in modules]
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget", type=float, default=0.15, help="allowed seconds per command"
+    )
+    args = parser.parse_args(argv)
+
+    with TemporaryDirectory() as directory:
+        cache_dir = Path(directory)
+        complete_store(cache_dir, "bench", 7)
+        cli = [sys.executable, "-m", "src.cli", "--cache-dir", str(cache_dir)]
+        commands = {
+            "python -c pass": [sys.executable, "-c", "pass"],
+            "--help": cli + ["--help"],
+            "merge --help": cli + ["merge", "--help"],
+            "sync (no-op)": cli + ["sync", "--host", "bench"],
+        }
+        failed = False
+        print(f"{'command':<20}{'median ms':>10}  heavy imports")
+        for name, command in commands.items():
+            seconds = measure(command, args.runs)
+            heavy = imported(command)
+            print(f"{name:<20}{seconds * 1000:>10.1f}  {', '.join(heavy) or '-'}")
+            if name != "python -c pass" and (seconds > args.budget or heavy):
+                failed = True
+    if failed:
+        print(
+            f"over the budget of {args.budget * 1000:.0f} ms or importing heavy modules"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
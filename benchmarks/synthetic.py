@@ -0,0 +1,271 @@
+"""Synthetic ActivityWatch and atuin data, and a stub client serving it, so the fetch
+and merge paths can be measured without a live aw-server holding personal data."""
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import random
+import sqlite3
+from time import sleep
+from typing import Dict, List, Optional, Tuple
+from aw_core.models import Event
+
+default_app_mix: Dict[str, float] = {
+    "code-url-handler": 0.35,
+    "google-chrome": 0.3,
+    "kitty": 0.2,
+    "Signal": 0.05,
+    "Ripcord": 0.05,
+    "org.gnome.Nautilus": 0.05,
+}
+default_start = datetime(2023, 5, 1, tzinfo=timezone.utc)
+
+
+class SyntheticData:
+    """Window, afk, web and atuin history datasets for a number of days.
+
+    Attributes
+    ----------
+    buckets : Dict[str, List[Event]]
+        events of each bucket, in chronological order
+    history : List[Tuple[datetime, str, str]]
+        shell history as (time, command, directory), in chronological order
+    start : datetime
+        start of the first day
+    end : datetime
+        end of the last day
+    """
+
+    def __init__(
+        self,
+        days: int = 1,
+        hostname: str = "synthetic",
+        window_seconds: float = 45.0,
+        web_seconds: float = 40.0,
+        commands_per_minute: float = 0.5,
+        afk_minutes: float = 15.0,
+        active_minutes: float = 50.0,
+        afk_noise: float = 2.0,
+        app_mix: Dict[str, float] = default_app_mix,
+        start: datetime = default_start,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            days (int):
+                number of days to generate
+            hostname (str):
+                hostname used in the window and afk bucket names
+            window_seconds (float):
+                mean duration of a window event
+            web_seconds (float):
+                mean time spent on a page while chrome is focused
+            commands_per_minute (float):
+                rate of shell commands while a terminal is focused
+            afk_minutes (float):
+                mean duration of an afk period
+            active_minutes (float):
+                mean duration of a not-afk period
+            afk_noise (float):
+                mean number of short not-afk blips (a bumped mouse, a notification)
+                per hour of afk time
+            app_mix (Dict[str, float]):
+                relative frequency of each app in the window bucket
+            start (datetime):
+                start of the first day
+            seed (int):
+                seed of the random generator, the same arguments give the same data
+        """
+        self.hostname = hostname
+        self.start = start
+        self.end = start + timedelta(days=days)
+        self.window_bucket = f"aw-watcher-window_{hostname}"
+        self.afk_bucket = f"aw-watcher-afk_{hostname}"
+        self.web_bucket = "aw-watcher-web-chrome"
+        self.history: List[Tuple[datetime, str, str]] = []
+        self.buckets: Dict[str, List[Event]] = {
+            self.window_bucket: [],
+            self.afk_bucket: [],
+            self.web_bucket: [],
+        }
+
+        self._random = random.Random(seed)
+        self._next_id = 0
+        apps = list(app_mix)
+        weights = list(app_mix.values())
+
+        time = start
+        while time < self.end:
+            duration = self._seconds(window_seconds)
+            app = self._random.choices(apps, weights)[0]
+            self._add(
+                self.window_bucket,
+                time,
+                duration,
+                {"app": app, "title": f"{app} {self._random.randrange(200)}"},
+            )
+            if app == "google-chrome":
+                self._add_web(time, time + duration, web_seconds)
+            elif app in ("kitty", "code-url-handler"):
+                self._add_history(time, time + duration, commands_per_minute)
+            time += duration
+
+        time = start
+        while time < self.end:
+            active = self._seconds(active_minutes * 60)
+            self._add(self.afk_bucket, time, active, {"status": "not-afk"})
+            time += active
+            afk = self._seconds(afk_minutes * 60)
+            # split the afk period around short not-afk blips
+            afk_end = time + afk
+            blip_starts = sorted(
+                time + self._random.random() * afk
+                for _ in range(self._poisson(afk_noise * afk / timedelta(hours=1)))
+            )
+            for blip_start in blip_starts:
+                # a blip starting inside the previous one is dropped, the last one
+                # ends with the afk period at the latest
+                if blip_start < time:
+                    continue
+                blip = timedelta(seconds=self._random.uniform(1, 5))
+                if blip_start > time:
+                    self._add(
+                        self.afk_bucket, time, blip_start - time, {"status": "afk"}
+                    )
+                blip = min(blip, afk_end - blip_start)
+                self._add(self.afk_bucket, blip_start, blip, {"status": "not-afk"})
+                time = blip_start + blip
+            if afk_end > time:
+                self._add(self.afk_bucket, time, afk_end - time, {"status": "afk"})
+            time = max(time, afk_end)
+
+    def _seconds(self, mean: float) -> timedelta:
+        return timedelta(seconds=max(1.0, self._random.expovariate(1 / mean)))
+
+    def _poisson(self, mean: float) -> int:
+        count, total = 0, self._random.expovariate(1)
+        while total < mean:
+            count += 1
+            total += self._random.expovariate(1)
+        return count
+
+    def _add(self, bucket: str, time: datetime, duration: timedelta, data: dict):
+        self.buckets[bucket].append(
+            Event(id=self._next_id, timestamp=time, duration=duration, data=data)
+        )
+        self._next_id += 1
+
+    def _add_web(self, start: datetime, end: datetime, web_seconds: float):
+        time = start
+        while time < end:
+            duration = min(self._seconds(web_seconds), end - time)
+            page = self._random.randrange(1000)
+            title = (
+                f"query {page} - Google Search"
+                if self._random.random() < 0.2
+                else f"page {page}"
+            )
+            self._add(
+                self.web_bucket,
+                time,
+                duration,
+                {"url": f"https://example.com/{page}", "title": title},
+            )
+            time += duration
+
+    def _add_history(self, start: datetime, end: datetime, commands_per_minute: float):
+        if commands_per_minute <= 0:
+            return
+        time = start
+        while (time := time + self._seconds(60 / commands_per_minute)) < end:
+            command = self._random.choice(("ls", "git status", "cargo build", "cd .."))
+            self.history.append((time, command, "/home/synthetic"))
+
+    @property
+    def window_events(self) -> int:
+        return len(self.buckets[self.window_bucket])
+
+    def write_atuin_db(self, path: Path) -> Path:
+        """writes the shell history to a sqlite database with atuin's history schema"""
+        with sqlite3.connect(path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS history (id TEXT PRIMARY KEY,"
+                " timestamp INTEGER NOT NULL, duration INTEGER NOT NULL,"
+                " exit INTEGER NOT NULL, command TEXT NOT NULL, cwd TEXT NOT NULL,"
+                " session TEXT NOT NULL, hostname TEXT NOT NULL, deleted_at INTEGER)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp)"
+            )
+            connection.executemany(
+                "INSERT INTO history VALUES (?, ?, 0, 0, ?, ?, 'synthetic', ?, NULL)",
+                (
+                    (
+                        str(i),
+                        round(time.timestamp() * 10**6) * 1000,
+                        command,
+                        directory,
+                        self.hostname,
+                    )
+                    for i, (time, command, directory) in enumerate(self.history)
+                ),
+            )
+        connection.close()
+        return path
+
+
+class StubClient:
+    """Stands in for ActivityWatchClient, serving `SyntheticData` from memory with the
+    same semantics as aw-server: events overlapping the interval, trimmed to it, newest
+    first. Every request is counted in `requests`, and can be delayed by `latency`
+    seconds to model the HTTP round trip."""
+
+    def __init__(self, data: SyntheticData, latency: float = 0.0):
+        self.data = data
+        self.latency = latency
+        self.requests = 0
+        self.client_name = "stub"
+        self.server_address = "http://localhost:5600"
+        self.testing = False
+        self._index: Dict[str, Tuple[List[datetime], List[datetime]]] = {}
+        for bucket, events in data.buckets.items():
+            max_ends: List[datetime] = []
+            for e in events:
+                e_end = e.timestamp + e.duration
+                max_ends.append(max(max_ends[-1], e_end) if max_ends else e_end)
+            self._index[bucket] = ([e.timestamp for e in events], max_ends)
+
+    def get_buckets(self) -> dict:
+        self.requests += 1
+        return {
+            bucket: {"id": bucket, "hostname": self.data.hostname}
+            for bucket in self.data.buckets
+        }
+
+    def get_events(
+        self,
+        bucket_id: str,
+        limit: int = -1,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> List[Event]:
+        self.requests += 1
+        if self.latency:
+            sleep(self.latency)
+        events = self.data.buckets[bucket_id]
+        starts, max_ends = self._index[bucket_id]
+        lo = 0 if start is None else bisect_left(max_ends, start)
+        hi = len(events) if end is None else bisect_right(starts, end)
+        result: List[Event] = []
+        for e in events[lo:hi]:
+            e_start, e_end = e.timestamp, e.timestamp + e.duration
+            if start is not None:
+                if e_end < start:
+                    continue
+                e_start = max(e_start, start)
+            if end is not None:
+                e_end = min(e_end, end)
+            result.append(
+                Event(id=e.id, timestamp=e_start, duration=e_end - e_start, data=e.data)
+            )
+        result.reverse()
+        return result if limit in (-1, None) else result[:limit]
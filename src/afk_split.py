@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+
+import polars as pl
+
+from src.aw_merge import afk_gen, bucket_merge_iter, event_iter
+from src.intervals import IntervalTable
+
+merged_schema = {
+    "category": pl.Utf8,
+    "timestamp": pl.Datetime("us", "UTC"),
+    "end": pl.Datetime("us", "UTC"),
+    "data": pl.Utf8,  # json encoded event data
+}
+
+
+def events_to_frame(events: List[Event], categories: List[str]) -> pl.DataFrame:
+    """Converts a list of events and their categories to a dataframe with the merged schema
+
+    Parameters
+    ----------
+    events : List[Event]
+        the events, in chronological order
+    categories : List[str]
+        the category of each event
+    Returns
+    -------
+    pl.DataFrame
+        dataframe with the columns category, timestamp, end and data
+    """
+    return IntervalTable.from_events(events, categories).to_polars(categorical=False)
+
+
+def afk_split(windows: pl.DataFrame, afk: pl.DataFrame) -> pl.DataFrame:
+    """Columnar version of the afk split done by `bucket_merge`. Every window event is
+    cut around *all* the afk intervals it overlaps, instead of only the current one.
+
+    For each window event the overlapping afk intervals are found with two sorted
+    searches, the event is exploded into one candidate gap per overlapped interval
+    plus one, and the gap boundaries are gathered from the afk columns.
+
+    Parameters
+    ----------
+    windows : pl.DataFrame
+        window events with the merged schema, in chronological order
+    afk : pl.DataFrame
+        afk intervals with the merged schema, sorted and non overlapping
+        (as returned by `afk_gen`)
+    Returns
+    -------
+    pl.DataFrame
+        the remaining parts of the window events and the afk intervals, sorted by timestamp
+    """
+    if windows.is_empty() or afk.is_empty():
+        return pl.concat([windows, afk]).sort("timestamp")
+
+    afk_start = afk.get_column("timestamp")
+    afk_end = afk.get_column("end")
+    last_afk = len(afk) - 1
+    segments = (
+        windows.with_columns(
+            # first afk interval ending after the window starts
+            afk_end.search_sorted(windows.get_column("timestamp"), side="right")
+            .cast(pl.Int64)
+            .alias("lo"),
+            # afk intervals starting before the window ends
+            afk_start.search_sorted(windows.get_column("end"), side="left")
+            .cast(pl.Int64)
+            .alias("hi"),
+        )
+        .with_columns(
+            (pl.col("hi") - pl.col("lo")).clip_min(0).alias("overlaps"),
+        )
+        # gap j lies between afk interval lo+j-1 and lo+j
+        .with_columns(pl.arange(0, pl.col("overlaps") + 1).alias("gap"))
+        .explode("gap")
+        .with_columns((pl.col("lo") + pl.col("gap")).alias("next_afk"))
+        .with_columns(
+            pl.when(pl.col("gap") == 0)
+            .then(pl.col("timestamp"))
+            .otherwise(
+                pl.lit(afk_end).take(
+                    (pl.col("next_afk") - 1).clip(0, last_afk).cast(pl.UInt32)
+                )
+            )
+            .alias("timestamp"),
+            pl.when(pl.col("gap") == pl.col("overlaps"))
+            .then(pl.col("end"))
+            .otherwise(
+                pl.lit(afk_start).take(
+                    pl.col("next_afk").clip(0, last_afk).cast(pl.UInt32)
+                )
+            )
+            .alias("end"),
+        )
+        # untouched events are kept even if they have no duration
+        .filter((pl.col("end") > pl.col("timestamp")) | (pl.col("overlaps") == 0))
+        .select(windows.columns)
+    )
+    return pl.concat([segments, afk]).sort("timestamp")
+
+
+def bucket_merge_df(
+    client: ActivityWatchClient,
+    hostname: str,
+    app_map: Dict[str, str | Callable],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    batched: bool = True,
+) -> pl.DataFrame:
+    """Merges all buckets in the given interval, like `bucket_merge`, but splits the
+    window events around the afk events with `afk_split`
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    hostname : str
+        hostname of the machine
+    app_map : Dict[str,str|Callable]
+        mapping of app names to event types
+    start : datetime
+        start of the interval
+    end : datetime
+        end of the interval
+    batched : bool
+        fetch each bucket in app_map once instead of once per window event
+
+    Returns
+    -------
+    pl.DataFrame
+        the merged events with the columns category, timestamp, end and data
+    """
+    afk_events = IntervalTable.from_events(afk_gen(client, hostname, start, end), "afk")
+    window_events = IntervalTable.from_pairs(
+        event_iter(client, hostname, app_map, start, end, batched)
+    )
+    return afk_split(
+        window_events.to_polars(categorical=False),
+        afk_events.to_polars(categorical=False),
+    )
+
+
+def bucket_merge_table(
+    client: ActivityWatchClient,
+    hostname: str,
+    app_map: Dict[str, str | Callable],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    batched: bool = False,
+    page: Optional[timedelta] = None,
+) -> IntervalTable:
+    """Runs `bucket_merge_iter` straight into an `IntervalTable`, without keeping the
+    merged events around
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    hostname : str
+        hostname of the machine
+    app_map : Dict[str,str|Callable]
+        mapping of app names to event types
+    start : datetime
+        start of the interval
+    end : datetime
+        end of the interval
+    batched : bool
+        fetch each bucket in app_map once (per page) instead of once per window event
+    page : Optional[timedelta]
+        length of the pages the buckets are fetched in
+
+    Returns
+    -------
+    IntervalTable
+        the merged events
+    """
+    return IntervalTable.from_pairs(
+        bucket_merge_iter(client, hostname, app_map, start, end, batched, page)
+    )
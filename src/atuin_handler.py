@@ -1,15 +1,23 @@
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import os
 import hashlib
-from datetime import datetime
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+from pathlib import Path
 from subprocess import run
 
+from src.instrumentation import instrumented
+from src.interval_join import IntervalIndex
+
 atuin_env: Dict[str, str] = os.environ | {
     "ATUIN_SESSION": str(hashlib.sha1(os.urandom(40)).hexdigest())
 }
 command_format = "{time}@@@{command}@@@{directory}"
+atuin_db: Path = Path.home() / ".local" / "share" / "atuin" / "history.db"
 
 
+@instrumented(count=len)
 def get_history_interval(start: datetime, end: datetime):
     """runs atuin search for the given interval
 
@@ -40,3 +48,82 @@ def get_history_interval(start: datetime, end: datetime):
                     (datetime.fromisoformat(command_time), command, directory)
                 )
     return result
+
+
+@instrumented(count=len)
+def read_history_db(
+    start: datetime, end: datetime, db_path: Path = atuin_db
+) -> List[Tuple[datetime, str, str]]:
+    """reads every command in the given interval straight from the atuin database,
+    using a single query on the indexed timestamp column instead of spawning `atuin search`
+
+    Parameters
+    ----------
+    start : datetime
+        start of the interval
+    end : datetime
+        end of the interval
+    db_path : Path
+        path to atuin's history.db
+    Returns
+    -------
+    List[Tuple[datetime, str, str]]
+        list of tuples containing the time, command and directory of the command,
+        sorted by time
+    Raises
+    ------
+    sqlite3.Error
+        if the database doesn't exist or can't be read
+    """
+    # atuin stores timestamps as nanoseconds since the epoch
+    start_ns = round(start.timestamp() * 10**6) * 1000
+    end_ns = round(end.timestamp() * 10**6) * 1000
+    with closing(
+        sqlite3.connect(f"{db_path.as_uri()}?mode=ro", uri=True)
+    ) as connection:
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(history)")}
+        query = (
+            "SELECT timestamp, command, cwd FROM history"
+            " WHERE timestamp >= ? AND timestamp < ?"
+        )
+        if "deleted_at" in columns:
+            query += " AND deleted_at IS NULL"
+        rows = connection.execute(query + " ORDER BY timestamp", (start_ns, end_ns))
+        return [
+            (
+                datetime.fromtimestamp(
+                    timestamp / 10**9, tz=timezone.utc
+                ).astimezone(),
+                command,
+                directory,
+            )
+            for timestamp, command, directory in rows
+        ]
+
+
+def history_slicer(
+    start: datetime, end: datetime, db_path: Path = atuin_db
+) -> Callable[[datetime, datetime], List[Tuple[datetime, str, str]]]:
+    """Loads the history of the whole interval once and returns a function with the same
+    signature as `get_history_interval` which answers lookups from memory. Falls back to
+    `get_history_interval` if the atuin database can't be read.
+
+    Parameters
+    ----------
+    start : datetime
+        start of the interval
+    end : datetime
+        end of the interval
+    db_path : Path
+        path to atuin's history.db
+    Returns
+    -------
+    Callable[[datetime, datetime], List[Tuple[datetime, str, str]]]
+        function returning the commands run in the given sub interval
+    """
+    try:
+        history = read_history_db(start, end, db_path)
+    except sqlite3.Error:
+        return get_history_interval
+    # commands are points in time, a command belongs to [start, end) if start <= time < end
+    return IntervalIndex(history, lambda command: command[0]).overlapping
@@ -0,0 +1,190 @@
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.aw_merge import events_slicer, merge_afk_events
+
+
+class AsyncActivityWatchClient:
+    """Asyncio front end for the read only queries of the aw-server REST API.
+
+    Requests go through one keep-alive `requests.Session` whose connection pool is
+    sized to `max_concurrency`, and are run on worker threads so that several of them
+    overlap their network latency. At most `max_concurrency` requests are in flight
+    at any time.
+    """
+
+    def __init__(
+        self,
+        server_address: str = "http://localhost:5600",
+        max_concurrency: int = 8,
+    ):
+        """
+        Args:
+            server_address (str):
+                protocol, host and port of aw-server
+            max_concurrency (int):
+                maximum number of requests in flight
+        """
+        self.server_address = server_address
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._limit = asyncio.Semaphore(max_concurrency)
+
+    @classmethod
+    def from_client(
+        cls, client: ActivityWatchClient, max_concurrency: int = 8
+    ) -> "AsyncActivityWatchClient":
+        """creates an async client talking to the same server as `client`"""
+        return cls(client.server_address, max_concurrency)
+
+    async def __aenter__(self) -> "AsyncActivityWatchClient":
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    async def _get(self, endpoint: str, params: Optional[dict] = None):
+        url = f"{self.server_address}/api/0/{endpoint}"
+        async with self._limit:
+            response = await asyncio.to_thread(self.session.get, url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_buckets(self) -> dict:
+        return await self._get("buckets/")
+
+    async def get_events(
+        self,
+        bucket_id: str,
+        limit: int = -1,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> List[Event]:
+        """same as `ActivityWatchClient.get_events`, newest event first"""
+        params = {"limit": str(limit)}
+        if start is not None:
+            params["start"] = start.isoformat()
+        if end is not None:
+            params["end"] = end.isoformat()
+        events = await self._get(f"buckets/{bucket_id}/events", params)
+        return [Event(**event) for event in events]
+
+    async def get_many(
+        self, queries: Sequence[Tuple[str, Optional[datetime], Optional[datetime]]]
+    ) -> List[List[Event]]:
+        """fetches several (bucket_id, start, end) ranges concurrently, for example the
+        same bucket over many days or the buckets of many hosts
+
+        Returns
+        -------
+        List[List[Event]]
+            the events of each query, in the order of the queries
+        """
+        return await asyncio.gather(
+            *(
+                self.get_events(bucket, start=start, end=end)
+                for bucket, start, end in queries
+            )
+        )
+
+
+async def afk_agen(
+    client: AsyncActivityWatchClient,
+    hostname: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> AsyncIterator[Event]:
+    """async version of `afk_gen`
+
+    Parameters
+    ----------
+    client : AsyncActivityWatchClient
+        AsyncActivityWatchClient instance
+    hostname : str
+        hostname of the machine
+    start : Optional[datetime]
+        start of the interval
+    end : Optional[datetime]
+        end of the interval
+    Yields
+    -------
+    Event
+        the merged afk events in the given interval
+    """
+    raw_afk_events = await client.get_events(
+        f"aw-watcher-afk_{hostname}", start=start, end=end
+    )
+    for afk in merge_afk_events(raw_afk_events[::-1]):
+        yield afk
+
+
+async def window_agen(
+    client: AsyncActivityWatchClient,
+    hostname: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> AsyncIterator[Event]:
+    """async version of `window_gen`"""
+    for event in (
+        await client.get_events(f"aw-watcher-window_{hostname}", start=start, end=end)
+    )[::-1]:
+        yield event
+
+
+async def event_aiter(
+    client: AsyncActivityWatchClient,
+    hostname: str,
+    app_map: Dict[str, str | Callable[[datetime, datetime], List[Event]]],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> AsyncIterator[Tuple[str, Event]]:
+    """async version of `event_iter` in batched mode. The window bucket and every
+    bucket named in app_map are fetched concurrently, once for the whole interval.
+
+    Parameters
+    ----------
+    client : AsyncActivityWatchClient
+        AsyncActivityWatchClient instance
+    hostname : str
+        hostname of the machine
+    app_map : Dict[str,str|Callable]
+        mapping of app names to event types
+    start : Optional[datetime]
+        start of the interval
+    end : Optional[datetime]
+        end of the interval
+
+    Yields
+    -------
+    Tuple[str,Event]
+        the category and event of all events in the given interval
+    """
+    default_category: str = "window"
+    buckets = {
+        app: buckfunc for app, buckfunc in app_map.items() if isinstance(buckfunc, str)
+    }
+    window_events, *bucket_events = await client.get_many(
+        [(f"aw-watcher-window_{hostname}", start, end)]
+        + [(bucket, start, end) for bucket in buckets.values()]
+    )
+    lookup = app_map | {
+        app: events_slicer(events) for app, events in zip(buckets, bucket_events)
+    }
+    for event in window_events[::-1]:
+        app_id = event.data["app"]
+        if callable(buckfunc := lookup.get(app_id)):
+            for e in buckfunc(event.timestamp, event.timestamp + event.duration):
+                yield (app_id, e)
+        else:
+            yield (default_category, event)
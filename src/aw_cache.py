@@ -0,0 +1,235 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+import json
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+
+import polars as pl
+
+from src.manifest import is_complete, read_manifest, write_manifest
+
+default_cache_dir = Path.home() / ".cache" / "anatomyofflow" / "aw"
+event_cache_schema = {
+    "id": pl.Int64,
+    "timestamp": pl.Int64,  # microseconds since the epoch, UTC
+    "duration": pl.Int64,  # microseconds
+    "data": pl.Utf8,  # json encoded event data
+}
+epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+one_day = timedelta(days=1)
+day_micros = one_day // timedelta(microseconds=1)
+
+
+def to_micros(time: datetime) -> int:
+    """converts an (aware or local) datetime to microseconds since the epoch"""
+    return (time.astimezone(timezone.utc) - epoch) // timedelta(microseconds=1)
+
+
+def from_micros(micros: int) -> datetime:
+    """converts microseconds since the epoch to an aware UTC datetime"""
+    return epoch + timedelta(microseconds=micros)
+
+
+class CachedDay(NamedTuple):
+    """The events of one bucket and day held in memory, sorted by timestamp"""
+
+    # columns of `event_cache_schema` and the end of each event
+    frame: pl.DataFrame
+    starts: List[int]
+    # running maximum of the ends, the first event that can overlap an interval is
+    # found by bisecting it
+    max_ends: List[int]
+    # (id, timestamp, end, data) of each event
+    rows: List[Tuple[int, int, int, str]]
+
+    @classmethod
+    def of(cls, frame: pl.DataFrame) -> "CachedDay":
+        rows = list(frame.select(["id", "timestamp", "end", "data"]).iter_rows())
+        max_ends = list(accumulate((row[2] for row in rows), max))
+        return cls(frame, [row[1] for row in rows], max_ends, rows)
+
+
+class CachedClient:
+    """Drop in replacement for ActivityWatchClient which keeps a local Parquet copy of
+    every bucket it is asked for, partitioned by bucket and (UTC) day.
+
+    Days which were fetched after they ended are served from disk. For the open day only
+    the events newer than the last cached event are fetched, so AW's heartbeat extended
+    last event is refreshed as well, at most once per `refresh`. Every day is read (or
+    fetched) once and then kept in memory for the lifetime of the client, so the many
+    small per window queries of the unbatched merge cost a filter each instead of a
+    file read and a request. Everything except `get_events` is forwarded to the wrapped
+    client, so it can be passed to `afk_gen`, `window_gen`, `bucket_merge`,
+    `build_event_df` and `get_bounds` unchanged.
+    """
+
+    def __init__(
+        self,
+        client: ActivityWatchClient,
+        cache_dir: Path = default_cache_dir,
+        grace: timedelta = timedelta(minutes=10),
+        refresh: timedelta = timedelta(seconds=30),
+    ):
+        """
+        Args:
+            client (ActivityWatchClient):
+                the client used to fetch anything that isn't cached yet
+            cache_dir (Path):
+                directory holding one folder per bucket
+            grace (timedelta):
+                how long after the end of a day it is considered complete, gives the
+                watchers time to flush their last heartbeat
+            refresh (timedelta):
+                how long the open day is served from memory before its newest events
+                are fetched again, i.e. how stale it can be
+        """
+        self.client = client
+        self.cache_dir = cache_dir
+        self.grace = grace
+        self.refresh = refresh
+        self._days: Dict[Tuple[str, int], CachedDay] = {}
+        # (bucket, day) -> when the open day was last fetched
+        self._fetched: Dict[Tuple[str, int], datetime] = {}
+        self._manifests: Dict[str, Dict[str, str]] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+    def get_events(
+        self,
+        bucket_id: str,
+        limit: int = -1,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> List[Event]:
+        """same as `ActivityWatchClient.get_events`, newest event first"""
+        # open ended and limited queries can't be answered per day
+        if start is None or end is None or limit not in (-1, None):
+            return self.client.get_events(bucket_id, limit=limit, start=start, end=end)
+
+        start_micros, end_micros = to_micros(start), to_micros(end)
+        # id -> [timestamp, end, data], events crossing midnight are stored in both
+        # days and stitched back together
+        events: Dict[int, list] = {}
+        for day in range(start_micros // day_micros, end_micros // day_micros + 1):
+            cached = self._load_day(bucket_id, day)
+            lo = bisect_left(cached.max_ends, start_micros)
+            hi = bisect_right(cached.starts, end_micros)
+            for event_id, timestamp, event_end, data in cached.rows[lo:hi]:
+                if event_end < start_micros:
+                    continue
+                if (event := events.get(event_id)) is None:
+                    events[event_id] = [timestamp, event_end, data]
+                else:
+                    event[0] = min(event[0], timestamp)
+                    event[1] = max(event[1], event_end)
+                    event[2] = data
+        result = []
+        for event_id, (timestamp, event_end, data) in sorted(
+            events.items(), key=lambda item: item[1][0], reverse=True
+        ):
+            # trim to the interval the same way aw-server does
+            timestamp, event_end = max(timestamp, start_micros), min(
+                event_end, end_micros
+            )
+            result.append(
+                Event(
+                    id=event_id,
+                    timestamp=from_micros(timestamp),
+                    duration=timedelta(microseconds=event_end - timestamp),
+                    data=json.loads(data),
+                )
+            )
+        return result
+
+    def _bucket_dir(self, bucket_id: str) -> Path:
+        return self.cache_dir / bucket_id
+
+    def _manifest(self, bucket_id: str) -> Dict[str, str]:
+        """the manifest maps each cached day to the time it was last fetched, read once
+        per bucket"""
+        if bucket_id not in self._manifests:
+            self._manifests[bucket_id] = read_manifest(self._bucket_dir(bucket_id))
+        return self._manifests[bucket_id]
+
+    def _load_day(self, bucket_id: str, day: int) -> CachedDay:
+        """returns all events of the given day (days since the epoch), from memory, disk
+        or aw-server, whichever is the first to have it complete or fresh enough"""
+        key = (bucket_id, day)
+        now = datetime.now(timezone.utc)
+        cached = self._days.get(key)
+        if cached is not None and (
+            key not in self._fetched or now - self._fetched[key] < self.refresh
+        ):
+            return cached
+
+        day_start = epoch + day * one_day
+        day_end = day_start + one_day
+        iso_day = day_start.date().isoformat()
+        path = self._bucket_dir(bucket_id) / f"{iso_day}.parquet"
+        manifest = self._manifest(bucket_id)
+
+        if cached is None and path.exists():
+            cached = CachedDay.of(
+                pl.read_parquet(path).with_columns(
+                    (pl.col("timestamp") + pl.col("duration")).alias("end")
+                )
+            )
+            if is_complete(manifest, iso_day, [path], day_end, self.grace):
+                self._days[key] = cached
+                return cached
+
+        fetch_start = day_start
+        if cached is not None and cached.starts:
+            # only fetch the events newer than the last cached one, including the
+            # last one itself as its duration may have grown since
+            fetch_start = from_micros(cached.starts[-1])
+
+        fresh = self._to_frame(
+            self.client.get_events(bucket_id, start=fetch_start, end=day_end)
+        ).with_columns((pl.col("timestamp") + pl.col("duration")).alias("end"))
+        frame = fresh
+        if cached is not None:
+            frame = (
+                pl.concat([cached.frame, fresh])
+                .groupby("id")
+                .agg(
+                    pl.col("timestamp").min(),
+                    pl.col("end").max(),
+                    pl.col("data").last(),
+                )
+                .select(
+                    "id",
+                    "timestamp",
+                    (pl.col("end") - pl.col("timestamp")).alias("duration"),
+                    "data",
+                    "end",
+                )
+            )
+        frame = frame.sort("timestamp")
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        frame.drop("end").write_parquet(path)
+        manifest[iso_day] = now.isoformat()
+        write_manifest(self._bucket_dir(bucket_id), manifest)
+        self._days[key] = CachedDay.of(frame)
+        if now >= day_end + self.grace:
+            self._fetched.pop(key, None)
+        else:
+            self._fetched[key] = now
+        return self._days[key]
+
+    @staticmethod
+    def _to_frame(events: List[Event]) -> pl.DataFrame:
+        return pl.DataFrame(
+            {
+                "id": [e.id for e in events],
+                "timestamp": [to_micros(e.timestamp) for e in events],
+                "duration": [e.duration // timedelta(microseconds=1) for e in events],
+                "data": [json.dumps(e.data) for e in events],
+            },
+            schema=event_cache_schema,
+        )
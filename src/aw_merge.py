@@ -1,18 +1,25 @@
 from datetime import datetime, timedelta
-import socket
-from typing import Callable, Iterator, Dict, List, Optional
+from typing import Callable, Iterable, Iterator, Dict, List, Optional, Tuple
 from aw_core.models import Event
 from aw_client.client import ActivityWatchClient
 from pytz import timezone
 
+from src.instrumentation import instrumented
+from src.interval_join import IntervalIndex, events_lookup
 
+# consecutive afk events with the same status closer than this are merged
+afk_merge_gap = timedelta(minutes=8)
+
+
+@instrumented()
 def afk_gen(
     client: ActivityWatchClient,
     hostname: str,
     start: Optional[datetime] = None,
     end: Optional[datetime] = None,
+    page: Optional[timedelta] = None,
 ):
-    """Generator for afk events. This generator merges consecutive afk events if they are within 5 minutes of each other
+    """Generator for afk events. This generator merges consecutive afk events if they are within 8 minutes of each other
     and returns only the events where the status is "afk". This is done to suppress noise events
     (events created by another watcher while afk).
 
@@ -26,45 +33,160 @@ def afk_gen(
         start of the interval
     end : Optional[datetime]
         end of the interval
+    page : Optional[timedelta]
+        if given, the afk bucket is fetched in pages of this length, see `paged_events`
     Returns
     -------
     Iterator[Event]
         Iterator over all afk events in the given interval
     """
-    raw_afk_events = client.get_events(f"aw-watcher-afk_{hostname}", start=start, end=end)[  # type: ignore
-        ::-1
-    ]
-    i = 1
-    current_afk = raw_afk_events[0]
-    raw_event_end: datetime
-    afk_events: List[Event] = []
+    yield from merge_afk_iter(
+        paged_events(client, f"aw-watcher-afk_{hostname}", start, end, page)
+    )
+
+
+def merge_afk_events(raw_afk_events: List[Event]) -> List[Event]:
+    """Merges consecutive afk events with the same status and keeps only the ones where
+    the status is "afk", see `afk_gen`
+
+    Parameters
+    ----------
+    raw_afk_events : List[Event]
+        events of the afk bucket, in chronological order
+    Returns
+    -------
+    List[Event]
+        the merged afk events
+    """
+    return list(merge_afk_iter(raw_afk_events))
+
+
+def merge_afk_iter(raw_afk_events: Iterable[Event]) -> Iterator[Event]:
+    """Streaming version of `merge_afk_events`, each merged afk event is yielded as soon
+    as the next event with a different status (or too far away) arrives
+
+    Parameters
+    ----------
+    raw_afk_events : Iterable[Event]
+        events of the afk bucket, in chronological order
+    Yields
+    -------
+    Event
+        the merged afk events
+    """
+    for afk_run in afk_runs(raw_afk_events):
+        if afk_run.data["status"] == "afk":
+            yield afk_run
+
+
+def afk_runs(raw_afk_events: Iterable[Event]) -> Iterator[Event]:
+    """Merges consecutive afk events with the same status, like `merge_afk_iter`, but
+    yields the merged events of every status. The first event of each run is extended
+    in place and yielded once the run is over.
+
+    Parameters
+    ----------
+    raw_afk_events : Iterable[Event]
+        events of the afk bucket, in chronological order
+    Yields
+    -------
+    Event
+        the merged events, "afk" and "not-afk"
+    """
+    raw_afk_iter = iter(raw_afk_events)
+    if (current_afk := next(raw_afk_iter, None)) is None:
+        return
+    last_afk: Optional[Event] = None
     # in order to suppress noise events(events created by another watcher while afk)
-    # we merge any consecutive afk events if they are within 5 minutes of each other
-    while i < len(raw_afk_events):
-        if raw_afk_events[i].data["status"] == current_afk.data["status"]:
-            # check if they are within 5 minutes of each other
+    # we merge any consecutive afk events if they are within 8 minutes of each other
+    for raw_afk in raw_afk_iter:
+        if raw_afk.data["status"] == current_afk.data["status"]:
+            # check if the gap between them is shorter than 8 minutes
             if (
-                current_afk.timestamp
-                + current_afk.duration
-                - raw_afk_events[i].timestamp
-            ) < timedelta(minutes=8):
+                raw_afk.timestamp - (current_afk.timestamp + current_afk.duration)
+            ) < afk_merge_gap:
                 # if they are, merge them
-                raw_event_end = raw_afk_events[i].timestamp + raw_afk_events[i].duration
+                raw_event_end = raw_afk.timestamp + raw_afk.duration
                 current_afk.duration = raw_event_end - current_afk.timestamp
-            else:
-                # otherwise move on
-                afk_events.append(current_afk)
-                current_afk = raw_afk_events[i]
-        else:
-            # if the status is different, push the current afk event to the list
-            afk_events.append(current_afk)
-            current_afk = raw_afk_events[i]
-        i += 1
+                continue
+        # if the status is different or they are too far apart, the current afk
+        # event is final
+        yield current_afk
+        last_afk = current_afk
+        current_afk = raw_afk
+
+    if last_afk is None or current_afk != last_afk:
+        yield current_afk
 
-    if current_afk != afk_events[-1]:
-        afk_events.append(current_afk)
 
-    yield from [afk for afk in afk_events if afk.data["status"] == "afk"]
+def paged_events(
+    client: ActivityWatchClient,
+    bucket_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    page: Optional[timedelta] = None,
+) -> Iterator[Event]:
+    """Yields the events of a bucket in chronological order, fetching the interval in
+    pages so that only about one page of events is held in memory at a time.
+
+    aw-server trims events to the requested interval, so an event crossing the end of
+    a page comes back in pieces; pieces with the same id are stitched back together
+    before the event is yielded.
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    bucket_id : str
+        name of the bucket to fetch
+    start : Optional[datetime]
+        start of the interval
+    end : Optional[datetime]
+        end of the interval
+    page : Optional[timedelta]
+        length of each page, the whole interval is fetched at once if not given
+    Yields
+    -------
+    Event
+        the events of the bucket overlapping the interval
+    """
+    if page is None or start is None or end is None:
+        yield from client.get_events(bucket_id, start=start, end=end)[::-1]
+        return
+
+    # events which overlap the end of the previous page, by id
+    carried: Dict[int, Event] = {}
+    page_start = start
+    while page_start < end:
+        page_end = min(page_start + page, end)
+        buffer = list(carried.values())
+        for event in client.get_events(bucket_id, start=page_start, end=page_end)[::-1]:
+            if (carried_event := carried.get(event.id)) is not None:
+                event_end = max(
+                    carried_event.timestamp + carried_event.duration,
+                    event.timestamp + event.duration,
+                )
+                carried_event.timestamp = min(carried_event.timestamp, event.timestamp)
+                carried_event.duration = event_end - carried_event.timestamp
+            else:
+                buffer.append(event)
+        buffer.sort()
+
+        if page_end == end:
+            yield from buffer
+            return
+        # hold back everything from the first event which may continue in the next page
+        held = next(
+            (
+                i
+                for i, event in enumerate(buffer)
+                if event.timestamp + event.duration >= page_end
+            ),
+            len(buffer),
+        )
+        yield from buffer[:held]
+        carried = {event.id: event for event in buffer[held:]}
+        page_start = page_end
 
 
 def window_gen(
@@ -72,16 +194,106 @@ def window_gen(
     hostname: str,
     start: Optional[datetime] = None,
     end: Optional[datetime] = None,
+    page: Optional[timedelta] = None,
 ):
-    yield from client.get_events(f"aw-watcher-window_{hostname}", start=start, end=end)[::-1]  # type: ignore
+    yield from paged_events(client, f"aw-watcher-window_{hostname}", start, end, page)
+
+
+def bucket_slicer(
+    client: ActivityWatchClient,
+    bucket_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> Callable[[datetime, datetime], List[Event]]:
+    """Fetches a bucket once for the whole interval and returns a function which
+    answers per window lookups from memory instead of querying aw-server again.
+
+    The returned events mirror what `client.get_events(bucket_id, start=s, end=e)`
+    returns: every event overlapping [s, e], trimmed to the interval, oldest first.
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    bucket_id : str
+        name of the bucket to fetch
+    start : Optional[datetime]
+        start of the interval
+    end : Optional[datetime]
+        end of the interval
+    Returns
+    -------
+    Callable[[datetime, datetime], List[Event]]
+        function returning the events of the bucket overlapping the given interval
+    """
+    return events_slicer(client.get_events(bucket_id, start=start, end=end))
+
+
+def events_slicer(
+    events: List[Event],
+) -> Callable[[datetime, datetime], List[Event]]:
+    """Indexes already fetched events of a bucket, see `bucket_slicer`
+
+    Parameters
+    ----------
+    events : List[Event]
+        the events of the bucket as returned by aw-server, newest first
+    Returns
+    -------
+    Callable[[datetime, datetime], List[Event]]
+        function returning the events overlapping the given interval
+    """
+    # reverse before the (stable) sort so that events which were trimmed to the same
+    # timestamp keep the order aw-server returned them in
+    return events_lookup(IntervalIndex.from_events(events[::-1]))
 
 
+def paged_slicer(
+    client: ActivityWatchClient,
+    bucket_id: str,
+    page: timedelta,
+) -> Callable[[datetime, datetime], List[Event]]:
+    """Like `bucket_slicer`, but only keeps one page of the bucket in memory. A new page,
+    starting at the requested interval, is fetched whenever an interval isn't covered by
+    the current one, so lookups should be made in chronological order.
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    bucket_id : str
+        name of the bucket to fetch
+    page : timedelta
+        length of each page
+    Returns
+    -------
+    Callable[[datetime, datetime], List[Event]]
+        function returning the events of the bucket overlapping the given interval
+    """
+    page_start: Optional[datetime] = None
+    page_end: Optional[datetime] = None
+    slice_page: Callable[[datetime, datetime], List[Event]]
+
+    def slice_bucket(slice_start: datetime, slice_end: datetime) -> List[Event]:
+        nonlocal page_start, page_end, slice_page
+        if page_start is None or not page_start <= slice_start <= slice_end <= page_end:  # type: ignore
+            page_start = slice_start
+            page_end = max(slice_end, slice_start + page)
+            slice_page = bucket_slicer(client, bucket_id, page_start, page_end)
+        return slice_page(slice_start, slice_end)
+
+    return slice_bucket
+
+
+@instrumented()
 def event_iter(
     client: ActivityWatchClient,
     hostname: str,
     app_map: Dict[str, str | Callable[[datetime, datetime], List[Event]]],
     start: Optional[datetime] = None,
     end: Optional[datetime] = None,
+    batched: bool = False,
+    page: Optional[timedelta] = None,
 ):
     """Returns an iterator over all events in the given interval
 
@@ -93,15 +305,63 @@ def event_iter(
         hostname of the machine
     app_map : Dict[str,str|Callable]
         mapping of app names to event types
+    start : Optional[datetime]
+        start of the interval
+    end : Optional[datetime]
+        end of the interval
+    batched : bool
+        if True, each bucket in app_map is fetched once for the whole interval
+        instead of once per window event
+    page : Optional[timedelta]
+        if given, the window bucket (and in batched mode the buckets in app_map) are
+        fetched in pages of this length instead of all at once
 
     Yields
     -------
     Iterator[Tuple[str,Event]]
         Iterator over all events in the given interval
     """
+    if batched:
+        app_map = {
+            app: (
+                bucket_slicer(client, buckfunc, start, end)
+                if page is None
+                else paged_slicer(client, buckfunc, page)
+            )
+            if isinstance(buckfunc, str)
+            else buckfunc
+            for app, buckfunc in app_map.items()
+        }
+    yield from expand_windows(
+        client, window_gen(client, hostname, start, end, page), app_map
+    )
+
+
+def expand_windows(
+    client: ActivityWatchClient,
+    windows: Iterable[Event],
+    app_map: Dict[str, str | Callable[[datetime, datetime], List[Event]]],
+) -> Iterator[Tuple[str, Event]]:
+    """Replaces each window event of an app in app_map by the events of its bucket
+    (or the events returned by its function) during the window, see `event_iter`
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance, used for the buckets named in app_map
+    windows : Iterable[Event]
+        window events, in chronological order
+    app_map : Dict[str,str|Callable]
+        mapping of app names to event types
+
+    Yields
+    -------
+    Tuple[str,Event]
+        the category and event of all events during the windows
+    """
     app_id: str
     default_category: str = "window"
-    for event in window_gen(client, hostname, start, end):
+    for event in windows:
         if (app_id := event.data["app"]) in app_map:
             app_id = app_id if isinstance(app_id, str) else str(app_id)
             # check if the app is a string
@@ -127,12 +387,14 @@ def event_iter(
             yield (default_category, event)
 
 
+@instrumented(count=lambda merged: len(merged[0]))
 def bucket_merge(
     client: ActivityWatchClient,
     hostname: str,
     app_map: Dict[str, str | Callable],
     start: Optional[datetime] = None,
     end: Optional[datetime] = None,
+    batched: bool = False,
 ):
     """Merges all buckets in the given interval
 
@@ -148,28 +410,95 @@ def bucket_merge(
         start of the interval
     end : datetime
         end of the interval
+    batched : bool
+        fetch each bucket in app_map once instead of once per window event
 
     Returns
     -------
     Tuple[List[Event],List[str]]
         the merged events and their corresponding categories
     """
-    stop_event = Event(timestamp=datetime.now(timezone("UTC")), data={})
-
     merged_events: List[Event] = []
     merged_categories: List[str] = []
-    afk_events = afk_gen(client, hostname, start, end)
-    current_afk = next(afk_events, stop_event)
+    for category, event in bucket_merge_iter(
+        client, hostname, app_map, start, end, batched
+    ):
+        merged_events.append(event)
+        merged_categories.append(category)
 
-    # flag to indicate whether there are any afk events left
-    no_afk = not current_afk.data
+    return (merged_events, merged_categories)
 
-    for category, event in event_iter(client, hostname, app_map, start, end):
-        if no_afk:
+
+@instrumented()
+def bucket_merge_iter(
+    client: ActivityWatchClient,
+    hostname: str,
+    app_map: Dict[str, str | Callable],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    batched: bool = False,
+    page: Optional[timedelta] = None,
+) -> Iterator[Tuple[str, Event]]:
+    """Streaming version of `bucket_merge`, every event is yielded as soon as it is final.
+    With `page` set the buckets are fetched in pages of that length, so memory stays flat
+    no matter how long the interval is.
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    hostname : str
+        hostname of the machine
+    app_map : Dict[str,str|Callable]
+        mapping of app names to event types
+    start : datetime
+        start of the interval
+    end : datetime
+        end of the interval
+    batched : bool
+        fetch each bucket in app_map once (per page) instead of once per window event
+    page : Optional[timedelta]
+        length of the pages the buckets are fetched in, e.g. a day
+
+    Yields
+    -------
+    Tuple[str,Event]
+        the category and the merged event
+    """
+    splitter = AfkSplitter(afk_gen(client, hostname, start, end, page))
+    for category, event in event_iter(
+        client, hostname, app_map, start, end, batched, page
+    ):
+        yield from splitter.push(category, event)
+
+
+class AfkSplitter:
+    """The afk split of `bucket_merge_iter` as a state machine: window events are pushed
+    one at a time and cut around the current afk event, which is only replaced by the
+    next one once a window event ends after it. Keeping the cursor in an object lets
+    callers feed it incrementally, see `src.live_tail`.
+    """
+
+    def __init__(self, afk_events: Iterable[Event]):
+        """
+        Parameters
+        ----------
+        afk_events : Iterable[Event]
+            merged afk events in chronological order, as yielded by `afk_gen`
+        """
+        self._stop_event = Event(timestamp=datetime.now(timezone("UTC")), data={})
+        self._afk_events = iter(afk_events)
+        self.current_afk: Event = next(self._afk_events, self._stop_event)
+        # flag to indicate whether there are any afk events left
+        self.no_afk = not self.current_afk.data
+
+    def push(self, category: str, event: Event) -> Iterator[Tuple[str, Event]]:
+        """yields the parts of the window event outside of the afk events, and the afk
+        events which are over once this window event is done"""
+        if self.no_afk:
             # if there are no afk events left, we can just yield the current event
-            merged_events.append(event)
-            merged_categories.append(category)
-            continue
+            yield (category, event)
+            return
 
         # there are four cases to consider for each window event with respect to the current afk event:
         # 1. event starts before, ends after the current afk event -> split(event) and update(afk)
@@ -179,72 +508,48 @@ def bucket_merge(
         # 5. event starts after, ends during the current afk event -> ignore and keep
         # first check if the current window event ends after the current afk event
         if (event_end := event.timestamp + event.duration) > (
-            afk_end := current_afk.timestamp + current_afk.duration
+            afk_end := self.current_afk.timestamp + self.current_afk.duration
         ):
             # if the current window event starts before the current afk event
-            if event.timestamp < current_afk.timestamp:
+            if event.timestamp < self.current_afk.timestamp:
                 # starts before, ends after
                 # split the current window event into two events
 
                 # first event is the part of the window event before the afk event
-                event.duration = current_afk.timestamp - event.timestamp
+                event.duration = self.current_afk.timestamp - event.timestamp
                 # second event is the part of the window event after the afk event
                 new_event = Event(
                     timestamp=afk_end, duration=event_end - afk_end, data=event.data
                 )
-                merged_events.extend((event, current_afk, new_event))
-                merged_categories.extend((category, "afk", category))
+                yield (category, event)
+                yield ("afk", self.current_afk)
+                yield (category, new_event)
 
                 # update the current afk event
             else:
                 # starts after, ends after
                 # move the event's timestamp to the end of the afk event
-                event.timestamp = current_afk.timestamp + current_afk.duration
+                event.timestamp = self.current_afk.timestamp + self.current_afk.duration
                 # shorten the event's duration accordingly
                 event.duration = event_end - event.timestamp
                 # TODO: what if event is affected by the next afk event?
-                merged_events.extend((current_afk, event))
-                merged_categories.extend(("afk", category))
+                yield ("afk", self.current_afk)
+                yield (category, event)
 
             # update the current afk event in both cases
-            current_afk = next(afk_events, stop_event)
+            self.current_afk = next(self._afk_events, self._stop_event)
             # check if the current afk event is the stop event
-            if not current_afk.data:
-                no_afk = True
+            if not self.current_afk.data:
+                self.no_afk = True
         # next check if the current event starts prior to the current afk event
-        elif event.timestamp < current_afk.timestamp:
+        elif event.timestamp < self.current_afk.timestamp:
             # if it ends during the current afk event, shorten the event's duration
             # note we don't yet push the afk event because it will effect the next event
-            if event_end >= current_afk.timestamp:
+            if event_end >= self.current_afk.timestamp:
                 # starts before, ends during
                 # shorten the event's duration to end at the start of the afk event
-                event.duration = current_afk.timestamp - event.timestamp
+                event.duration = self.current_afk.timestamp - event.timestamp
 
             # starts before, ends before
             # push the event
-            merged_events.append(event)
-            merged_categories.append(category)
-
-    return (merged_events, merged_categories)
-
-
-if __name__ == "__main__":
-    from pprint import pprint
-
-    start = (
-        (datetime.today() - timedelta(days=1))
-        .astimezone(tz=timezone("America/Chicago"))
-        .replace(hour=0, minute=0, second=0, microsecond=0)
-    )
-
-    app_map: dict[str, str | Callable[[datetime, datetime], List[Event]]] = {
-        "google-chrome": "aw-watcher-web-chrome"
-    }
-    client = ActivityWatchClient()
-    hostname = socket.gethostname()
-    merged_events, merged_categories = bucket_merge(
-        client, hostname, app_map, start=start, end=start + timedelta(days=1)
-    )
-    # pprint(merged_categories)
-    pprint(list(zip(merged_categories, merged_events)))
-    print(len(merged_events))
+            yield (category, event)
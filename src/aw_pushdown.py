@@ -0,0 +1,125 @@
+from datetime import datetime
+import json
+import logging
+from typing import Callable, Dict, Iterator, List, Tuple
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+from requests import RequestException
+
+from src.aw_merge import afk_merge_gap, bucket_merge_iter, expand_windows
+
+logger = logging.getLogger(__name__)
+
+
+def merge_query(hostname: str, buckets: Dict[str, str]) -> str:
+    """Compiles the afk split of `bucket_merge` into an aw-server query2 program.
+
+    Consecutive afk events with the same status are merged by `flood` with the same
+    8 minute gap as `afk_runs`, the window events are cut to the not-afk periods with
+    `filter_period_intersect`, and the window events of each app in `buckets` are
+    replaced by the events of its bucket during those windows.
+
+    Parameters
+    ----------
+    hostname : str
+        hostname of the machine
+    buckets : Dict[str,str]
+        mapping of app names to the bucket whose events replace their window events
+    Returns
+    -------
+    str
+        the query, returning {"afk": [...], "windows": [...], "app_0": [...], ...}
+    """
+    lines = [
+        f"afk = flood(query_bucket({json.dumps(f'aw-watcher-afk_{hostname}')}),"
+        f" {afk_merge_gap.total_seconds():g});",
+        f"windows = query_bucket({json.dumps(f'aw-watcher-window_{hostname}')});",
+        # aw-server's python parser doesn't take nested calls with list arguments
+        'not_afk = filter_keyvals(afk, "status", ["not-afk"]);',
+        "windows = filter_period_intersect(windows, not_afk);",
+        'afk = filter_keyvals(afk, "status", ["afk"]);',
+    ]
+    returned = ['"afk": afk']
+    for i, (app, bucket) in enumerate(buckets.items()):
+        lines += [
+            f'app_{i} = filter_keyvals(windows, "app", [{json.dumps(app)}]);',
+            f"app_{i} = filter_period_intersect(query_bucket({json.dumps(bucket)}),"
+            f" app_{i});",
+        ]
+        returned.append(f'"app_{i}": app_{i}')
+    if buckets:
+        lines.append(
+            f'windows = exclude_keyvals(windows, "app", {json.dumps(list(buckets))});'
+        )
+    returned.append('"windows": windows')
+    lines.append(f"RETURN = {{{', '.join(returned)}}};")
+    return "\n".join(lines)
+
+
+def pushdown_merge_iter(
+    client: ActivityWatchClient,
+    hostname: str,
+    app_map: Dict[str, str | Callable[[datetime, datetime], List[Event]]],
+    start: datetime,
+    end: datetime,
+    fallback: bool = False,
+) -> Iterator[Tuple[str, Event]]:
+    """Merges all buckets in the given interval on aw-server with `merge_query`, so only
+    the merged events cross the wire. Functions in app_map can't run on the server,
+    their window events are expanded locally.
+
+    This is a different merge from `bucket_merge_iter`, not a drop-in for it. Unlike
+    `bucket_merge`, a window event overlapping several afk events is cut around
+    all of them, every afk event of the interval is returned (`bucket_merge` only yields
+    those followed by a window event), a gap of up to 8 minutes between an afk and a
+    not-afk event is split between the two by `flood` instead of left open, and window
+    events during longer gaps in the afk bucket are dropped instead of kept.
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    hostname : str
+        hostname of the machine
+    app_map : Dict[str,str|Callable]
+        mapping of app names to event types
+    start : datetime
+        start of the interval, timezone aware
+    end : datetime
+        end of the interval, timezone aware
+    fallback : bool
+        merge locally with `bucket_merge_iter` if the server can't run the query,
+        instead of raising the error. The timeline then differs as described above,
+        depending on the server
+
+    Yields
+    -------
+    Tuple[str,Event]
+        the category and the merged event, sorted by timestamp
+    """
+    buckets = {
+        app: bucket for app, bucket in app_map.items() if isinstance(bucket, str)
+    }
+    try:
+        (result,) = client.query(merge_query(hostname, buckets), [(start, end)])
+    except RequestException as error:
+        if not fallback:
+            raise
+        logger.info("aw-server can't run the merge query, merging locally: %s", error)
+        yield from bucket_merge_iter(
+            client, hostname, app_map, start, end, batched=True
+        )
+        return
+
+    merged = [("afk", Event(**event)) for event in result["afk"]]
+    for i, app in enumerate(buckets):
+        merged.extend((app, Event(**event)) for event in result[f"app_{i}"])
+    merged.extend(
+        expand_windows(
+            client,
+            (Event(**event) for event in result["windows"]),
+            {app: func for app, func in app_map.items() if callable(func)},
+        )
+    )
+    # the sort is stable, events of a bucket keep their order
+    yield from sorted(merged, key=lambda pair: pair[1].timestamp)
@@ -0,0 +1,163 @@
+from functools import lru_cache
+import json
+from pathlib import Path
+import re
+from typing import Dict, List, Literal, NamedTuple, Optional, Tuple
+
+import polars as pl
+
+default_rules_path = Path(__file__).parent.parent / ".config" / "categories.json"
+
+
+class Match(NamedTuple):
+    """the outcome of a rule for an (app, title) pair"""
+
+    category: str
+    # name of the parser which takes over the event, e.g. "browser", None if the
+    # event is just recorded under `category`
+    handler: Optional[str]
+    # what is recorded as the event's data
+    data: str
+
+
+class RuleSet:
+    """Ordered categorization rules, compiled once and memoized per (app, title)
+
+    Each rule is a dict with
+        app: list of app names, matched exactly
+        app_pattern: regex searched in the app name
+        title: regex searched in the title, its first group (if any) becomes the data
+        category: category of the matched events
+        handler: instead of a category, the parser which takes over the events
+    and the first rule whose app and title conditions all match wins.
+
+    Rules which only name apps end up in a dispatch table, all others are combined
+    into a single regex with one named alternative per rule, matched against
+    "app\\ntitle". Alternatives are tried in order, so the first match is also the
+    first rule. Patterns are matched per line (re.MULTILINE), `^` and `$` anchor to
+    the start and end of the app or title.
+    """
+
+    def __init__(
+        self,
+        rules: List[dict],
+        default: str = "Uncategorized",
+        data: Literal["app", "title"] = "app",
+    ):
+        """
+        Args:
+            rules (List[dict]): the rules, in order of precedence
+            default (str): category of the events no rule matches
+            data (Literal["app", "title"]): what is recorded as the data of an event,
+                unless its title rule captured a group
+        """
+        self.rules = rules
+        self.default = default
+        self.data = data
+        # first rule of each app which matches on the app name alone
+        self.dispatch: Dict[str, int] = {}
+        self.titles: Dict[int, re.Pattern] = {}
+        alternatives: List[str] = []
+        for i, rule in enumerate(rules):
+            if "category" not in rule and "handler" not in rule:
+                raise ValueError(f"rule {i} has neither a category nor a handler")
+            if "title" in rule:
+                self.titles[i] = re.compile(rule["title"], re.M)
+            if "app_pattern" not in rule and "title" not in rule:
+                for app in rule.get("app", []):
+                    self.dispatch.setdefault(app, i)
+                continue
+            app_pattern = rule.get("app_pattern") or (
+                "^(?:" + "|".join(map(re.escape, rule["app"])) + ")$"
+                if "app" in rule
+                else ""
+            )
+            alternatives.append(
+                f"(?P<r{i}>.*?(?:{app_pattern}).*\\n.*?(?:{rule.get('title', '')}))"
+            )
+        self.combined = (
+            re.compile("|".join(alternatives), re.M) if alternatives else None
+        )
+        self._cache: Dict[Tuple[str, str], Match] = {}
+
+    def match(self, app: str, title: str = "") -> Match:
+        """categorizes an event by its app and title, see `RuleSet`"""
+        if (cached := self._cache.get((app, title))) is not None:
+            return cached
+        rule_index = self.dispatch.get(app, len(self.rules))
+        # the title is kept to one line, the newline separates it from the app
+        line = title.replace("\n", " ")
+        if self.combined is not None and (
+            found := self.combined.match(f"{app}\n{line}")
+        ):
+            rule_index = min(rule_index, int(found.lastgroup[1:]))
+        data = title if self.data == "title" else app
+        if rule_index == len(self.rules):
+            result = Match(self.default, None, data)
+        else:
+            rule = self.rules[rule_index]
+            if rule_index in self.titles and (
+                captured := self.titles[rule_index].search(title)
+            ):
+                data = captured.group(1) if captured.re.groups else data
+            result = Match(
+                rule.get("category", self.default), rule.get("handler"), data
+            )
+        self._cache[(app, title)] = result
+        return result
+
+    def categorize(
+        self, frame: pl.DataFrame, app: str = "app", title: str = "title"
+    ) -> pl.DataFrame:
+        """Adds the columns category, handler and label (the data of `Match`) to a frame
+        of events. Only the distinct (app, title) pairs are matched, the results are
+        joined back to the events."""
+        keyed = frame.with_columns(
+            pl.col(app).fill_null("").alias("__app"),
+            pl.col(title).fill_null("").alias("__title"),
+        )
+        pairs = keyed.select("__app", "__title").unique()
+        matches = [self.match(*pair) for pair in pairs.iter_rows()]
+        lookup = pairs.with_columns(
+            pl.Series("category", [m.category for m in matches], pl.Utf8),
+            pl.Series("handler", [m.handler for m in matches], pl.Utf8),
+            pl.Series("label", [m.data for m in matches], pl.Utf8),
+        )
+        return keyed.join(lookup, on=["__app", "__title"], how="left").drop(
+            "__app", "__title"
+        )
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RuleSet":
+        return cls(
+            config.get("rules", []),
+            config.get("default", "Uncategorized"),
+            config.get("data", "app"),
+        )
+
+
+class CategoryRules(NamedTuple):
+    """the rules for window events and for the pages of browser windows"""
+
+    windows: RuleSet
+    pages: RuleSet
+
+
+@lru_cache
+def load_rules(path: Path = default_rules_path) -> CategoryRules:
+    """Reads the categorization rules from a json file like .config/categories.json,
+    with a "windows" and a "pages" `RuleSet`. The rules of a path are only compiled
+    once per process, so their memo is shared by every caller.
+
+    Args:
+        path (Path): the rules file
+    Returns:
+        CategoryRules: the compiled rules
+    """
+    config = json.loads(path.read_text())
+    return CategoryRules(
+        RuleSet.from_config(config.get("windows", {})),
+        RuleSet.from_config(
+            {"default": "Browsing", "data": "title"} | config.get("pages", {})
+        ),
+    )
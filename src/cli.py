@@ -0,0 +1,453 @@
+"""anatomyofflow command line: merge, export and sync the activity data.
+
+    anatomyofflow merge --days 1 --tz Europe/Berlin
+    anatomyofflow merge --host laptop --host desktop --policy lanes --format json
+    anatomyofflow export events.xlsx --what events --start 2023-05-01 --end 2023-06-01
+    anatomyofflow sync --rollups --oura .config/oura.json
+
+Only the standard library is imported up front. Each subcommand imports what it needs
+when it runs, and sync checks the stores' manifests before it imports anything else,
+so `--help` and a sync without missing days start about as fast as the interpreter and
+can run from cron every few minutes (see benchmarks/bench_startup.py).
+"""
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from datetime import date, datetime, time, timedelta, timezone, tzinfo
+import json
+import os
+from pathlib import Path
+import socket
+import sys
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from src.manifest import is_complete, read_manifest
+
+default_cache_dir = Path.home() / ".cache" / "anatomyofflow"
+default_app_map = {"google-chrome": "aw-watcher-web-chrome"}
+# how long after its end a day of each store is complete, passed to the stores as well
+# so that the manifest check of `sync` and the stores agree
+sync_grace = {
+    "rollups": timedelta(minutes=10),
+    "heartrate": timedelta(hours=12),
+    "heartbeats": timedelta(hours=1),
+}
+
+
+def parse_time(value: str) -> datetime | date:
+    """an ISO date or datetime"""
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ArgumentTypeError(f"not an ISO date or datetime: {value}")
+
+
+def parse_app(value: str) -> Tuple[str, str]:
+    """APP=BUCKET"""
+    app, separator, bucket = value.partition("=")
+    if not separator or not app or not bucket:
+        raise ArgumentTypeError(f"expected APP=BUCKET, got {value}")
+    return app, bucket
+
+
+def time_range(args: Namespace, until_now: bool = False) -> Tuple[datetime, datetime]:
+    """The interval given by --start, --end and --days, timezone aware.
+
+    Dates are midnights in --tz. Without --end the range ends at the start of today,
+    so only complete days are included, or now with `until_now`. Without --start it
+    starts at the midnight --days days before its end. An empty range raises
+    ArgumentTypeError, which `main` reports as a usage error.
+    """
+    tz = zone(args.tz)
+
+    def aware(value: datetime | date) -> datetime:
+        if not isinstance(value, datetime):
+            return datetime.combine(value, time(), tz)
+        return value if value.tzinfo else value.replace(tzinfo=tz)
+
+    today = datetime.combine(datetime.now(tz).date(), time(), tz)
+    end = aware(args.end) if args.end else (datetime.now(tz) if until_now else today)
+    start = (
+        aware(args.start)
+        if args.start
+        else datetime.combine(
+            (end - timedelta(microseconds=1)).date() - timedelta(days=args.days - 1),
+            time(),
+            tz,
+        )
+    )
+    if start >= end:
+        raise ArgumentTypeError(
+            f"empty range: {start.isoformat()} is not before {end.isoformat()}"
+        )
+    return start, end
+
+
+def zone(name: Optional[str]) -> tzinfo:
+    """the named timezone, or the local one"""
+    if name is None:
+        return local_zone()
+    return ZoneInfo(name)
+
+
+def local_zone() -> tzinfo:
+    """The machine's timezone, with its daylight saving rules: the zone named by $TZ,
+    else /etc/localtime. Only if neither is readable, the current UTC offset, which is
+    off by an hour across a daylight saving change."""
+    name = os.environ.get("TZ", "").lstrip(":")
+    try:
+        if name:
+            return ZoneInfo(name)
+    except (ValueError, ZoneInfoNotFoundError):
+        # a POSIX rule like "CET-1CEST" or a path, see tzset(3)
+        pass
+    try:
+        with open(name if name.startswith("/") else "/etc/localtime", "rb") as file:
+            return ZoneInfo.from_file(file, key="localtime")
+    except (OSError, ValueError):
+        return datetime.now().astimezone().tzinfo  # type: ignore
+
+
+def days_of(start: datetime, end: datetime) -> List[date]:
+    """the local dates which overlap [start, end)"""
+    first = start.date()
+    return [
+        first + timedelta(days=n)
+        for n in range(((end - timedelta(microseconds=1)).date() - first).days + 1)
+    ]
+
+
+def create_client(args: Namespace):
+    from aw_client.client import ActivityWatchClient
+
+    server = urlsplit(args.server)
+    client = ActivityWatchClient(
+        # aw_client only allows one client per name and server
+        f"anatomyofflow-cli-{os.getpid()}",
+        testing=args.testing,
+        host=server.hostname,
+        port=server.port,
+        protocol=server.scheme,
+    )
+    if not args.cached:
+        return client
+    from src.aw_cache import CachedClient
+
+    return CachedClient(client, args.cache_dir / "aw")
+
+
+def app_map_of(args: Namespace) -> Dict[str, str]:
+    return dict(args.app) if args.app else default_app_map
+
+
+def merge(args: Namespace) -> int:
+    start, end = time_range(args, until_now=True)
+    client = create_client(args)
+    tz = zone(args.tz)
+    hosts: Optional[List[str]] = args.host
+    if args.all_hosts or (hosts and len(hosts) > 1):
+        from src.multi_host import multi_host_merge
+
+        rows = multi_host_merge(
+            client, app_map_of(args), start, end, hosts, policy=args.policy
+        )
+    else:
+        hostname = hosts[0] if hosts else socket.gethostname()
+        if args.pushdown:
+            from src.aw_pushdown import pushdown_merge_iter
+
+            merged = pushdown_merge_iter(client, hostname, app_map_of(args), start, end)
+        else:
+            from src.aw_merge import bucket_merge_iter
+
+            merged = bucket_merge_iter(
+                client, hostname, app_map_of(args), start, end, batched=True
+            )
+        rows = ((hostname, category, event) for category, event in merged)
+
+    count = 0
+    for hostname, category, event in rows:
+        event_start = event.timestamp.astimezone(tz)
+        if args.format == "json":
+            line = json.dumps(
+                {
+                    "host": hostname,
+                    "category": category,
+                    "timestamp": event_start.isoformat(),
+                    "duration": event.duration.total_seconds(),
+                    "data": event.data,
+                }
+            )
+        else:
+            line = (
+                f"{event_start:%Y-%m-%d %H:%M:%S}"
+                f"  {event.duration.total_seconds():>8.1f}s"
+                f"  {hostname}  {category:<14}  {json.dumps(event.data)}"
+            )
+        print(line)
+        count += 1
+    if args.format != "json":
+        print(f"{count} events", file=sys.stderr)
+    return 0
+
+
+def export(args: Namespace) -> int:
+    start, end = time_range(args)
+    client = create_client(args)
+    tz = zone(args.tz)
+    hostname = args.host[0] if args.host else socket.gethostname()
+    if args.what == "events":
+        from src.categories import default_rules_path
+        from src.user_events import iter_event_df
+
+        days = iter_event_df(
+            client,
+            hostname,
+            start,
+            end,
+            args.workers,
+            rules_path=args.rules or default_rules_path,
+            tz=tz,
+        )
+        sort_by = "Start"
+    else:
+        from src.export import merged_days
+
+        dates = days_of(start, end)
+        days = merged_days(
+            client,
+            hostname,
+            app_map_of(args),
+            dates[0],
+            dates[-1] + timedelta(days=1),
+            tz=tz,
+        )
+        sort_by = "timestamp"
+
+    from src.export import export_excel, export_parquet
+
+    if (
+        args.format or ("xlsx" if args.path.suffix == ".xlsx" else "parquet")
+    ) == "xlsx":
+        written = export_excel(days, args.path, sort_by)
+    else:
+        written = export_parquet(days, args.path)
+    print(f"exported {written} days to {args.path}", file=sys.stderr)
+    return 0
+
+
+def sync(args: Namespace) -> int:
+    start, end = time_range(args)
+    tz = zone(args.tz)
+    local_days = days_of(start, end)
+    hostname = args.host[0] if args.host else socket.gethostname()
+    rollups_dir = args.cache_dir / "rollups"
+    heartrate_dir = args.cache_dir / "oura" / "heartrate"
+    heartbeats_dir = args.cache_dir / "wakatime" / "heartbeats"
+    # the heart rate store is partitioned by UTC day
+    utc_start = start.astimezone(timezone.utc)
+    utc_days = days_of(utc_start, end.astimezone(timezone.utc))
+
+    def tz_end(day: date) -> datetime:
+        return datetime.combine(day + timedelta(days=1), time(), tz)
+
+    # the heartbeat store ends its days at the machine's midnight, whatever --tz says
+    local = local_zone()
+
+    def local_end(day: date) -> datetime:
+        return datetime.combine(day + timedelta(days=1), time(), local)
+
+    def pending(
+        store_dir: Path, days: List[date], paths, day_end, grace: timedelta
+    ) -> List[date]:
+        manifest = read_manifest(store_dir)
+        return [
+            day
+            for day in days
+            if not is_complete(
+                manifest, day.isoformat(), paths(day), day_end(day), grace
+            )
+        ]
+
+    if not (args.rollups or args.oura or args.wakatime):
+        args.rollups = True
+    synced = 0
+    if args.rollups and (
+        missing := pending(
+            rollups_dir / hostname,
+            local_days,
+            lambda day: [
+                rollups_dir / hostname / kind / f"{day.isoformat()}.parquet"
+                for kind in ("hourly", "daily")
+            ],
+            tz_end,
+            sync_grace["rollups"],
+        )
+    ):
+        from src.rollups import RollupStore
+
+        store = RollupStore(
+            create_client(args),
+            hostname,
+            app_map_of(args),
+            rollups_dir,
+            sync_grace["rollups"],
+            tz=tz,
+        )
+        store.update(missing[0], missing[-1] + timedelta(days=1))
+        synced += len(missing)
+
+    if args.oura and (
+        missing := pending(
+            heartrate_dir,
+            utc_days,
+            lambda day: [heartrate_dir / f"{day.isoformat()}.parquet"],
+            lambda day: datetime.combine(day + timedelta(days=1), time(), timezone.utc),
+            sync_grace["heartrate"],
+        )
+    ):
+        from src.oura_handler import HeartRateStore
+
+        HeartRateStore(
+            json.loads(args.oura.read_text())["access_token"],
+            heartrate_dir,
+            sync_grace["heartrate"],
+        ).sync([datetime.combine(day, time(), timezone.utc) for day in missing])
+        synced += len(missing)
+
+    if args.wakatime and (
+        missing := pending(
+            heartbeats_dir,
+            local_days,
+            lambda day: [heartbeats_dir / f"{day.isoformat()}.parquet"],
+            local_end,
+            sync_grace["heartbeats"],
+        )
+    ):
+        from src.wakatime_handler import HeartbeatStore, initialize_session
+
+        session = initialize_session(args.wakatime, os.urandom(20).hex())
+        HeartbeatStore(session, heartbeats_dir, grace=sync_grace["heartbeats"]).sync(
+            missing
+        )
+        synced += len(missing)
+
+    if synced:
+        print(f"synced {synced} days", file=sys.stderr)
+    return 0
+
+
+def parser() -> ArgumentParser:
+    root = ArgumentParser(prog="anatomyofflow", description=__doc__.splitlines()[0])
+    root.add_argument(
+        "--server", default="http://localhost:5600", help="aw-server address"
+    )
+    root.add_argument(
+        "--testing", action="store_true", help="aw-server runs in testing mode"
+    )
+    root.add_argument(
+        "--cached",
+        action="store_true",
+        help="keep a local copy of the aw buckets, see CachedClient",
+    )
+    root.add_argument("--cache-dir", type=Path, default=default_cache_dir)
+    commands = root.add_subparsers(dest="command", required=True)
+
+    def add_command(name: str, help: str, days: int) -> ArgumentParser:
+        command = commands.add_parser(name, help=help, description=help)
+        command.add_argument(
+            "--start", type=parse_time, help="ISO date or datetime, dates are midnights"
+        )
+        command.add_argument("--end", type=parse_time, help="ISO date or datetime")
+        command.add_argument(
+            "--days",
+            type=int,
+            default=days,
+            help=f"number of days before --end, if --start isn't given (default {days})",
+        )
+        command.add_argument(
+            "--tz", help="timezone of the dates and the output, defaults to local time"
+        )
+        command.add_argument(
+            "--host",
+            action="append",
+            help="hostname, repeat to merge several hosts (default: this machine)",
+        )
+        command.add_argument(
+            "--app",
+            type=parse_app,
+            action="append",
+            help="APP=BUCKET, replaces the window events of APP by the bucket's events"
+            " (default: google-chrome=aw-watcher-web-chrome)",
+        )
+        return command
+
+    command = add_command("merge", "print the merged timeline, ends now", 1)
+    command.add_argument(
+        "--all-hosts", action="store_true", help="merge every host aw-server knows"
+    )
+    command.add_argument(
+        "--policy",
+        choices=["last-input", "lanes"],
+        default="last-input",
+        help="how overlapping hosts are combined: keep the latest started event, or"
+        " every host's events",
+    )
+    command.add_argument(
+        "--pushdown",
+        action="store_true",
+        help="let aw-server do the afk split, a slightly different merge which fails"
+        " if the server can't run the query (see pushdown_merge_iter)",
+    )
+    command.add_argument("--format", choices=["text", "json"], default="text")
+    command.set_defaults(run=merge)
+
+    command = add_command("export", "export complete days to Excel or Parquet", 14)
+    command.add_argument("path", type=Path, help=".xlsx file or Parquet directory")
+    command.add_argument(
+        "--what",
+        choices=["merged", "events"],
+        default="merged",
+        help="the merged timeline, or the categorized events of build_event_df",
+    )
+    command.add_argument(
+        "--format",
+        choices=["xlsx", "parquet"],
+        help="defaults to xlsx for .xlsx paths, Parquet otherwise",
+    )
+    command.add_argument("--rules", type=Path, help="categorization rules file")
+    command.add_argument("--workers", type=int, help="days built at the same time")
+    command.set_defaults(run=export)
+
+    command = add_command("sync", "update the local stores of complete days", 7)
+    command.add_argument(
+        "--rollups",
+        action="store_true",
+        help="hourly and daily focus rollups, the default without other stores",
+    )
+    command.add_argument(
+        "--oura", type=Path, help="Oura config with an access_token, syncs heart rate"
+    )
+    command.add_argument(
+        "--wakatime", type=Path, help="WakaTime config, syncs the heartbeats"
+    )
+    command.set_defaults(run=sync)
+    return root
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    root = parser()
+    args = root.parse_args(argv)
+    try:
+        return args.run(args)
+    except ArgumentTypeError as error:
+        # exits with status 2, like the errors of parse_args
+        root.error(str(error))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+from datetime import date, datetime, time, timedelta, tzinfo
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+
+import polars as pl
+from xlsxwriter import Workbook
+
+from src.afk_split import bucket_merge_table
+
+# a day (or the start of a workday) and its events
+Day = Tuple[date, pl.DataFrame]
+
+
+def merged_days(
+    client: ActivityWatchClient,
+    hostname: str,
+    app_map: Dict[str, str | Callable[[datetime, datetime], List[Event]]],
+    start: date,
+    end: date,
+    batched: bool = True,
+    tz: Optional[tzinfo] = None,
+) -> Iterator[Day]:
+    """Merges the timeline one day at a time, see `bucket_merge_table`
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    hostname : str
+        hostname of the machine
+    app_map : Dict[str,str|Callable]
+        mapping of app names to event types
+    start : date
+        first day
+    end : date
+        day after the last one
+    batched : bool
+        fetch each bucket in app_map once per day instead of once per window event
+    tz : Optional[tzinfo]
+        timezone whose midnights bound the days, defaults to local time
+    Yields
+    -------
+    Tuple[date, pl.DataFrame]
+        the day and its merged events with the columns category, timestamp, end and
+        data. Days without events are left out
+    """
+    day = start
+    while day < end:
+        timeline = bucket_merge_table(
+            client,
+            hostname,
+            app_map,
+            # naive midnights are taken as local time
+            datetime.combine(day, time(), tz).astimezone(tz),
+            datetime.combine(day + timedelta(days=1), time(), tz).astimezone(tz),
+            batched,
+        ).to_polars(categorical=False)
+        if len(timeline):
+            yield day, timeline
+        day += timedelta(days=1)
+
+
+def export_excel(
+    days: Iterable[Day],
+    path: Path,
+    sort_by: Optional[str] = "Start",
+    sheet_name: str = "%a %Y-%m-%d",
+) -> int:
+    """Writes each day to its own worksheet as soon as it arrives, e.g. from
+    `iter_event_df` or `merged_days`
+
+    The workbook is opened in xlsxwriter's constant_memory mode, which flushes every
+    row to disk once the next one is started, so the peak memory is one day's
+    dataframe no matter how many days are exported. Timezones are dropped, Excel has
+    no aware datetimes.
+
+    Parameters
+    ----------
+    days : Iterable[Tuple[date, pl.DataFrame]]
+        the days to export, in order
+    path : Path
+        the .xlsx file
+    sort_by : Optional[str]
+        column each day is sorted by, None to keep the order
+    sheet_name : str
+        strftime format of the worksheet names, at most 31 characters long
+    Returns
+    -------
+    int
+        the number of worksheets written
+    """
+    sheets = 0
+    with Workbook(
+        str(path), {"constant_memory": True, "remove_timezone": True}
+    ) as workbook:
+        header = workbook.add_format({"bold": True})
+        datetime_format = workbook.add_format({"num_format": "yyyy-mm-dd hh:mm:ss.000"})
+        for day, frame in days:
+            worksheet = workbook.add_worksheet(day.strftime(sheet_name))
+            if sort_by is not None:
+                frame = frame.sort(sort_by)
+            formats = [
+                datetime_format if isinstance(dtype, pl.Datetime) else None
+                for dtype in frame.dtypes
+            ]
+            for column in range(frame.width):
+                worksheet.set_column(column, column, 22 if formats[column] else 16)
+            # constant_memory only keeps the current row, so rows are written in order
+            worksheet.write_row(0, 0, frame.columns, header)
+            for row, values in enumerate(frame.iter_rows(), 1):
+                for column, value in enumerate(values):
+                    worksheet.write(row, column, value, formats[column])
+            sheets += 1
+    return sheets
+
+
+def export_parquet(days: Iterable[Day], directory: Path, partition: str = "day") -> int:
+    """Appends each day to a hive partitioned Parquet dataset as soon as it arrives,
+    one file per day at `directory/day=YYYY-MM-DD/data.parquet`, which
+    `pl.scan_parquet(directory / "*" / "*.parquet")` reads back. A day that was
+    exported before is replaced.
+
+    Parameters
+    ----------
+    days : Iterable[Tuple[date, pl.DataFrame]]
+        the days to export
+    directory : Path
+        root of the dataset
+    partition : str
+        name of the partition key
+    Returns
+    -------
+    int
+        the number of days written
+    """
+    written = 0
+    for day, frame in days:
+        day_dir = directory / f"{partition}={_as_date(day).isoformat()}"
+        day_dir.mkdir(parents=True, exist_ok=True)
+        frame.write_parquet(day_dir / "data.parquet")
+        written += 1
+    return written
+
+
+def _as_date(day: date) -> date:
+    return day.date() if isinstance(day, datetime) else day
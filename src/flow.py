@@ -0,0 +1,315 @@
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from math import exp, log
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from aw_core.models import Event
+
+import polars as pl
+
+flow_schema = {
+    "start": pl.Datetime("us", "UTC"),
+    "end": pl.Datetime("us", "UTC"),
+    "state": pl.Utf8,
+    "score": pl.Float64,
+    "switches_per_minute": pl.Float64,
+    "dwell_seconds": pl.Float64,
+    "entropy": pl.Float64,
+    "bpm": pl.Float64,
+    "bpm_delta": pl.Float64,
+}
+
+
+class FlowSession(NamedTuple):
+    """A stretch of activity in one state, with the time weighted means of the rolling
+    features of its events"""
+
+    start: datetime
+    end: datetime
+    # "flow" or "unfocused"
+    state: str
+    # 0 (scattered) to 1 (absorbed)
+    score: float
+    switches_per_minute: float
+    dwell_seconds: float
+    # of the time spent per context, in nats
+    entropy: float
+    # mean heart rate, None without samples
+    bpm: Optional[float]
+    # difference to the long running heart rate baseline
+    bpm_delta: Optional[float]
+
+
+class FlowDetector:
+    """Scores the merged timeline for flow in a single pass, one event at a time.
+
+    For every event it updates rolling windows of the last `window` of activity: the
+    number of context switches, the mean dwell time per context and the entropy of the
+    time spent per context (a context is the app of a window event, or the category of
+    the events replacing it). These are combined into a score between 0 and 1, which
+    labels the event "flow" above `flow_threshold` and "unfocused" below
+    `unfocused_threshold`. In between an event keeps the label of the previous one, so
+    a short dip doesn't end a session. Consecutive events with the same label form a
+    session, which also ends at afk events and gaps longer than `max_gap`.
+
+    Heart rate samples are joined as of each event's end: the mean of the samples in
+    the window, compared to an exponentially weighted baseline. They only describe the
+    sessions and don't change their scores.
+
+    Each event and sample costs O(1) amortized, and only the window is kept in memory.
+    Events and samples have to be pushed in order of time, see `detect_flow`.
+    """
+
+    def __init__(
+        self,
+        window: timedelta = timedelta(minutes=10),
+        flow_threshold: float = 0.6,
+        unfocused_threshold: float = 0.4,
+        min_duration: timedelta = timedelta(minutes=10),
+        max_gap: timedelta = timedelta(minutes=2),
+        switch_scale: float = 1.0,
+        dwell_scale: timedelta = timedelta(minutes=2),
+        baseline_half_life: timedelta = timedelta(hours=6),
+        heartrate_tolerance: timedelta = timedelta(minutes=5),
+    ):
+        """
+        Args:
+            window (timedelta): length of the rolling windows
+            flow_threshold (float): score above which an event is in flow
+            unfocused_threshold (float): score below which an event is unfocused
+            min_duration (timedelta): shorter sessions aren't emitted
+            max_gap (timedelta): longer gaps between events end the session
+            switch_scale (float): switches per minute at which the switch part of
+                the score drops to 1/e
+            dwell_scale (timedelta): mean dwell time at which the dwell part of the
+                score is 0.5
+            baseline_half_life (timedelta): half life of the heart rate baseline
+            heartrate_tolerance (timedelta): samples older than this don't describe
+                an event anymore
+        """
+        self.window = window.total_seconds()
+        self.flow_threshold = flow_threshold
+        self.unfocused_threshold = unfocused_threshold
+        self.min_duration = min_duration.total_seconds()
+        self.max_gap = max_gap.total_seconds()
+        self.switch_scale = switch_scale
+        self.dwell_scale = dwell_scale.total_seconds()
+        self.baseline_half_life = baseline_half_life.total_seconds()
+        self.heartrate_tolerance = heartrate_tolerance.total_seconds()
+
+        # events in the window as [start, end, context, counted seconds]
+        self._events: Deque[list] = deque()
+        self._switches: Deque[float] = deque()
+        self._seconds: Dict[str, float] = {}
+        self._total = 0.0
+        # sum of s * log(s) over the seconds per context, for the entropy
+        self._s_log_s = 0.0
+        self._origin: Optional[float] = None
+        self._last_context: Optional[str] = None
+        self._last_end: Optional[float] = None
+
+        self._samples: Deque[Tuple[float, float]] = deque()
+        self._bpm_sum = 0.0
+        self._baseline: Optional[float] = None
+        self._last_sample: Optional[float] = None
+
+        self._state: Optional[str] = None
+        # start, end and the time weighted sums of the open session
+        self._session: Optional[list] = None
+
+    def push(self, category: str, event: Event) -> List[FlowSession]:
+        """Adds the next event of the merged timeline
+
+        Args:
+            category (str): the event's category, as yielded by `bucket_merge_iter`
+            event (Event): the event
+        Returns:
+            List[FlowSession]: the sessions this event ended, usually none
+        """
+        start = event.timestamp.timestamp()
+        end = start + event.duration.total_seconds()
+        closed: List[FlowSession] = []
+        if category == "afk" or (
+            self._last_end is not None and start - self._last_end > self.max_gap
+        ):
+            closed += self.flush()
+        if category == "afk" or end <= start:
+            return closed
+        context = event.data.get("app", category) if category == "window" else category
+        self._add(start, end, context)
+        score, switch_rate, dwell, entropy = self._features(end)
+        bpm, bpm_delta = self._heartrate(end)
+
+        if score >= self.flow_threshold:
+            state = "flow"
+        elif score <= self.unfocused_threshold or self._state is None:
+            state = "unfocused" if score < 0.5 else "flow"
+        else:
+            state = self._state
+        if state != self._state:
+            closed += self._close()
+            self._state = state
+            self._session = [start, end, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        session = self._session
+        assert session is not None
+        seconds = end - start
+        session[1] = end
+        session[2] += seconds * score
+        session[3] += seconds * switch_rate
+        session[4] += seconds * dwell
+        session[5] += seconds * entropy
+        session[6] += seconds
+        if bpm is not None:
+            session[7] += seconds * bpm
+            session[8] += seconds * bpm_delta
+            session[9] += seconds
+        return closed
+
+    def push_heartrate(self, timestamp: datetime, bpm: float):
+        """adds the next heart rate sample"""
+        time = timestamp.timestamp()
+        self._samples.append((time, bpm))
+        self._bpm_sum += bpm
+        if self._baseline is None or self._last_sample is None:
+            self._baseline = bpm
+        else:
+            weight = 0.5 ** ((time - self._last_sample) / self.baseline_half_life)
+            self._baseline = weight * self._baseline + (1 - weight) * bpm
+        self._last_sample = time
+
+    def flush(self) -> List[FlowSession]:
+        """ends the open session and clears the windows, e.g. at the end of the data"""
+        closed = self._close()
+        self._state = None
+        self._events.clear()
+        self._switches.clear()
+        self._seconds.clear()
+        self._total = self._s_log_s = 0.0
+        self._origin = self._last_context = self._last_end = None
+        return closed
+
+    def _add(self, start: float, end: float, context: str):
+        if self._origin is None:
+            self._origin = start
+        elif context != self._last_context:
+            self._switches.append(start)
+        self._last_context = context
+        self._last_end = end
+        self._events.append([start, end, context, 0.0])
+        self._count(self._events[-1], end - max(start, end - self.window))
+
+        # move the window, only its oldest event can be partly inside
+        window_start = end - self.window
+        while self._events[0][1] <= window_start:
+            self._count(self._events[0], 0.0)
+            self._events.popleft()
+        oldest = self._events[0]
+        self._count(oldest, oldest[1] - max(oldest[0], window_start))
+        while self._switches and self._switches[0] < window_start:
+            self._switches.popleft()
+
+    def _count(self, entry: list, seconds: float):
+        """changes the seconds an event in the window contributes"""
+        context = entry[2]
+        before = self._seconds.get(context, 0.0)
+        after = before + seconds - entry[3]
+        entry[3] = seconds
+        self._s_log_s += _x_log_x(after) - _x_log_x(before)
+        self._total += after - before
+        if after <= 1e-9:
+            self._seconds.pop(context, None)
+        else:
+            self._seconds[context] = after
+
+    def _features(self, now: float) -> Tuple[float, float, float, float]:
+        assert self._origin is not None
+        minutes = max(min(self.window, now - self._origin), 60.0) / 60
+        switch_rate = len(self._switches) / minutes
+        dwell = self._total / (len(self._switches) + 1)
+        entropy = (
+            max(log(self._total) - self._s_log_s / self._total, 0.0)
+            if self._total > 0
+            else 0.0
+        )
+        score = (
+            exp(-switch_rate / self.switch_scale)
+            + dwell / (dwell + self.dwell_scale)
+            + exp(-entropy)
+        ) / 3
+        return score, switch_rate, dwell, entropy
+
+    def _heartrate(self, now: float) -> Tuple[Optional[float], Optional[float]]:
+        """the mean of the samples in the window as of `now` and its difference to the
+        baseline"""
+        window_start = now - max(self.window, self.heartrate_tolerance)
+        while self._samples and self._samples[0][0] < window_start:
+            self._bpm_sum -= self._samples.popleft()[1]
+        if not self._samples or self._baseline is None:
+            return None, None
+        bpm = self._bpm_sum / len(self._samples)
+        return bpm, bpm - self._baseline
+
+    def _close(self) -> List[FlowSession]:
+        session, self._session = self._session, None
+        if session is None or session[1] - session[0] < self.min_duration:
+            return []
+        start, end, score, switches, dwell, entropy, seconds, bpm, delta, hr = session
+        return [
+            FlowSession(
+                datetime.fromtimestamp(start, timezone.utc),
+                datetime.fromtimestamp(end, timezone.utc),
+                self._state or "unfocused",
+                score / seconds,
+                switches / seconds,
+                dwell / seconds,
+                entropy / seconds,
+                bpm / hr if hr else None,
+                delta / hr if hr else None,
+            )
+        ]
+
+
+def _x_log_x(x: float) -> float:
+    return x * log(x) if x > 0 else 0.0
+
+
+def detect_flow(
+    timeline: Iterable[Tuple[str, Event]],
+    heartrate: Iterable[Tuple[datetime, float]] = (),
+    detector: Optional[FlowDetector] = None,
+) -> Iterator[FlowSession]:
+    """Runs a `FlowDetector` over the merged timeline, joining the heart rate samples
+    as of each event's end by merging the two sorted streams
+
+    Parameters
+    ----------
+    timeline : Iterable[Tuple[str, Event]]
+        (category, event) pairs sorted by timestamp, e.g. from `bucket_merge_iter`
+    heartrate : Iterable[Tuple[datetime, float]]
+        (timestamp, bpm) samples sorted by timestamp, e.g. the rows of
+        `HeartRateStore.load(...).select("timestamp", "bpm")`
+    detector : Optional[FlowDetector]
+        the detector and its parameters, defaults to `FlowDetector()`
+    Yields
+    -------
+    FlowSession
+        the flow and unfocused sessions, in order
+    """
+    detector = detector or FlowDetector()
+    samples = iter(heartrate)
+    pending = next(samples, None)
+    for category, event in timeline:
+        event_end = event.timestamp + event.duration
+        while pending is not None and pending[0] <= event_end:
+            detector.push_heartrate(*pending)
+            pending = next(samples, None)
+        yield from detector.push(category, event)
+    yield from detector.flush()
+
+
+def flow_sessions_df(sessions: Iterable[FlowSession]) -> pl.DataFrame:
+    """collects the sessions of `detect_flow` into a dataframe with `flow_schema`"""
+    return pl.DataFrame(
+        [tuple(session) for session in sessions],
+        schema=flow_schema,
+        orient="row",
+    )
@@ -0,0 +1,404 @@
+from contextlib import contextmanager
+from functools import wraps
+import inspect
+import json
+import os
+from pathlib import Path
+import threading
+from time import perf_counter_ns, time_ns
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+from urllib.parse import urlsplit
+
+import requests
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# the recorder of the current run, None while instrumentation is disabled
+_recorder: Optional["Recorder"] = None
+
+
+class Stat:
+    """Call count, latency histogram, bytes, events and errors of one instrumented
+    name"""
+
+    __slots__ = ("calls", "nanos", "max_nanos", "events", "bytes", "errors", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.nanos = 0
+        self.max_nanos = 0
+        self.events = 0
+        self.bytes = 0
+        self.errors = 0
+        # bucket i counts the calls which took less than 2**i microseconds
+        self.buckets: List[int] = [0] * 40
+
+    def add(self, nanos: int, events: int):
+        self.calls += 1
+        self.nanos += nanos
+        self.max_nanos = max(self.max_nanos, nanos)
+        self.events += events
+        self.buckets[min((nanos // 1000).bit_length(), 39)] += 1
+
+    def percentile(self, q: float) -> float:
+        """upper bound of the q-th percentile of the latency in seconds, from the
+        histogram"""
+        rank = q * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2**i / 10**6, self.max_nanos / 10**9)
+        return self.max_nanos / 10**9
+
+
+class Recorder:
+    """Collects the stats and spans of one run, see `recording`.
+
+    Functions are recorded by the time of the call, generators by the time spent
+    inside them (summed over every resume), with the events they returned or yielded.
+    Calls which raise are recorded as well, with the name of the exception as their
+    error, so the trace shows the failing and timed out requests too. HTTP bytes are added to the innermost instrumented call of the thread which made
+    the request, and to a stat per host.
+    """
+
+    def __init__(self, trace: bool = True):
+        """
+        Args:
+            trace (bool): keep a span per call for `write_chrome_trace` and `write_otlp`
+        """
+        self.trace = trace
+        self.stats: Dict[str, Stat] = {}
+        self.spans: List[dict] = []
+        self.started = perf_counter_ns()
+        self.started_unix = time_ns()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_id = 0
+
+    def stack(self) -> List[list]:
+        """the open spans of the current thread, innermost last"""
+        if (stack := getattr(self._local, "stack", None)) is None:
+            stack = self._local.stack = []
+        return stack
+
+    def open(self, name: str) -> list:
+        stack = self.stack()
+        with self._lock:
+            self._next_id += 1
+            span_id = self._next_id
+        # name, span id, parent id, bytes
+        frame = [name, span_id, stack[-1][1] if stack else 0, 0]
+        stack.append(frame)
+        return frame
+
+    def close(
+        self,
+        frame: list,
+        start: int,
+        nanos: int,
+        events: int,
+        wall_end: Optional[int] = None,
+        generator: bool = False,
+        error: Optional[str] = None,
+    ):
+        """records a finished call, `nanos` is the time spent in it and `start` to
+        `wall_end` the time it was alive, both from perf_counter_ns. `error` is the
+        name of the exception the call raised, if any"""
+        name, span_id, parent_id, nbytes = frame
+        with self._lock:
+            stat = self.stats.get(name) or self.stats.setdefault(name, Stat())
+            stat.add(nanos, events)
+            stat.bytes += nbytes
+            stat.errors += error is not None
+            if self.trace:
+                self.spans.append(
+                    {
+                        "name": name,
+                        "id": span_id,
+                        "parent": parent_id,
+                        "start": start - self.started,
+                        "end": (wall_end or start + nanos) - self.started,
+                        "busy": nanos,
+                        "events": events,
+                        "bytes": nbytes,
+                        "thread": threading.get_ident(),
+                        "generator": generator,
+                        "error": error,
+                    }
+                )
+
+    def add_bytes(self, nbytes: int):
+        """adds the bytes to the innermost open span of the current thread"""
+        if stack := self.stack():
+            stack[-1][3] += nbytes
+
+    def summary(self) -> str:
+        """one line per instrumented name, slowest first"""
+        lines = [
+            f"{'name':<36}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}"
+            f"{'p99 ms':>10}{'max ms':>10}{'events':>10}{'MiB':>8}{'errors':>8}"
+        ]
+        for name, stat in sorted(
+            self.stats.items(), key=lambda item: item[1].nanos, reverse=True
+        ):
+            lines.append(
+                f"{name:<36}{stat.calls:>8}{stat.nanos / 10**9:>10.3f}"
+                f"{stat.nanos / stat.calls / 10**6:>10.2f}"
+                f"{stat.percentile(0.5) * 1000:>10.2f}"
+                f"{stat.percentile(0.99) * 1000:>10.2f}"
+                f"{stat.max_nanos / 10**6:>10.2f}{stat.events:>10}"
+                f"{stat.bytes / 2**20:>8.2f}{stat.errors:>8}"
+            )
+        lines.append(f"wall time {(perf_counter_ns() - self.started) / 10**9:.3f}s")
+        return "\n".join(lines)
+
+    def histogram(self, name: str) -> Dict[float, int]:
+        """maps the upper bound of each latency bucket of `name`, in seconds, to the
+        number of calls in it"""
+        return {
+            2**i / 10**6: count
+            for i, count in enumerate(self.stats[name].buckets)
+            if count
+        }
+
+    def write_chrome_trace(self, path: Path):
+        """Writes the spans in the Chrome trace event format, for chrome://tracing or
+        ui.perfetto.dev. Generators are resumed interleaved with their callers, so they
+        are written as async events on a track of their own."""
+        events: List[dict] = []
+        for span in self.spans:
+            args = {"events": span["events"], "bytes": span["bytes"]}
+            if span["error"] is not None:
+                args["error"] = span["error"]
+            common = {"name": span["name"], "pid": os.getpid(), "tid": span["thread"]}
+            if span["generator"]:
+                args["busy_ms"] = span["busy"] / 10**6
+                events += [
+                    common
+                    | {"ph": "b", "cat": "generator", "id": span["id"], "args": args}
+                    | {"ts": span["start"] / 1000},
+                    common
+                    | {"ph": "e", "cat": "generator", "id": span["id"]}
+                    | {"ts": span["end"] / 1000},
+                ]
+            else:
+                events.append(
+                    common
+                    | {
+                        "ph": "X",
+                        "ts": span["start"] / 1000,
+                        "dur": (span["end"] - span["start"]) / 1000,
+                        "args": args,
+                    }
+                )
+        path.write_text(json.dumps({"traceEvents": events}))
+
+    def write_otlp(self, path: Path, service: str = "anatomyofflow"):
+        """Writes the spans as OTLP/JSON, which the OpenTelemetry collector's file
+        receiver and most tracing backends can import"""
+        trace_id = os.urandom(16).hex()
+        offset = self.started_unix - self.started
+        spans = [
+            {
+                "traceId": trace_id,
+                "spanId": f"{span['id']:016x}",
+                "parentSpanId": f"{span['parent']:016x}" if span["parent"] else "",
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(span["start"] + self.started + offset),
+                "endTimeUnixNano": str(span["end"] + self.started + offset),
+                "attributes": [
+                    {"key": key, "value": {"intValue": str(span[key])}}
+                    for key in ("events", "bytes", "busy")
+                ]
+                + (
+                    []
+                    if span["error"] is None
+                    else [
+                        {"key": "error.type", "value": {"stringValue": span["error"]}}
+                    ]
+                ),
+                # STATUS_CODE_ERROR
+                "status": {"code": 2, "message": span["error"]}
+                if span["error"]
+                else {},
+            }
+            for span in self.spans
+        ]
+        path.write_text(
+            json.dumps(
+                {
+                    "resourceSpans": [
+                        {
+                            "resource": {
+                                "attributes": [
+                                    {
+                                        "key": "service.name",
+                                        "value": {"stringValue": service},
+                                    }
+                                ]
+                            },
+                            "scopeSpans": [
+                                {"scope": {"name": __name__}, "spans": spans}
+                            ],
+                        }
+                    ]
+                }
+            )
+        )
+
+
+@contextmanager
+def recording(trace: bool = True) -> Iterator[Recorder]:
+    """Enables the instrumentation for the duration of the block
+
+    While recording, every HTTP request made through `requests` (aw-client, Oura and
+    WakaTime) is counted with its response size. Outside of the block an instrumented
+    call costs a single global lookup.
+
+    Args:
+        trace (bool): keep a span per call, see `Recorder`
+    Returns:
+        Iterator[Recorder]: the recorder, e.g. `print(recorder.summary())` after the block
+    """
+    global _recorder
+    previous, recorder = _recorder, Recorder(trace)
+    send = requests.Session.send
+
+    def counted_send(session, request, **kwargs):
+        frame = recorder.open(f"http {urlsplit(request.url).netloc}")
+        start = perf_counter_ns()
+        error = None
+        try:
+            response = send(session, request, **kwargs)
+            if kwargs.get("stream"):
+                frame[3] = int(response.headers.get("Content-Length", 0))
+            else:
+                frame[3] = len(response.content)
+            return response
+        except BaseException as exception:
+            error = type(exception).__name__
+            raise
+        finally:
+            recorder.stack().pop()
+            recorder.add_bytes(frame[3])
+            recorder.close(frame, start, perf_counter_ns() - start, 0, error=error)
+
+    _recorder = recorder
+    requests.Session.send = counted_send
+    try:
+        yield recorder
+    finally:
+        requests.Session.send = send
+        _recorder = previous
+
+
+def instrumented(
+    name: Optional[str] = None, count: Optional[Callable[[Any], int]] = None
+) -> Callable[[F], F]:
+    """Decorator recording the calls of a function while `recording` is active
+
+    Args:
+        name (Optional[str]): name of the stat, defaults to the qualified name
+        count (Optional[Callable[[Any], int]]): returns the number of events in the
+            result of a function, generators count the items they yield
+    Returns:
+        Callable[[F], F]: the decorator
+    """
+
+    def decorator(func: F) -> F:
+        stat_name = name or func.__qualname__
+
+        if inspect.isgeneratorfunction(func):
+
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if _recorder is None:
+                    return func(*args, **kwargs)
+                return _timed_generator(_recorder, stat_name, func(*args, **kwargs))
+
+            return generator_wrapper  # type: ignore
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if (recorder := _recorder) is None:
+                return func(*args, **kwargs)
+            frame = recorder.open(stat_name)
+            start = perf_counter_ns()
+            events, error = 0, None
+            try:
+                result = func(*args, **kwargs)
+                events = count(result) if count else 0
+                return result
+            except BaseException as exception:
+                error = type(exception).__name__
+                raise
+            finally:
+                nanos = perf_counter_ns() - start
+                recorder.stack().pop()
+                recorder.close(frame, start, nanos, events, error=error)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def _timed_generator(recorder: Recorder, name: str, generator: Iterator) -> Iterator:
+    frame = recorder.open(name)
+    # the span is only open while the generator runs
+    recorder.stack().pop()
+    start = perf_counter_ns()
+    nanos = 0
+    items = 0
+    error = None
+    try:
+        while True:
+            stack = recorder.stack()
+            stack.append(frame)
+            resumed = perf_counter_ns()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except BaseException as exception:
+                error = type(exception).__name__
+                raise
+            finally:
+                nanos += perf_counter_ns() - resumed
+                stack.pop()
+            items += 1
+            yield item
+    finally:
+        generator.close()
+        recorder.close(
+            frame, start, nanos, items, perf_counter_ns(), generator=True, error=error
+        )
+
+
+class InstrumentedClient:
+    """Wraps an ActivityWatchClient (or a `CachedClient`) so that its `get_events`,
+    `get_buckets` and `query` calls are recorded while `recording` is active.
+    Everything else is forwarded to the wrapped client."""
+
+    def __init__(self, client: Any):
+        """
+        Args:
+            client (ActivityWatchClient): the client to record
+        """
+        self.client = client
+        self.get_events = instrumented("get_events", len)(client.get_events)
+        self.get_buckets = instrumented("get_buckets", len)(client.get_buckets)
+        if hasattr(client, "query"):
+            self.query = instrumented("query", _query_events)(client.query)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+
+def _query_events(result: List[Any]) -> int:
+    return sum(
+        len(events)
+        for period in result
+        for events in (period.values() if isinstance(period, dict) else [period])
+    )
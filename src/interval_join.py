@@ -0,0 +1,164 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Callable, Generic, Iterable, List, Optional, Tuple, TypeVar
+from aw_core.models import Event
+
+T = TypeVar("T")
+
+
+class IntervalIndex(Generic[T]):
+    """Sorted index over the records of a secondary source (web events, shell history,
+    heartbeats, ...), answering which records overlap an interval from memory.
+
+    The records are sorted by start, and next to their ends the running maximum of the
+    ends is kept, which stays sorted even if records overlap. Every record before the
+    first maximum end reaching the interval ends before it, every record from the first
+    start past the interval starts after it, so a lookup is two bisections plus a scan
+    of the candidates in between. Building the index costs O(m log m) and a lookup
+    O(log m + c), where c is the number of candidates. c is close to the number of
+    overlapping records while the records are short, but a long record (e.g. a day
+    long afk event) keeps the running maximum up, so every later lookup scans all
+    records from it onwards and degrades to O(m).
+
+    Records without an end are points, they overlap [start, end) if start <= t < end.
+    """
+
+    __slots__ = ("records", "starts", "ends", "max_ends")
+
+    def __init__(
+        self,
+        records: Iterable[T],
+        start: Callable[[T], datetime],
+        end: Optional[Callable[[T], datetime]] = None,
+    ):
+        """
+        Parameters
+        ----------
+        records : Iterable[T]
+            the records, in any order. Records with the same start keep their order
+        start : Callable[[T], datetime]
+            returns the start of a record
+        end : Optional[Callable[[T], datetime]]
+            returns the end of a record, if not given the records are points
+        """
+        self.records: List[T] = sorted(records, key=start)
+        self.starts: List[datetime] = [start(record) for record in self.records]
+        self.ends: List[datetime] = (
+            self.starts if end is None else [end(record) for record in self.records]
+        )
+        self.max_ends: List[datetime] = []
+        for record_end in self.ends:
+            self.max_ends.append(
+                max(self.max_ends[-1], record_end) if self.max_ends else record_end
+            )
+
+    @classmethod
+    def from_events(cls, events: Iterable[Event]) -> "IntervalIndex[Event]":
+        """indexes events by their timestamp and end. Events with the same timestamp
+        keep the order they are passed in, so pass them in chronological order:
+        aw-server returns events newest first, reverse them before indexing, as
+        `events_slicer` does"""
+        return cls(
+            events,
+            lambda event: event.timestamp,
+            lambda event: event.timestamp + event.duration,
+        )
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def overlapping(
+        self, start: datetime, end: datetime, closed: bool = False
+    ) -> List[T]:
+        """Returns the records overlapping the interval, in order of their start
+
+        Parameters
+        ----------
+        start : datetime
+            start of the interval
+        end : datetime
+            end of the interval
+        closed : bool
+            treat the interval as [start, end] and include records which only touch it,
+            this is what aw-server returns for `get_events(start=start, end=end)`.
+            By default the interval is [start, end)
+        Returns
+        -------
+        List[T]
+            the overlapping records
+        """
+        lo = bisect_left(self.max_ends, start)
+        hi = (bisect_right if closed else bisect_left)(self.starts, end)
+        starts, ends, records = self.starts, self.ends, self.records
+        if closed:
+            return [records[i] for i in range(lo, hi) if ends[i] >= start]
+        # a record ending at the start only overlaps it if it is a point
+        return [
+            records[i] for i in range(lo, hi) if ends[i] > start or starts[i] >= start
+        ]
+
+    def containing(self, point: datetime) -> List[T]:
+        """returns the records with start <= point < end, and the points at `point`"""
+        lo = bisect_left(self.max_ends, point)
+        hi = bisect_right(self.starts, point)
+        starts, ends, records = self.starts, self.ends, self.records
+        return [
+            records[i] for i in range(lo, hi) if ends[i] > point or starts[i] == point
+        ]
+
+    def join(
+        self, intervals: Iterable[Tuple[datetime, datetime]], closed: bool = False
+    ) -> List[List[T]]:
+        """Looks up a whole batch of intervals, e.g. the window events of a range, one
+        `overlapping` lookup per interval
+
+        Parameters
+        ----------
+        intervals : Iterable[Tuple[datetime, datetime]]
+            start and end of each interval
+        closed : bool
+            see `overlapping`
+        Returns
+        -------
+        List[List[T]]
+            the records overlapping each interval
+        """
+        return [self.overlapping(start, end, closed) for start, end in intervals]
+
+
+def trim_event(event: Event, start: datetime, end: datetime) -> Event:
+    """returns a copy of the event trimmed to the interval, like aw-server does"""
+    event_start = max(event.timestamp, start)
+    return Event(
+        id=event.id,
+        timestamp=event_start,
+        duration=min(event.timestamp + event.duration, end) - event_start,
+        data=event.data,
+    )
+
+
+def events_lookup(
+    index: IntervalIndex[Event],
+) -> Callable[[datetime, datetime], List[Event]]:
+    """Turns an index of events into a lookup which can be used as a callable in the
+    `app_map` of `event_iter`: it returns the events overlapping the window, trimmed to
+    it, the same way `client.get_events(bucket_id, start=start, end=end)[::-1]` would
+
+    Parameters
+    ----------
+    index : IntervalIndex[Event]
+        events loaded once for the whole range, see `IntervalIndex.from_events`
+    Returns
+    -------
+    Callable[[datetime, datetime], List[Event]]
+        function returning the events overlapping the given interval
+    """
+
+    def lookup(start: datetime, end: datetime) -> List[Event]:
+        # trim copies, the same event may overlap the next window
+        return [
+            trim_event(event, start, end)
+            for event in index.overlapping(start, end, closed=True)
+        ]
+
+    return lookup
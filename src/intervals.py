@@ -0,0 +1,171 @@
+from array import array
+from datetime import datetime, timedelta, timezone
+import json
+from typing import Dict, Iterable, Iterator, List, Tuple
+from aw_core.models import Event
+
+import polars as pl
+import pyarrow as pa
+
+epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+one_micro = timedelta(microseconds=1)
+
+
+class IntervalTable:
+    """Compact, append only container for categorized intervals.
+
+    Instead of one `Event` (a dict holding a data dict, a datetime and a timedelta) per
+    interval, starts and ends are kept as int64 microseconds since the epoch in two
+    arrays, and the category and payload of each interval are dictionary encoded: each
+    distinct category and payload string is stored once, rows only hold its code.
+    The arrays are handed to Arrow without copying, see `to_arrow`.
+    """
+
+    __slots__ = (
+        "start",
+        "end",
+        "category",
+        "payload",
+        "categories",
+        "payloads",
+        "_category_codes",
+        "_payload_codes",
+    )
+
+    def __init__(self):
+        self.start = array("q")
+        self.end = array("q")
+        self.category = array("i")
+        self.payload = array("i")
+        # dictionaries of the category and payload columns
+        self.categories: List[str] = []
+        self.payloads: List[str] = []
+        self._category_codes: Dict[str, int] = {}
+        self._payload_codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def append(self, start: int, end: int, category: str, payload: str):
+        """appends an interval given in microseconds since the epoch"""
+        if (category_code := self._category_codes.get(category)) is None:
+            category_code = self._category_codes[category] = len(self.categories)
+            self.categories.append(category)
+        if (payload_code := self._payload_codes.get(payload)) is None:
+            payload_code = self._payload_codes[payload] = len(self.payloads)
+            self.payloads.append(payload)
+        self.start.append(start)
+        self.end.append(end)
+        self.category.append(category_code)
+        self.payload.append(payload_code)
+
+    def append_interval(
+        self, start: datetime, end: datetime, category: str, payload: str
+    ):
+        """appends an interval given as (aware or local) datetimes"""
+        self.append(
+            (start.astimezone(timezone.utc) - epoch) // one_micro,
+            (end.astimezone(timezone.utc) - epoch) // one_micro,
+            category,
+            payload,
+        )
+
+    def append_event(self, category: str, event: Event):
+        """appends an event, its data is stored json encoded"""
+        start = (event.timestamp - epoch) // one_micro
+        self.append(
+            start,
+            start + event.duration // one_micro,
+            category,
+            json.dumps(event.data),
+        )
+
+    @classmethod
+    def from_events(
+        cls, events: Iterable[Event], categories: str | Iterable[str]
+    ) -> "IntervalTable":
+        """builds a table from events and either one category for all of them
+        or the category of each event"""
+        table = cls()
+        if isinstance(categories, str):
+            for event in events:
+                table.append_event(categories, event)
+        else:
+            for event, category in zip(events, categories):
+                table.append_event(category, event)
+        return table
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Tuple[str, Event]]) -> "IntervalTable":
+        """builds a table from (category, event) pairs, e.g. from `bucket_merge_iter`"""
+        table = cls()
+        for category, event in pairs:
+            table.append_event(category, event)
+        return table
+
+    def to_events(self) -> Iterator[Tuple[str, Event]]:
+        """yields the rows as (category, event) pairs, for code expecting events"""
+        for start, end, category, payload in zip(
+            self.start, self.end, self.category, self.payload
+        ):
+            yield (
+                self.categories[category],
+                Event(
+                    timestamp=epoch + timedelta(microseconds=start),
+                    duration=timedelta(microseconds=end - start),
+                    data=json.loads(self.payloads[payload]),
+                ),
+            )
+
+    def to_arrow(self) -> pa.Table:
+        """Exports the table to Arrow. The start, end and code arrays are wrapped, not
+        copied, so the table must not be appended to while the export is in use.
+
+        Returns
+        -------
+        pa.Table
+            table with the columns category, timestamp, end and data
+        """
+        rows = len(self)
+
+        def wrap(values: array, arrow_type: pa.DataType) -> pa.Array:
+            if not rows:
+                # the buffer of an empty array isn't aligned
+                return pa.array([], arrow_type)
+            return pa.Array.from_buffers(arrow_type, rows, [None, pa.py_buffer(values)])
+
+        timestamp_type = pa.timestamp("us", tz="UTC")
+        return pa.table(
+            {
+                "category": pa.DictionaryArray.from_arrays(
+                    wrap(self.category, pa.int32()),
+                    pa.array(self.categories, pa.string()),
+                ),
+                "timestamp": wrap(self.start, pa.int64()).view(timestamp_type),
+                "end": wrap(self.end, pa.int64()).view(timestamp_type),
+                "data": pa.DictionaryArray.from_arrays(
+                    wrap(self.payload, pa.int32()),
+                    pa.array(self.payloads, pa.string()),
+                ),
+            }
+        )
+
+    def to_polars(self, categorical: bool = True) -> pl.DataFrame:
+        """Exports the table to polars, see `to_arrow`
+
+        Parameters
+        ----------
+        categorical : bool
+            keep category and data as Categorical columns. polars can't concatenate
+            Categorical columns of different tables without a global string cache,
+            so pass False to get plain strings instead
+        Returns
+        -------
+        pl.DataFrame
+            dataframe with the columns category, timestamp, end and data
+        """
+        frame = pl.from_arrow(self.to_arrow())
+        assert isinstance(frame, pl.DataFrame)
+        if not categorical:
+            frame = frame.with_columns(pl.col(["category", "data"]).cast(pl.Utf8))
+        return frame
@@ -0,0 +1,180 @@
+from datetime import datetime, timedelta, timezone
+from time import sleep
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+
+from src.aw_merge import AfkSplitter, afk_runs, expand_windows
+
+
+def copy_event(event: Event) -> Event:
+    """the merge extends and trims events in place, so it only gets copies"""
+    return Event(
+        id=event.id, timestamp=event.timestamp, duration=event.duration, data=event.data
+    )
+
+
+class LiveMerger:
+    """Keeps the merged timeline of a host up to date while the watchers are running,
+    for dashboards which refresh every few seconds.
+
+    Only the events which can still change are kept as raw events: the window events
+    from the last final one on, and the afk events from the afk event under the cursor
+    of the afk split on (the cursor `current_afk` of `bucket_merge`). Each poll fetches
+    the events from the start of the last buffered one, which picks up AW's heartbeat
+    extended last event with its new duration, and merges the buffer again. Everything
+    before the watermark, the start of the last window event or of the last afk run
+    (whichever is earlier, while not-afk the run is open ended and only bounded by
+    `settle`), can't change anymore: it is moved to `timeline` and dropped from the
+    buffer. A poll therefore costs about the same at 5pm as at 9am.
+
+    The result is the same as running `bucket_merge_iter` (unbatched) from `start` to
+    the time of the poll, as long as afk events arrive within `settle`.
+    """
+
+    def __init__(
+        self,
+        client: ActivityWatchClient,
+        hostname: str,
+        app_map: Dict[str, str | Callable[[datetime, datetime], List[Event]]],
+        start: datetime,
+        settle: timedelta = timedelta(minutes=5),
+    ):
+        """
+        Parameters
+        ----------
+        client : ActivityWatchClient
+            ActivityWatchClient instance
+        hostname : str
+            hostname of the machine
+        app_map : Dict[str,str|Callable]
+            mapping of app names to event types
+        start : datetime
+            start of the timeline
+        settle : timedelta
+            how long after the end of the last not-afk event an afk event may still
+            show up that starts before it
+        """
+        self.client = client
+        self.app_map = app_map
+        self.start = start
+        self.settle = settle
+        self.window_bucket = f"aw-watcher-window_{hostname}"
+        self.afk_bucket = f"aw-watcher-afk_{hostname}"
+        # events before the watermark, they won't change anymore
+        self.timeline: List[Tuple[str, Event]] = []
+        # events after the watermark as of the last poll
+        self.tail: List[Tuple[str, Event]] = []
+        self.watermark = start
+        self._windows: List[Event] = []
+        self._afk: List[Event] = []
+        self._max_ids: Dict[str, int] = {}
+
+    @property
+    def events(self) -> List[Tuple[str, Event]]:
+        """the whole merged timeline as of the last poll"""
+        return self.timeline + self.tail
+
+    def poll(
+        self, now: Optional[datetime] = None
+    ) -> Tuple[List[Tuple[str, Event]], List[Tuple[str, Event]]]:
+        """Fetches the events which arrived since the last poll and merges them
+
+        Parameters
+        ----------
+        now : Optional[datetime]
+            end of the timeline, defaults to the current time
+        Returns
+        -------
+        Tuple[List[Tuple[str,Event]],List[Tuple[str,Event]]]
+            the (category, event) pairs which became final with this poll, and the
+            ones after the watermark which replace the previous tail
+        """
+        now = now or datetime.now(timezone.utc)
+        self._fetch(self.window_bucket, self._windows, now)
+        self._fetch(self.afk_bucket, self._afk, now)
+
+        runs = list(afk_runs(copy_event(event) for event in self._afk))
+        # the last window event and the last run of afk events are still being extended.
+        # An afk event can only start after the not-afk events seen so far, give or
+        # take the time the afk watcher needs to notice
+        bounds = [self._windows[-1].timestamp] if self._windows else []
+        if runs and runs[-1].data["status"] == "afk":
+            bounds.append(runs[-1].timestamp)
+        elif self._afk:
+            last_afk = self._afk[-1]
+            bounds.append(
+                max(
+                    last_afk.timestamp,
+                    last_afk.timestamp + last_afk.duration - self.settle,
+                )
+            )
+        else:
+            bounds.append(now - self.settle)
+        watermark = max(self.watermark, min(bounds))
+
+        splitter = AfkSplitter(run for run in runs if run.data["status"] == "afk")
+        final: List[Tuple[str, Event]] = []
+        final_windows = 0
+        for window in self._windows[:-1]:
+            if window.timestamp + window.duration > watermark:
+                break
+            for category, event in expand_windows(
+                self.client, [copy_event(window)], self.app_map
+            ):
+                final.extend(splitter.push(category, event))
+            final_windows += 1
+
+        # keep the afk events from the run under the cursor on, the split of the
+        # remaining windows starts from it again on the next poll. Without one the
+        # last run is not-afk, and only its last event can be merged with new ones
+        if not splitter.no_afk:
+            cursor = splitter.current_afk
+            self._afk = self._afk[
+                next(i for i, event in enumerate(self._afk) if event.id == cursor.id) :
+            ]
+        else:
+            self._afk = self._afk[-1:]
+        self._windows = self._windows[final_windows:]
+
+        tail: List[Tuple[str, Event]] = []
+        for category, event in expand_windows(
+            self.client, map(copy_event, self._windows), self.app_map
+        ):
+            tail.extend(splitter.push(category, event))
+
+        self.timeline.extend(final)
+        self.tail = tail
+        self.watermark = watermark
+        return final, tail
+
+    def follow(
+        self, interval: timedelta = timedelta(seconds=5)
+    ) -> Iterator[Tuple[List[Tuple[str, Event]], List[Tuple[str, Event]]]]:
+        """polls forever, yielding the result of each poll, see `poll`"""
+        while True:
+            yield self.poll()
+            sleep(interval.total_seconds())
+
+    def _fetch(self, bucket_id: str, buffered: List[Event], now: datetime):
+        """Adds the events which arrived since the last poll to the buffer.
+
+        aw-server trims events to the requested interval, so the buffered events are
+        only extended, never replaced by a trimmed copy. Events overlapping the start
+        of the request which were already moved to the timeline are recognized by
+        their id, aw-server hands out increasing ids.
+        """
+        fetch_from = buffered[-1].timestamp if buffered else self.watermark
+        max_id = self._max_ids.get(bucket_id, -1)
+        by_id = {event.id: event for event in buffered}
+        for event in self.client.get_events(bucket_id, start=fetch_from, end=now)[::-1]:
+            event_end = event.timestamp + event.duration
+            if (known := by_id.get(event.id)) is not None:
+                # the heartbeat extended last event grows in place
+                known.duration = max(known.timestamp + known.duration, event_end) - (
+                    known.timestamp
+                )
+            elif event.id > max_id:
+                buffered.append(event)
+                max_id = event.id
+        self._max_ids[bucket_id] = max_id
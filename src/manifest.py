@@ -0,0 +1,43 @@
+"""Bookkeeping shared by the day partitioned stores (`HeartRateStore`,
+`HeartbeatStore`, `RollupStore`). Kept free of heavy imports, so the command line can
+tell whether a sync has anything to do before it imports polars or aw_client."""
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+from typing import Dict, Iterable
+
+
+def read_manifest(store_dir: Path) -> Dict[str, str]:
+    """the manifest maps each stored day to the time it was fetched (or computed)"""
+    manifest = store_dir / "manifest.json"
+    return json.loads(manifest.read_text()) if manifest.exists() else {}
+
+
+def write_manifest(store_dir: Path, manifest: Dict[str, str]):
+    (store_dir / "manifest.json").write_text(json.dumps(manifest))
+
+
+def is_complete(
+    manifest: Dict[str, str],
+    key: str,
+    paths: Iterable[Path],
+    day_end: datetime,
+    grace: timedelta,
+) -> bool:
+    """Whether a stored day can be used as is: all its files exist and it was fetched
+    at least `grace` after the day ended
+
+    Args:
+        manifest (Dict[str, str]): the store's manifest, see `read_manifest`
+        key (str): the day's key in the manifest, its ISO date
+        paths (Iterable[Path]): the day's files
+        day_end (datetime): end of the day, timezone aware
+        grace (timedelta): how long after its end a day is considered complete
+    Returns:
+        bool: False if the day has to be fetched (again)
+    """
+    if (fetched_at := manifest.get(key)) is None or not all(
+        path.exists() for path in paths
+    ):
+        return False
+    return datetime.fromisoformat(fetched_at) >= day_end + grace
@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+from typing import Callable, Dict, List, Literal, Optional, Tuple
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+
+from src.aw_merge import bucket_merge_iter
+from src.interval_join import trim_event
+
+AppMap = Dict[str, str | Callable[[datetime, datetime], List[Event]]]
+window_prefix = "aw-watcher-window_"
+afk_prefix = "aw-watcher-afk_"
+
+
+def discover_hosts(client: ActivityWatchClient) -> List[str]:
+    """returns the hostnames which have both a window and an afk bucket, sorted"""
+    buckets = client.get_buckets()
+    window_hosts = {
+        bucket.removeprefix(window_prefix)
+        for bucket in buckets
+        if bucket.startswith(window_prefix)
+    }
+    afk_hosts = {
+        bucket.removeprefix(afk_prefix)
+        for bucket in buckets
+        if bucket.startswith(afk_prefix)
+    }
+    return sorted(window_hosts & afk_hosts)
+
+
+def multi_host_merge(
+    client: ActivityWatchClient,
+    app_map: AppMap | Callable[[str], AppMap],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    hostnames: Optional[List[str]] = None,
+    policy: Literal["last-input", "lanes"] = "last-input",
+    max_workers: Optional[int] = None,
+    batched: bool = True,
+    page: Optional[timedelta] = None,
+) -> List[Tuple[str, str, Event]]:
+    """Runs `bucket_merge_iter` for several machines in parallel and combines their
+    timelines into one
+
+    Parameters
+    ----------
+    client : ActivityWatchClient
+        ActivityWatchClient instance
+    app_map : Dict[str,str|Callable] | Callable[[str], Dict[str,str|Callable]]
+        mapping of app names to event types, or a function returning the mapping of
+        a host, e.g. if each host has its own web watcher bucket
+    start : Optional[datetime]
+        start of the interval
+    end : Optional[datetime]
+        end of the interval
+    hostnames : Optional[List[str]]
+        the hosts to merge, defaults to every host found by `discover_hosts`
+    policy : Literal["last-input", "lanes"]
+        what to do when several hosts are active at the same time. "last-input" keeps
+        the host whose current event started last and cuts the others around it, and
+        only reports afk where no host is active. The start of an event (a window or
+        tab switch, the end of an afk period) stands in for the last input, keys
+        pressed inside a window don't count as the afk watcher doesn't report them.
+        "lanes" keeps every host's timeline as is, overlaps included
+    max_workers : Optional[int]
+        number of hosts merged at the same time, defaults to one per host
+    batched : bool
+        fetch each bucket in app_map once instead of once per window event
+    page : Optional[timedelta]
+        length of the pages the buckets are fetched in, see `bucket_merge_iter`
+    Returns
+    -------
+    List[Tuple[str,str,Event]]
+        the hostname, category and event of the combined timeline, sorted by timestamp
+    Raises
+    ------
+    ValueError
+        if the policy isn't one of the above
+    """
+    if policy not in ("last-input", "lanes"):
+        raise ValueError(f"unknown policy {policy!r}, expected 'last-input' or 'lanes'")
+    if hostnames is None:
+        hostnames = discover_hosts(client)
+    if not hostnames:
+        return []
+
+    def merge_host(hostname: str) -> List[Tuple[str, Event]]:
+        host_map = app_map(hostname) if callable(app_map) else app_map
+        return list(
+            bucket_merge_iter(client, hostname, host_map, start, end, batched, page)
+        )
+
+    with ThreadPoolExecutor(max_workers or len(hostnames)) as pool:
+        timelines = dict(zip(hostnames, pool.map(merge_host, hostnames)))
+
+    if policy == "lanes":
+        return sorted(
+            (
+                (hostname, category, event)
+                for hostname, timeline in timelines.items()
+                for category, event in timeline
+            ),
+            # the sort is stable, so each host's own order is kept
+            key=lambda row: row[2].timestamp,
+        )
+    return last_input_wins(timelines)
+
+
+def last_input_wins(
+    timelines: Dict[str, List[Tuple[str, Event]]]
+) -> List[Tuple[str, str, Event]]:
+    """Combines the merged timelines of several hosts, keeping at every moment the event
+    which started last. Afk events only win where no host has any other event.
+
+    This is the "last-input" policy of `multi_host_merge`: the latest start is a proxy
+    for the latest input, not the time of the last key press or mouse move, which
+    ActivityWatch doesn't record. A host that keeps being used within one long window
+    event loses against another host which merely switched windows later.
+
+    The boundaries of all events are swept in order with the events covering the
+    current segment in a heap, so n events cost O(n log n). Events without a duration
+    can't win a segment and are dropped, the ends of the others are truncated to
+    milliseconds.
+
+    Parameters
+    ----------
+    timelines : Dict[str, List[Tuple[str, Event]]]
+        (category, event) pairs of each host, as yielded by `bucket_merge_iter`
+    Returns
+    -------
+    List[Tuple[str,str,Event]]
+        the hostname, category and event of the combined timeline, sorted by timestamp
+    """
+    rows = sorted(
+        (
+            (hostname, category, event)
+            for hostname, timeline in timelines.items()
+            for category, event in timeline
+            if event.duration > timedelta(0)
+        ),
+        key=lambda row: row[2].timestamp,
+    )
+    starts = [event.timestamp for _, _, event in rows]
+    # aw_core keeps timestamps in milliseconds, so the segment boundaries have to be
+    # milliseconds as well or the trimmed events would overlap
+    ends = [
+        (end := event.timestamp + event.duration)
+        - timedelta(microseconds=end.microsecond % 1000)
+        for _, _, event in rows
+    ]
+    bounds = sorted(set(starts) | set(ends))
+
+    result: List[Tuple[str, str, Event]] = []
+    # heap of the rows started so far, active before afk, then the latest start first.
+    # Rows which ended are only dropped once they reach the top
+    active: List[Tuple[bool, int]] = []
+    next_row = 0
+    last_row: Optional[int] = None
+    for left, right in zip(bounds, bounds[1:]):
+        while next_row < len(rows) and starts[next_row] <= left:
+            heappush(active, (rows[next_row][1] == "afk", -next_row))
+            next_row += 1
+        while active and ends[-active[0][1]] <= left:
+            heappop(active)
+        if not active:
+            last_row = None
+            continue
+        row = -active[0][1]
+        if row == last_row:
+            # the same event keeps winning, extend its last segment
+            result[-1][2].duration = right - result[-1][2].timestamp
+            continue
+        hostname, category, event = rows[row]
+        result.append((hostname, category, trim_event(event, left, right)))
+        last_row = row
+    return result
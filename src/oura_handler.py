@@ -1,14 +1,242 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import polars as pl
+
+from src.instrumentation import instrumented
+from src.manifest import is_complete, read_manifest, write_manifest
 
 url = "https://api.ouraring.com/v2/usercollection/heartrate"
+default_store_dir = Path.home() / ".cache" / "anatomyofflow" / "oura" / "heartrate"
+heartrate_schema = {
+    "timestamp": pl.Datetime("us", "UTC"),
+    "bpm": pl.Int64,
+    "source": pl.Utf8,
+}
+
+
+def create_session(retries: int = 5, backoff: float = 0.5) -> requests.Session:
+    """creates a keep-alive session which retries rate limited and failed requests
+    with exponential backoff"""
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    session.mount("http://", HTTPAdapter(max_retries=retry))
+    return session
+
 
+@instrumented()
+def heartrate_pages(
+    access_token: str,
+    start: datetime,
+    end: datetime,
+    session: Optional[requests.Session] = None,
+    api_url: str = url,
+) -> Iterator[List[dict]]:
+    """Yields the heart rate samples of the interval one page at a time, following the
+    API's next_token until the interval is exhausted
 
-def get_heartrate_data(access_token: str, start: datetime, end: datetime):
+    Parameters
+    ----------
+    access_token : str
+        Oura personal access token
+    start : datetime
+        start of the interval
+    end : datetime
+        end of the interval
+    session : Optional[requests.Session]
+        session to reuse, see `create_session`
+    api_url : str
+        heart rate endpoint
+    Yields
+    -------
+    List[dict]
+        samples with the keys bpm, source and timestamp
+    Raises
+    ------
+    requests.HTTPError
+        if a request still fails after the session's retries, including when they
+        ran out on a retried status like 429
+    """
+    session = session or create_session()
     headers = {"Authorization": f"Bearer {access_token}"}
     params = {
         "start_datetime": start.isoformat(),
         "end_datetime": end.isoformat(),
     }
-    response = requests.request("GET", url, headers=headers, params=params)
-    return response.json() if response.ok else None
+    while True:
+        try:
+            response = session.get(api_url, headers=headers, params=params)
+        except requests.exceptions.RetryError as error:
+            # raised instead of an HTTPError once the retries of the session run out
+            raise requests.HTTPError(str(error), request=error.request) from error
+        response.raise_for_status()
+        page = response.json()
+        yield page["data"]
+        if not (next_token := page.get("next_token")):
+            return
+        params["next_token"] = next_token
+
+
+@instrumented(count=lambda result: len(result["data"]))
+def get_heartrate_data(
+    access_token: str,
+    start: datetime,
+    end: datetime,
+    session: Optional[requests.Session] = None,
+):
+    """returns all heart rate samples of the interval as {"data": [...]}, across all
+    pages. Raises `requests.HTTPError` if a request still fails after the retries"""
+    return {
+        "data": [
+            sample
+            for page in heartrate_pages(access_token, start, end, session)
+            for sample in page
+        ]
+    }
+
+
+class HeartRateStore:
+    """Local Parquet copy of the Oura heart rate samples, one file per (UTC) day.
+
+    Days which were fetched long enough after they ended are read from disk, all other
+    days of a requested interval are fetched in one paginated pull per run of missing
+    days, and written to disk day by day as the pages come in.
+    """
+
+    def __init__(
+        self,
+        access_token: str,
+        store_dir: Path = default_store_dir,
+        grace: timedelta = timedelta(hours=12),
+        session: Optional[requests.Session] = None,
+        api_url: str = url,
+    ):
+        """
+        Args:
+            access_token (str):
+                Oura personal access token
+            store_dir (Path):
+                directory holding the daily Parquet files
+            grace (timedelta):
+                how long after the end of a day it is considered complete, the ring
+                only uploads its data when the app syncs
+            session (Optional[requests.Session]):
+                session to reuse, defaults to `create_session()`
+            api_url (str):
+                heart rate endpoint
+        """
+        self.access_token = access_token
+        self.store_dir = store_dir
+        self.grace = grace
+        self.session = session or create_session()
+        self.api_url = api_url
+
+    def load(self, start: datetime, end: datetime) -> pl.DataFrame:
+        """Returns the heart rate samples in [start, end), fetching missing days first
+
+        Returns
+        -------
+        pl.DataFrame
+            dataframe with the columns timestamp, bpm and source
+        """
+        start, end = start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+        days: List[datetime] = []
+        day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day < end:
+            days.append(day)
+            day += timedelta(days=1)
+        self.sync(days)
+        frames = [
+            pl.read_parquet(path)
+            for day in days
+            if (path := self._day_path(day)).exists()
+        ]
+        if not frames:
+            return pl.DataFrame(schema=heartrate_schema)
+        return (
+            pl.concat(frames)
+            .filter((pl.col("timestamp") >= start) & (pl.col("timestamp") < end))
+            .sort("timestamp")
+        )
+
+    def sync(self, days: List[datetime]):
+        """fetches every day in `days` (UTC midnights) which isn't complete on disk"""
+        manifest = read_manifest(self.store_dir)
+        missing = [day for day in days if not self._is_complete(day, manifest)]
+        # group consecutive missing days so that each run is a single pull
+        runs: List[List[datetime]] = []
+        for day in missing:
+            if runs and runs[-1][-1] + timedelta(days=1) == day:
+                runs[-1].append(day)
+            else:
+                runs.append([day])
+        for run in runs:
+            self._fetch_run(run[0], run[-1] + timedelta(days=1), manifest)
+
+    def _fetch_run(self, start: datetime, end: datetime, manifest: Dict[str, str]):
+        fetched_at = datetime.now(timezone.utc).isoformat()
+        by_day: Dict[datetime, List[dict]] = {}
+        day = start
+        for page in heartrate_pages(
+            self.access_token, start, end, self.session, self.api_url
+        ):
+            for sample in page:
+                timestamp = datetime.fromisoformat(sample["timestamp"]).astimezone(
+                    timezone.utc
+                )
+                sample_day = timestamp.replace(
+                    hour=0, minute=0, second=0, microsecond=0
+                )
+                by_day.setdefault(sample_day, []).append(
+                    sample | {"timestamp": timestamp}
+                )
+            # samples arrive in order, every day before the last one seen is done
+            if by_day:
+                latest = max(by_day)
+                while day < latest:
+                    self._write_day(day, by_day.pop(day, []), manifest, fetched_at)
+                    day += timedelta(days=1)
+        while day < end:
+            self._write_day(day, by_day.pop(day, []), manifest, fetched_at)
+            day += timedelta(days=1)
+
+    def _write_day(
+        self,
+        day: datetime,
+        samples: List[dict],
+        manifest: Dict[str, str],
+        fetched_at: str,
+    ):
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        pl.DataFrame(
+            {
+                "timestamp": [sample["timestamp"] for sample in samples],
+                "bpm": [sample["bpm"] for sample in samples],
+                "source": [sample.get("source") for sample in samples],
+            },
+            schema=heartrate_schema,
+        ).write_parquet(self._day_path(day))
+        manifest[day.date().isoformat()] = fetched_at
+        write_manifest(self.store_dir, manifest)
+
+    def _is_complete(self, day: datetime, manifest: Dict[str, str]) -> bool:
+        return is_complete(
+            manifest,
+            day.date().isoformat(),
+            [self._day_path(day)],
+            day + timedelta(days=1),
+            self.grace,
+        )
+
+    def _day_path(self, day: datetime) -> Path:
+        return self.store_dir / f"{day.date().isoformat()}.parquet"
@@ -0,0 +1,289 @@
+from datetime import date, datetime, time, timedelta, timezone, tzinfo
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from aw_core.models import Event
+from aw_client.client import ActivityWatchClient
+
+import polars as pl
+
+from src.afk_split import bucket_merge_table
+from src.manifest import is_complete, read_manifest, write_manifest
+
+default_store_dir = Path.home() / ".cache" / "anatomyofflow" / "rollups"
+# upper edges of the session length histogram, in minutes
+session_bins = (5, 15, 30, 60, 120)
+hour_micros = timedelta(hours=1) // timedelta(microseconds=1)
+hourly_schema = {
+    "hour": pl.Datetime("us", "UTC"),
+    "category": pl.Utf8,
+    "seconds": pl.Float64,
+    "switches": pl.UInt32,  # switches to this category during the hour
+}
+daily_schema = (
+    {
+        "day": pl.Date,
+        "active_seconds": pl.Float64,
+        "afk_seconds": pl.Float64,
+        "switches": pl.UInt32,
+        "sessions": pl.UInt32,
+        "longest_session_seconds": pl.Float64,
+        "longest_stretch_seconds": pl.Float64,
+    }
+    | {f"sessions_under_{minutes}m": pl.UInt32 for minutes in session_bins}
+    | {f"sessions_over_{session_bins[-1]}m": pl.UInt32}
+)
+
+
+def rollup_day(
+    timeline: pl.DataFrame,
+    day: date,
+    session_gap: timedelta = timedelta(minutes=1),
+) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """Aggregates the merged timeline of a day per hour and for the whole day
+
+    A session is a stretch of activity without afk periods or gaps longer than
+    `session_gap`, a switch is a change of the app (or of the category, for the events
+    mapped by app_map) within a session, and a stretch is the time spent in one app
+    without switching.
+
+    Parameters
+    ----------
+    timeline : pl.DataFrame
+        merged events of the day with the columns category, timestamp, end and data,
+        as returned by `bucket_merge_df`
+    day : date
+        the day the timeline belongs to
+    session_gap : timedelta
+        shortest gap which ends a session
+    Returns
+    -------
+    Tuple[pl.DataFrame, pl.DataFrame]
+        the hourly rollup with `hourly_schema` and the daily one with `daily_schema`
+    """
+    events = (
+        timeline.select(
+            "category",
+            pl.col("timestamp").cast(pl.Int64).alias("start"),
+            pl.col("end").cast(pl.Int64),
+            pl.when(pl.col("category") == "window")
+            .then(pl.col("data").str.json_path_match("$.app"))
+            .otherwise(pl.col("category"))
+            .alias("context"),
+        )
+        .filter(pl.col("end") > pl.col("start"))
+        .sort("start")
+    )
+
+    active = (
+        events.filter(pl.col("category") != "afk")
+        .with_columns(
+            (
+                pl.col("start") - pl.col("end").cummax().shift(1)
+                > session_gap // timedelta(microseconds=1)
+            )
+            .fill_null(True)
+            .alias("new_session")
+        )
+        .with_columns(
+            (
+                (pl.col("context") != pl.col("context").shift(1)).fill_null(False)
+                & ~pl.col("new_session")
+            ).alias("switch")
+        )
+        .with_columns(
+            pl.col("new_session").cumsum().alias("session"),
+            (pl.col("new_session") | pl.col("switch")).cumsum().alias("stretch"),
+        )
+    )
+    sessions = active.groupby("session").agg(
+        ((pl.col("end").max() - pl.col("start").min()) / 10**6).alias("seconds")
+    )
+    stretches = active.groupby("stretch").agg(
+        ((pl.col("end").max() - pl.col("start").min()) / 10**6).alias("seconds")
+    )
+
+    # split the events at the hour boundaries
+    hourly = (
+        events.with_columns(
+            pl.arange(
+                pl.col("start") // hour_micros, (pl.col("end") - 1) // hour_micros + 1
+            ).alias("hour")
+        )
+        .explode("hour")
+        .with_columns(
+            (pl.col("hour") * hour_micros).alias("hour_start"),
+            ((pl.col("hour") + 1) * hour_micros).alias("hour_end"),
+        )
+        .with_columns(
+            (
+                pl.when(pl.col("end") < pl.col("hour_end"))
+                .then(pl.col("end"))
+                .otherwise(pl.col("hour_end"))
+                - pl.when(pl.col("start") > pl.col("hour_start"))
+                .then(pl.col("start"))
+                .otherwise(pl.col("hour_start"))
+            ).alias("micros")
+        )
+        .groupby("hour_start", "category")
+        .agg((pl.col("micros").sum() / 10**6).alias("seconds"))
+    )
+    hourly_switches = (
+        active.filter(pl.col("switch"))
+        .groupby(
+            (pl.col("start") // hour_micros * hour_micros).alias("hour_start"),
+            "category",
+        )
+        .agg(pl.count().cast(pl.UInt32).alias("switches"))
+    )
+    hourly = (
+        hourly.join(hourly_switches, on=["hour_start", "category"], how="left")
+        .select(
+            pl.col("hour_start").cast(pl.Datetime("us", "UTC")).alias("hour"),
+            "category",
+            "seconds",
+            pl.col("switches").fill_null(0),
+        )
+        .sort("hour", "category")
+    )
+
+    session_minutes = sessions.get_column("seconds") / 60
+    lower = 0.0
+    histogram: Dict[str, int] = {}
+    for minutes in session_bins:
+        histogram[f"sessions_under_{minutes}m"] = (
+            (session_minutes >= lower) & (session_minutes < minutes)
+        ).sum()
+        lower = minutes
+    histogram[f"sessions_over_{session_bins[-1]}m"] = (session_minutes >= lower).sum()
+    afk_seconds = hourly.filter(pl.col("category") == "afk").get_column("seconds").sum()
+    daily = pl.DataFrame(
+        {
+            "day": [day],
+            "active_seconds": [
+                hourly.filter(pl.col("category") != "afk").get_column("seconds").sum()
+                or 0.0
+            ],
+            "afk_seconds": [afk_seconds or 0.0],
+            "switches": [active.get_column("switch").sum()],
+            "sessions": [len(sessions)],
+            "longest_session_seconds": [sessions.get_column("seconds").max() or 0.0],
+            "longest_stretch_seconds": [stretches.get_column("seconds").max() or 0.0],
+        }
+        | {column: [count] for column, count in histogram.items()},
+        schema=daily_schema,
+    )
+    return hourly.select([pl.col(c).cast(t) for c, t in hourly_schema.items()]), daily
+
+
+class RollupStore:
+    """Hourly and daily aggregates of the merged timeline, persisted as one Parquet file
+    per day, so that trend queries over months read a few hundred rows instead
+    of merging millions of events again.
+
+    A day is merged and rolled up once it has been over for `grace`, days which
+    were still open when they were rolled up are rolled up again on the next query.
+    """
+
+    def __init__(
+        self,
+        client: ActivityWatchClient,
+        hostname: str,
+        app_map: Dict[str, str | Callable[[datetime, datetime], List[Event]]],
+        store_dir: Path = default_store_dir,
+        grace: timedelta = timedelta(minutes=10),
+        session_gap: timedelta = timedelta(minutes=1),
+        tz: Optional[tzinfo] = None,
+    ):
+        """
+        Args:
+            client (ActivityWatchClient):
+                the client the timeline of a day is merged from
+            hostname (str):
+                hostname of the machine
+            app_map (Dict[str,str|Callable]):
+                mapping of app names to event types, see `bucket_merge`
+            store_dir (Path):
+                directory holding a folder per host
+            grace (timedelta):
+                how long after the end of a day it is considered complete
+            session_gap (timedelta):
+                shortest gap which ends a session, see `rollup_day`
+            tz (Optional[tzinfo]):
+                timezone whose midnights bound the days, defaults to local time
+        """
+        self.client = client
+        self.hostname = hostname
+        self.app_map = app_map
+        self.store_dir = store_dir / hostname
+        self.grace = grace
+        self.session_gap = session_gap
+        self.tz = tz
+
+    def hourly(self, start: date, end: date) -> pl.DataFrame:
+        """returns the hourly rollup of the days in [start, end), see `hourly_schema`"""
+        return self._load("hourly", start, end, hourly_schema).sort("hour", "category")
+
+    def daily(self, start: date, end: date) -> pl.DataFrame:
+        """returns the daily rollup of the days in [start, end), see `daily_schema`"""
+        return self._load("daily", start, end, daily_schema).sort("day")
+
+    def update(self, start: date, end: date):
+        """rolls up every day in [start, end) which isn't complete on disk yet"""
+        manifest = read_manifest(self.store_dir)
+        day = start
+        while day < end:
+            if not self._is_complete(day, manifest):
+                self._rollup(day, manifest)
+            day += timedelta(days=1)
+
+    def _load(
+        self, kind: str, start: date, end: date, schema: Dict[str, pl.PolarsDataType]
+    ) -> pl.DataFrame:
+        self.update(start, end)
+        return pl.concat(
+            [pl.DataFrame(schema=schema)]
+            + [
+                pl.read_parquet(self._day_path(kind, start + timedelta(days=n)))
+                for n in range((end - start).days)
+            ]
+        )
+
+    def _rollup(self, day: date, manifest: Dict[str, str]):
+        computed_at = datetime.now(timezone.utc)
+        day_start, day_end = self._day_bounds(day)
+        timeline = bucket_merge_table(
+            self.client,
+            self.hostname,
+            self.app_map,
+            day_start,
+            min(day_end, computed_at),
+            batched=True,
+        ).to_polars(categorical=False)
+        hourly, daily = rollup_day(timeline, day, self.session_gap)
+        for kind, frame in (("hourly", hourly), ("daily", daily)):
+            path = self._day_path(kind, day)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            frame.write_parquet(path)
+        manifest[day.isoformat()] = computed_at.isoformat()
+        write_manifest(self.store_dir, manifest)
+
+    def _is_complete(self, day: date, manifest: Dict[str, str]) -> bool:
+        return is_complete(
+            manifest,
+            day.isoformat(),
+            [self._day_path(kind, day) for kind in ("hourly", "daily")],
+            self._day_bounds(day)[1],
+            self.grace,
+        )
+
+    def _day_bounds(self, day: date) -> Tuple[datetime, datetime]:
+        return (
+            # naive midnights are taken as local time
+            datetime.combine(day, time(), self.tz).astimezone(self.tz),
+            datetime.combine(day + timedelta(days=1), time(), self.tz).astimezone(
+                self.tz
+            ),
+        )
+
+    def _day_path(self, kind: str, day: date) -> Path:
+        return self.store_dir / kind / f"{day.isoformat()}.parquet"
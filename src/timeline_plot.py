@@ -0,0 +1,310 @@
+from datetime import datetime, timedelta
+from typing import List, Literal, Optional, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+from plotly import graph_objects as go
+
+default_categories = ["afk", "window", "google-chrome"]
+
+
+def localize(
+    timeline: pl.DataFrame, tz: str, columns: Sequence[str] = ("timestamp", "end")
+) -> pl.DataFrame:
+    """converts the UTC datetime columns to wall clock times of the timezone in one
+    pass. The timezone is dropped afterwards, plotly can't plot aware datetimes"""
+    return timeline.with_columns(
+        pl.col(list(columns)).dt.convert_time_zone(tz).dt.replace_time_zone(None)
+    )
+
+
+def coalesce_segments(
+    timeline: pl.DataFrame, max_gap: timedelta = timedelta(0)
+) -> pl.DataFrame:
+    """Merges the consecutive segments of a category with the same data (the same app
+    and title, page, ...) which follow each other with at most `max_gap` in between,
+    e.g. less than a pixel apart. Adjacent segments with different data stay apart, so
+    the hover text of a segment belongs to all its events
+
+    Parameters
+    ----------
+    timeline : pl.DataFrame
+        merged events with the columns category, timestamp, end and data
+    max_gap : timedelta
+        largest gap which is closed
+    Returns
+    -------
+    pl.DataFrame
+        the segments with the columns category, timestamp, end, data and count
+        (number of merged events)
+    """
+    return (
+        timeline.sort("category", "timestamp")
+        .with_columns(
+            (
+                (pl.col("category") != pl.col("category").shift(1))
+                | (pl.col("data") != pl.col("data").shift(1))
+                | (
+                    pl.col("timestamp")
+                    > pl.col("end").cummax().shift(1).over("category")
+                    + pl.duration(microseconds=max_gap // timedelta(microseconds=1))
+                )
+            )
+            .fill_null(True)
+            .cumsum()
+            .alias("segment")
+        )
+        .groupby("segment", maintain_order=True)
+        .agg(
+            pl.col("category").first(),
+            pl.col("timestamp").min(),
+            pl.col("end").max(),
+            pl.col("data").first(),
+            pl.count(),
+        )
+        .drop("segment")
+    )
+
+
+def minmax_downsample(
+    x: np.ndarray, y: np.ndarray, buckets: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Keeps the lowest and the highest point of each of `buckets` equally wide x
+    buckets, in order of x. Peaks stay visible at any zoom level, and a burst of
+    samples takes no more of the budget than a sparse stretch of the same width.
+    Datetimes are compared as integers, buckets without points are skipped"""
+    if len(x) <= 2 * buckets:
+        return x, y
+    xs = x.astype(np.int64) if np.issubdtype(x.dtype, np.datetime64) else x
+    edges = np.searchsorted(xs, np.linspace(xs[0], xs[-1], buckets + 1))
+    # the last bucket is closed on the right
+    edges[-1] = len(x)
+    bounds = [(lo, hi) for lo, hi in zip(edges[:-1], edges[1:]) if hi > lo]
+    # index of the min and max point of every bucket
+    lows = [lo + np.argmin(y[lo:hi]) for lo, hi in bounds]
+    highs = [lo + np.argmax(y[lo:hi]) for lo, hi in bounds]
+    keep = np.unique(np.concatenate([lows, highs]).astype(np.int64))
+    return x[keep], y[keep]
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Largest triangle three buckets: keeps the first and last point and, for every
+    bucket in between, the point spanning the largest triangle with the point kept
+    for the previous bucket and the mean of the next bucket
+
+    Parameters
+    ----------
+    x : np.ndarray
+        x values in increasing order, datetimes are compared as integers
+    y : np.ndarray
+        y values
+    threshold : int
+        number of points to keep
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        the kept points
+    """
+    if threshold >= len(x) or threshold < 3:
+        return x, y
+    xs = x.astype(np.int64).astype(np.float64)
+    ys = y.astype(np.float64)
+    edges = np.linspace(1, len(x) - 1, threshold - 1).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, len(x) - 1
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else len(x)
+        mean_x = xs[hi:next_hi].mean()
+        mean_y = ys[hi:next_hi].mean()
+        a = keep[i]
+        areas = np.abs(
+            (xs[a] - mean_x) * (ys[lo:hi] - ys[a])
+            - (xs[a] - xs[lo:hi]) * (mean_y - ys[a])
+        )
+        keep[i + 1] = lo + np.argmax(areas)
+    return x[keep], y[keep]
+
+
+def downsample(
+    samples: pl.DataFrame,
+    points: int,
+    method: Literal["minmax", "lttb"] = "minmax",
+    x: str = "timestamp",
+    y: str = "bpm",
+) -> Tuple[np.ndarray, np.ndarray]:
+    """reduces a sorted series, e.g. the Oura heart rate, to about `points` points"""
+    xs, ys = samples.get_column(x).to_numpy(), samples.get_column(y).to_numpy()
+    if method == "lttb":
+        return lttb(xs, ys, points)
+    return minmax_downsample(xs, ys, points // 2)
+
+
+def segment_traces(
+    segments: pl.DataFrame, categories: List[str], width: int = 20
+) -> List[go.Scattergl]:
+    """Draws each category lane as a single WebGL trace of thick horizontal lines,
+    one per segment, separated by gaps. Unlike the bars of `px.timeline` this stays
+    interactive with tens of thousands of segments."""
+    traces = []
+    for lane, category in enumerate(categories):
+        lane_segments = segments.filter(pl.col("category") == category)
+        rows = len(lane_segments)
+        # empty lanes get a trace as well, so the traces can be updated in place
+        starts = lane_segments.get_column("timestamp").to_numpy()
+        # every segment is start, end and a gap
+        xs = np.repeat(starts, 3)
+        xs[1::3] = lane_segments.get_column("end").to_numpy()
+        ys = np.full(3 * rows, float(lane))
+        ys[2::3] = np.nan
+        text = np.repeat(lane_segments.get_column("data").to_numpy(), 3)
+        traces.append(
+            go.Scattergl(
+                x=xs,
+                y=ys,
+                mode="lines",
+                line={"width": width},
+                name=category,
+                text=text,
+                hoverinfo="x+text+name",
+                connectgaps=False,
+            )
+        )
+    return traces
+
+
+def timeline_figure(
+    timeline: pl.DataFrame,
+    heartrate: Optional[pl.DataFrame] = None,
+    tz: Optional[str] = "UTC",
+    x_range: Optional[Tuple[datetime, datetime]] = None,
+    pixels: int = 1600,
+    categories: List[str] = default_categories,
+    method: Literal["minmax", "lttb"] = "minmax",
+) -> go.Figure:
+    """Builds the attentional timeline with the heart rate on a secondary axis
+
+    Segments closer than a pixel are coalesced and the heart rate is downsampled to
+    about two points per pixel of the visible range, see `zoomable_figure` to redo
+    this whenever the view is zoomed.
+
+    Parameters
+    ----------
+    timeline : pl.DataFrame
+        merged events with the columns category, timestamp, end and data (UTC),
+        e.g. from `bucket_merge_df`
+    heartrate : Optional[pl.DataFrame]
+        heart rate samples with the columns timestamp (UTC) and bpm,
+        e.g. from `HeartRateStore.load`
+    tz : Optional[str]
+        timezone the times are shown in, None if they were localized already
+    x_range : Optional[Tuple[datetime, datetime]]
+        visible range as wall clock times of `tz`, defaults to the whole timeline
+    pixels : int
+        width of the plot area in pixels
+    categories : List[str]
+        categories to draw, from the bottom lane to the top one
+    method : Literal["minmax", "lttb"]
+        how the heart rate is downsampled
+    Returns
+    -------
+    go.Figure
+        the figure
+    """
+    figure = go.Figure(
+        layout={
+            "yaxis": {
+                "tickvals": list(range(len(categories))),
+                "ticktext": categories,
+                "fixedrange": True,
+            },
+            "yaxis2": {"overlaying": "y", "side": "right", "title": "bpm"},
+            "xaxis": {"type": "date"},
+        }
+    )
+    figure.add_traces(
+        _traces(timeline, heartrate, tz, x_range, pixels, categories, method)
+    )
+    if x_range is not None:
+        figure.update_xaxes(range=list(x_range))
+    return figure
+
+
+def zoomable_figure(
+    timeline: pl.DataFrame,
+    heartrate: Optional[pl.DataFrame] = None,
+    tz: str = "UTC",
+    pixels: int = 1600,
+    categories: List[str] = default_categories,
+    method: Literal["minmax", "lttb"] = "minmax",
+) -> go.FigureWidget:
+    """Like `timeline_figure`, but as a notebook widget which coalesces and
+    downsamples again for the visible range whenever it is zoomed or panned"""
+    timeline, heartrate = _localize(timeline, heartrate, tz)
+    widget = go.FigureWidget(
+        timeline_figure(timeline, heartrate, None, None, pixels, categories, method)
+    )
+
+    def on_zoom(layout, x_range):
+        if x_range is None:
+            return
+        start, end = (np.datetime64(bound) for bound in x_range)
+        with widget.batch_update():
+            for trace, new in zip(
+                widget.data,
+                _traces(
+                    timeline,
+                    heartrate,
+                    None,
+                    (start.item(), end.item()),
+                    pixels,
+                    categories,
+                    method,
+                ),
+            ):
+                trace.x, trace.y, trace.text = new.x, new.y, new.text
+
+    widget.layout.on_change(on_zoom, "xaxis.range")
+    return widget
+
+
+def _localize(
+    timeline: pl.DataFrame, heartrate: Optional[pl.DataFrame], tz: Optional[str]
+) -> Tuple[pl.DataFrame, Optional[pl.DataFrame]]:
+    if tz is None:
+        return timeline, heartrate
+    return localize(timeline, tz), (
+        None if heartrate is None else localize(heartrate, tz, ("timestamp",))
+    )
+
+
+def _traces(
+    timeline: pl.DataFrame,
+    heartrate: Optional[pl.DataFrame],
+    tz: Optional[str],
+    x_range: Optional[Tuple[datetime, datetime]],
+    pixels: int,
+    categories: List[str],
+    method: Literal["minmax", "lttb"],
+) -> List[go.Scattergl]:
+    timeline, heartrate = _localize(timeline, heartrate, tz)
+    if x_range is None:
+        x_range = (
+            timeline.get_column("timestamp").min(),
+            timeline.get_column("end").max(),
+        )
+    start, end = x_range
+    visible = timeline.filter((pl.col("end") >= start) & (pl.col("timestamp") <= end))
+    traces = segment_traces(
+        coalesce_segments(visible, (end - start) / pixels), categories
+    )
+    if heartrate is not None:
+        x, y = downsample(
+            heartrate.filter(pl.col("timestamp").is_between(start, end)),
+            2 * pixels,
+            method,
+        )
+        traces.append(
+            go.Scattergl(x=x, y=y, name="Heart Rate", mode="lines", yaxis="y2")
+        )
+    return traces
@@ -1,14 +1,42 @@
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from datetime import datetime, timedelta, tzinfo
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Tuple
+from urllib.parse import urlsplit
 from aw_core import Event
 from aw_client.client import ActivityWatchClient
-from src.atuin_handler import get_history_interval
+from src.atuin_handler import atuin_db, get_history_interval, history_slicer
+from src.aw_merge import bucket_slicer
+from src.categories import (
+    CategoryRules,
+    Match,
+    RuleSet,
+    default_rules_path,
+    load_rules,
+)
+from src.intervals import IntervalTable
 
-event_schema = {"Category": [], "Start": [], "End": [], "Data": []}
+logger = logging.getLogger(__name__)
 
 import polars as pl
 
+# schema of the dataframe built for each day
+day_schema = {
+    "Category": pl.Categorical,
+    "Start": pl.Datetime("us", "UTC"),
+    "End": pl.Datetime("us", "UTC"),
+    "Data": pl.Utf8,
+}
+
 
 class WindowSession(Enum):
     """Enum for user activity"""
@@ -20,63 +48,154 @@ class WindowSession(Enum):
     OTHER = 4
 
 
-terminals = {
-    "kitty",
-    "alacritty",
-    "gnome-terminal",
-    "konsole",
-    "terminator",
-    "tilix",
-    "xfce4-terminal",
-    "xterm",
-}
+HistoryLookup = Callable[[datetime, datetime], List[Tuple[datetime, str, str]]]
+EventLookup = Callable[[datetime, datetime], List[Event]]
 
 
-def parse_terminal_history_interval(start: datetime, end: datetime):
-    res = {}
-    if commands := get_history_interval(start, end):
-        res |= event_schema
-        res["Category"].extend(["Terminal"] * len(commands))
-        for i in range(len(commands)):
-            res["Start"].append(commands[i][0])
-            res["End"].append(commands[i][0])
-            res["Data"].append(commands[i][1])
-    return res
+def parse_terminal_history_interval(
+    res: IntervalTable,
+    start: datetime,
+    end: datetime,
+    history: HistoryLookup = get_history_interval,
+):
+    for command_time, command, _ in history(start, end):
+        res.append_interval(command_time, command_time, "Terminal", command)
 
 
-def parse_vscode_event(event: Event):
-    res = {} | event_schema
-    res["Category"].append("Coding")
+def parse_vscode_event(
+    res: IntervalTable, event: Event, history: HistoryLookup = get_history_interval
+):
     start = event.timestamp
     end = start + event.duration
-    res["Start"].append(start)
-    res["End"].append(end)
-
     # title is the file in focus, has a ● in front of it if it's unsaved
     file_being_edited = event.data["title"].removeprefix("●")
-    res["Data"].append(file_being_edited)
-
-    if commands := parse_terminal_history_interval(start, end):
-        res |= commands
-    return res
+    res.append_interval(start, end, "Coding", file_being_edited)
 
+    parse_terminal_history_interval(res, start, end, history)
 
-def parse_chrome_session(aw_client: ActivityWatchClient, web_event: Event):
-    res = {} | event_schema
 
+def parse_chrome_session(
+    res: IntervalTable,
+    aw_client: ActivityWatchClient,
+    web_event: Event,
+    web: Optional[EventLookup] = None,
+    pages: Optional[RuleSet] = None,
+):
+    pages = pages or load_rules().pages
     start = web_event.timestamp
     end = start + web_event.duration
-    aw_web_events = aw_client.get_events("aw-watcher-web-chrome", start=start, end=end)[
+    aw_web_events = (
+        aw_client.get_events("aw-watcher-web-chrome", start=start, end=end)[::-1]
+        if web is None
+        else web(start, end)
+    )
+    browser = web_event.data["app"]
+    for page in aw_web_events:
+        match = pages.match(browser, page.data["title"])
+        categorize_general(res, match.category, page, match.data)
+
+
+def to_day_df(res: IntervalTable) -> pl.DataFrame:
+    """converts the intervals collected for a day to a dataframe with `day_schema`"""
+    return (
+        res.to_polars()
+        .rename(
+            {"category": "Category", "timestamp": "Start", "end": "End", "data": "Data"}
+        )
+        .select([pl.col(column).cast(dtype) for column, dtype in day_schema.items()])
+    )
+
+
+def build_day_df(
+    aw_client: ActivityWatchClient,
+    hostname: str,
+    date: datetime,
+    history_db: Path = atuin_db,
+    rules: Optional[CategoryRules] = None,
+) -> Optional[pl.DataFrame]:
+    """Builds a dataframe of the user events of a single workday
+    Args:
+        aw_client (ActivityWatchClient):
+            the ActivityWatch client to use
+        hostname (str):
+            hostname of the machine
+        date (datetime):
+            start of the workday
+        history_db (Path):
+            atuin's history database
+        rules (Optional[CategoryRules]):
+            categorization rules, defaults to the ones in .config/categories.json
+    Returns:
+        Optional[pl.DataFrame]: dataframe of user events, None if there were none
+    """
+    rules = rules or load_rules()
+    res = IntervalTable()
+    end_of_day = date.replace(hour=17).astimezone()
+    # read the day's shell history once instead of running atuin per window
+    history = history_slicer(date, end_of_day, history_db)
+    # and the day's web events, once the first browser window shows up
+    web: Optional[EventLookup] = None
+
+    # get the events between 6am and 5pm
+    events = aw_client.get_events(
+        f"aw-watcher-window_{hostname}", start=date, end=end_of_day
+    )[
         ::-1
-    ]
-    for web_event in aw_web_events:
-        if web_event.data["title"].endswith(" - Google Search"):
-            query = web_event.data["title"].removesuffix(" - Google Search")
-            categorize_general(res, "Search", web_event, query)
+    ]  # the returned events are in reverse order
+
+    # categorized as columns, each distinct (app, title) pair is matched once
+    matches = rules.windows.categorize(
+        pl.DataFrame(
+            {
+                "app": [event.data["app"] for event in events],
+                "title": [event.data.get("title", "") for event in events],
+            },
+            schema={"app": pl.Utf8, "title": pl.Utf8},
+        )
+    ).select("category", "handler", "label")
+    for event, match in zip(events, map(Match._make, matches.iter_rows())):
+        if match.handler == "vscode":
+            parse_vscode_event(res, event, history)
+        elif match.handler == "browser":
+            if web is None:
+                web = bucket_slicer(
+                    aw_client, "aw-watcher-web-chrome", date, end_of_day
+                )
+            parse_chrome_session(res, aw_client, event, web, rules.pages)
+        elif match.handler == "terminal":
+            parse_terminal_history_interval(
+                res, event.timestamp, event.timestamp + event.duration, history
+            )
         else:
-            page_title = web_event.data["title"]
-            categorize_general(res, "Browsing", web_event, page_title)
-    return res
+            categorize_general(res, match.category, event, match.data)
+    return to_day_df(res) if len(res) else None
+
+
+# client used by the days built in a worker process, see `_init_worker`
+_worker_client: Optional[ActivityWatchClient] = None
+
+
+def _init_worker(client_name: str, server_address: str, testing: bool):
+    """creates the client of a worker process, the parent's client can't be pickled"""
+    global _worker_client
+    server = urlsplit(server_address)
+    _worker_client = ActivityWatchClient(
+        # aw_client only allows one client per name and server
+        f"{client_name}-worker-{os.getpid()}",
+        testing=testing,
+        host=server.hostname,
+        port=server.port,
+        protocol=server.scheme,
+    )
+
+
+def _build_day_in_worker(
+    hostname: str, date: datetime, history_db: Path, rules_path: Path
+) -> Optional[pl.DataFrame]:
+    assert _worker_client is not None, "worker was not initialized"
+    return build_day_df(
+        _worker_client, hostname, date, history_db, load_rules(rules_path)
+    )
 
 
 def build_event_df(
@@ -84,6 +203,11 @@ def build_event_df(
     hostname: str,
     start_date: datetime = datetime.now() - timedelta(days=14),
     end_date: datetime = datetime.now(),
+    max_workers: Optional[int] = None,
+    executor: Literal["thread", "process"] = "process",
+    history_db: Path = atuin_db,
+    rules_path: Path = default_rules_path,
+    tz: Optional[tzinfo] = None,
 ) -> Dict[str, pl.DataFrame]:
     """Builds a dataframe of user events from the given interval
     Args:
@@ -95,6 +219,20 @@ def build_event_df(
             start of the interval, defaults to 2 weeks ago
         end (datetime):
             end of the interval, defaults to now
+        max_workers (Optional[int]):
+            if given, the days are built concurrently by this many workers.
+            A day which fails is logged and left out instead of failing every day
+        executor (Literal["thread", "process"]):
+            whether the workers are threads or processes. Each process creates its
+            own client from the server address of `aw_client`. Processes are the
+            default as they share no state between days
+        history_db (Path):
+            atuin's history database
+        rules_path (Path):
+            categorization rules, see `load_rules`. They are compiled once and
+            shared by all days (once per process with the process executor)
+        tz (Optional[tzinfo]):
+            timezone of the workdays, defaults to local time
     Returns:
         pl.DataFrame: dataframe of user events
 
@@ -102,52 +240,97 @@ def build_event_df(
         the default arguments for start and end are defined *once* on the
         initial function call
     """
-    res = {} | event_schema
-    terminals = {"kitty"}
-    browsers = {"google-chrome"}
-    social_apps = {"Ripcord", "Signal"}
+    return {
+        date.strftime("%a %Y-%m-%d"): data
+        for date, data in iter_event_df(
+            aw_client,
+            hostname,
+            start_date,
+            end_date,
+            max_workers,
+            executor,
+            history_db,
+            rules_path,
+            tz,
+        )
+    }
 
+
+def iter_event_df(
+    aw_client: ActivityWatchClient,
+    hostname: str,
+    start_date: datetime,
+    end_date: datetime,
+    max_workers: Optional[int] = None,
+    executor: Literal["thread", "process"] = "process",
+    history_db: Path = atuin_db,
+    rules_path: Path = default_rules_path,
+    tz: Optional[tzinfo] = None,
+) -> Iterator[Tuple[datetime, pl.DataFrame]]:
+    """Generator version of `build_event_df`, each day is yielded as soon as it is
+    built, in order of the dates, and days without events are left out. With workers
+    at most `max_workers` days are built ahead of the consumer, so only a few days are
+    held in memory at any time, see `src.export`
+    Args:
+        see `build_event_df`
+    Yields:
+        Tuple[datetime, pl.DataFrame]: the start of the workday and its events
+    """
     # each day starts at 6am, though the first couple of hours
-    # will likely be afk
+    # will likely be afk. build_day_df ends it at 5pm in the zone of the date, so
+    # the dates stay in tz
+    first = start_date if tz is None else start_date.astimezone(tz)
     dates = [
-        (start_date + timedelta(n))
+        (first + timedelta(n))
         .replace(hour=6, minute=0, second=0, microsecond=0)
-        .astimezone()
+        .astimezone(tz)
         for n in range(int((end_date - start_date).days))
     ]
-    workday_data = {}
-    for date in dates:
-        res = {} | event_schema
-        end_of_day = date.replace(hour=17).astimezone()
-
-        # get the events between 6am and 5pm
-        events = aw_client.get_events(
-            f"aw-watcher-window_{hostname}", start=date, end=end_of_day
-        )[
-            ::-1
-        ]  # the returned events are in reverse order
-
-        for event in events:
-            if (app_id := event.data["app"]) == "code-url-handler":
-                res |= parse_vscode_event(event)
-            elif app_id in browsers:
-                res.update(parse_chrome_session(aw_client, event))
-            elif app_id in terminals:
-                res.update(
-                    parse_terminal_history_interval(
-                        event.timestamp, event.timestamp + event.duration
-                    )
-                )
-            elif app_id in social_apps:
-                categorize_general(res, "Social", event, app_id)
-            else:
-                categorize_general(res, "Uncategorized", event, app_id)
-        if not (data := pl.DataFrame(res)).is_empty():
-            data.select(
-                pl.col(["Start", "End"]).cast(pl.Datetime).dt.replace_time_zone(None)
+    rules = load_rules(rules_path)
+    if max_workers is None:
+        for date in dates:
+            if (
+                data := build_day_df(aw_client, hostname, date, history_db, rules)
+            ) is not None:
+                yield date, data
+        return
+
+    pool: Executor
+    if executor == "process":
+        pool = ProcessPoolExecutor(
+            max_workers,
+            initializer=_init_worker,
+            initargs=(
+                aw_client.client_name,
+                aw_client.server_address,
+                aw_client.testing,
+            ),
+        )
+    else:
+        pool = ThreadPoolExecutor(max_workers)
+
+    def submit(date: datetime) -> Future:
+        if executor == "process":
+            return pool.submit(
+                _build_day_in_worker, hostname, date, history_db, rules_path
             )
-            workday_data[date.strftime("%a %Y-%m-%d")] = pl.DataFrame(res)
-    return workday_data
+        return pool.submit(build_day_df, aw_client, hostname, date, history_db, rules)
+
+    with pool:
+        pending = deque((date, submit(date)) for date in dates[:max_workers])
+        remaining = iter(dates[max_workers:])
+        # collect in the order of the dates so the result doesn't depend on scheduling
+        while pending:
+            date, future = pending.popleft()
+            if (next_date := next(remaining, None)) is not None:
+                pending.append((next_date, submit(next_date)))
+            try:
+                data = future.result()
+            except Exception:
+                logger.exception("failed to build %s, skipping it", date.date())
+                continue
+            if data is not None:
+                yield date, data
 
 
 def get_bounds(
@@ -168,8 +351,5 @@ def get_bounds(
 
 
 # TODO Rename this here and in `build_event_df`
-def categorize_general(res, arg1, event, app_id):
-    res["Category"].append(arg1)
-    res["Start"].append(event.timestamp)
-    res["End"].append(event.timestamp + event.duration)
-    res["Data"].append(app_id)
+def categorize_general(res: IntervalTable, arg1: str, event: Event, app_id: str):
+    res.append_interval(event.timestamp, event.timestamp + event.duration, arg1, app_id)
@@ -1,12 +1,35 @@
 from rauth import OAuth2Service
+from rauth.session import OAuth2Session
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta, timezone
 from urllib.parse import parse_qsl
 from pathlib import Path
+from typing import Dict, List, Tuple
 import json
 
+import polars as pl
+
+from src.instrumentation import instrumented
+from src.manifest import is_complete, read_manifest, write_manifest
+
+wakatime_url = "https://wakatime.com"
+default_store_dir = Path.home() / ".cache" / "anatomyofflow" / "wakatime" / "heartbeats"
+heartbeat_schema = {
+    "time": pl.Datetime("us", "UTC"),
+    "entity": pl.Utf8,
+    "type": pl.Utf8,
+    "category": pl.Utf8,
+    "project": pl.Utf8,
+    "language": pl.Utf8,
+    "branch": pl.Utf8,
+    "is_write": pl.Boolean,
+}
+
 
 def __create_service(client_id: str, client_secret: str) -> OAuth2Service:
     """internal function to create the OAuth2Service
@@ -16,9 +39,9 @@ def __create_service(client_id: str, client_secret: str) -> OAuth2Service:
         client_id=client_id,  # your App ID from https://wakatime.com/apps
         client_secret=client_secret,  # your App Secret from https://wakatime.com/apps
         name="wakatime",
-        authorize_url="https://wakatime.com/oauth/authorize",
-        access_token_url="https://wakatime.com/oauth/token",
-        base_url="https://wakatime.com/api/v1/",
+        authorize_url=f"{wakatime_url}/oauth/authorize",
+        access_token_url=f"{wakatime_url}/oauth/token",
+        base_url=f"{wakatime_url}/api/v1/",
     )
     return service
 
@@ -73,35 +96,204 @@ def __refresh_token(
     return service.get_auth_session(data=data)
 
 
-def initialize_session(waka_config_path: Path, state: str):
+def __save_token(waka_config: dict, waka_config_path: Path, session: OAuth2Session):
+    """internal function to store the access token, its expiry and the refresh token
+    of a freshly authorized or refreshed session in the config"""
+    token = dict(parse_qsl(session.access_token_response.text))
+    waka_config["access_token"] = session.access_token
+    if "refresh_token" in token:
+        waka_config["refresh_token"] = token["refresh_token"]
+    if "expires_in" in token:
+        expires_at = datetime.now(timezone.utc) + timedelta(
+            seconds=float(token["expires_in"])
+        )
+    elif "expires_at" in token:
+        expires_at = datetime.fromisoformat(token["expires_at"])
+    else:
+        # without an expiry the token is refreshed on the next run
+        expires_at = datetime.now(timezone.utc)
+    waka_config["expires_at"] = expires_at.isoformat()
+    (waka_config_path).write_text(json.dumps(waka_config))
+
+
+@instrumented()
+def initialize_session(
+    waka_config_path: Path, state: str, margin: timedelta = timedelta(minutes=5)
+):
     """Initializes the wakatime session. On first run, it will ask the user to authorize the app.
-    On subsequent runs, it will refresh the token which was created on the first run.
+    On subsequent runs, it reuses the stored access token until it is about to expire, and only
+    then refreshes it with the refresh token which was created on the first run.
     Args:
         waka_config_path (Path): Path to the wakatime.json file
         state (str): state to be used for the OAuth2Service, can be any string, but should be random
+        margin (timedelta): the token is refreshed if it expires within this margin
     Returns:
         OAuth2Session: the session to be used for the wakatime api
     """
     waka_config = json.loads((waka_config_path).read_text())
-    print(waka_config["redirect_uri"])
     service = __create_service(waka_config["app_id"], waka_config["app_secret"])
+    # reuse the stored token while it is still valid
+    if "access_token" in waka_config and "expires_at" in waka_config:
+        expires_at = datetime.fromisoformat(waka_config["expires_at"])
+        if expires_at - margin > datetime.now(timezone.utc):
+            return service.get_session(waka_config["access_token"])
     # Check if refresh token exists
     if "refresh_token" in waka_config.keys():
         # create session with refresh token
-        return __refresh_token(
+        session = __refresh_token(
             service,
             waka_config["app_id"],
             waka_config["app_secret"],
             waka_config["refresh_token"],
         )
+        __save_token(waka_config, waka_config_path, session)
+        return session
 
+    print(waka_config["redirect_uri"])
     code = __get_initial_token(service, state, waka_config["redirect_uri"])
     session = __get_auth_session(service, waka_config["redirect_uri"], state, code)
-    # Extract refresh token from session
-    waka_config["refresh_token"] = dict(parse_qsl(session.access_token_response.text))[
-        "refresh_token"
-    ]
-    # Save refresh token to config
-    (waka_config_path).write_text(json.dumps(waka_config))
+    # Save access and refresh token to config
+    __save_token(waka_config, waka_config_path, session)
     # Return session
     return session
+
+
+class HeartbeatStore:
+    """Local Parquet copy of the WakaTime heartbeats, one file per day.
+
+    Days which were fetched long enough after they ended are read from disk, the others
+    are fetched on every load. The days of a load are fetched concurrently over the
+    session's connection pool.
+    """
+
+    def __init__(
+        self,
+        session: OAuth2Session,
+        store_dir: Path = default_store_dir,
+        max_workers: int = 8,
+        grace: timedelta = timedelta(hours=1),
+    ):
+        """
+        Args:
+            session (OAuth2Session): session returned by `initialize_session`
+            store_dir (Path): directory holding the daily Parquet files
+            max_workers (int): number of days fetched at the same time
+            grace (timedelta): how long after the end of a day it is considered complete
+        """
+        self.session = session
+        self.store_dir = store_dir
+        self.max_workers = max_workers
+        self.grace = grace
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def load(self, days: List[date]) -> pl.DataFrame:
+        """Returns the heartbeats of the given days (in the user's wakatime timezone),
+        fetching the days which aren't stored yet
+        Args:
+            days (List[date]): the days to load
+        Returns:
+            pl.DataFrame: heartbeats sorted by time, with the columns of `heartbeat_schema`
+        """
+        self.sync(days)
+        return pl.concat(
+            [pl.DataFrame(schema=heartbeat_schema)]
+            + [pl.read_parquet(self._day_path(day)) for day in days]
+        ).sort("time")
+
+    def sync(self, days: List[date]):
+        """fetches every day in `days` which isn't complete on disk"""
+        manifest = read_manifest(self.store_dir)
+        missing = [day for day in days if not self._is_complete(day, manifest)]
+        fetched_at = datetime.now(timezone.utc).isoformat()
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            for day, heartbeats in zip(missing, pool.map(self._fetch_day, missing)):
+                self._write_day(day, heartbeats, manifest, fetched_at)
+
+    @instrumented(count=len)
+    def _fetch_day(self, day: date) -> pl.DataFrame:
+        response = self.session.get(
+            "users/current/heartbeats", params={"date": day.isoformat()}
+        )
+        response.raise_for_status()
+        heartbeats = response.json()["data"]
+        return pl.DataFrame(
+            {
+                column: (
+                    [
+                        datetime.fromtimestamp(heartbeat["time"], timezone.utc)
+                        for heartbeat in heartbeats
+                    ]
+                    if column == "time"
+                    else [heartbeat.get(column) for heartbeat in heartbeats]
+                )
+                for column in heartbeat_schema
+            },
+            schema=heartbeat_schema,
+        )
+
+    def _write_day(
+        self,
+        day: date,
+        heartbeats: pl.DataFrame,
+        manifest: Dict[str, str],
+        fetched_at: str,
+    ):
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        heartbeats.write_parquet(self._day_path(day))
+        manifest[day.isoformat()] = fetched_at
+        write_manifest(self.store_dir, manifest)
+
+    def _is_complete(self, day: date, manifest: Dict[str, str]) -> bool:
+        # the days are local to the user, a day fetched before it ended is fetched again
+        day_end = datetime.combine(day + timedelta(days=1), time()).astimezone()
+        return is_complete(
+            manifest, day.isoformat(), [self._day_path(day)], day_end, self.grace
+        )
+
+    def _day_path(self, day: date) -> Path:
+        return self.store_dir / f"{day.isoformat()}.parquet"
+
+
+def match_heartbeats(
+    heartbeats: pl.DataFrame, windows: List[Tuple[datetime, datetime]]
+) -> pl.DataFrame:
+    """Finds the heartbeats sent during each window, e.g. of the `code-url-handler`
+    window events, with two sorted searches instead of a lookup per window
+    Args:
+        heartbeats (pl.DataFrame): heartbeats sorted by time, see `HeartbeatStore.load`
+        windows (List[Tuple[datetime, datetime]]): start and end of each window
+    Returns:
+        pl.DataFrame: the heartbeats in [start, end) of each window, with the index
+        of the window in the column "window"
+    """
+    times = heartbeats.get_column("time")
+    bounds = pl.DataFrame(
+        {
+            "start": [start for start, _ in windows],
+            "end": [end for _, end in windows],
+        },
+        schema={"start": heartbeat_schema["time"], "end": heartbeat_schema["time"]},
+    )
+    rows = (
+        bounds.with_row_count("window")
+        .with_columns(
+            times.search_sorted(bounds.get_column("start"), side="left")
+            .cast(pl.Int64)
+            .alias("lo"),
+            times.search_sorted(bounds.get_column("end"), side="left")
+            .cast(pl.Int64)
+            .alias("hi"),
+        )
+        .select("window", pl.arange(pl.col("lo"), pl.col("hi")).alias("row"))
+        .explode("row")
+        .drop_nulls("row")
+    )
+    return pl.concat(
+        [
+            rows.select("window"),
+            heartbeats[rows.get_column("row").cast(pl.UInt32)],
+        ],
+        how="horizontal",
+    )
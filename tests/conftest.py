@@ -0,0 +1,85 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from threading import Thread
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    query: Dict[str, str]
+    headers: Dict[str, str]
+    body: bytes
+
+
+# status, json body (or raw text) and extra headers
+Response = Tuple[int, Any, Dict[str, str]]
+Handler = Callable[[Request], Response]
+
+
+class FakeServer:
+    """Serves `handler` over HTTP on a local port and records every request, to stand
+    in for aw-server and the Oura and WakaTime APIs"""
+
+    def __init__(self, handler: Handler):
+        self.handler = handler
+        self.requests: List[Request] = []
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def _respond(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                request = Request(
+                    self.command,
+                    url.path,
+                    dict(parse_qsl(url.query)),
+                    dict(self.headers),
+                    self.rfile.read(length),
+                )
+                server.requests.append(request)
+                status, body, headers = server.handler(request)
+                # strings are sent as they are, e.g. form encoded tokens
+                if isinstance(body, str):
+                    payload = body.encode()
+                    content_type = "application/x-www-form-urlencoded"
+                else:
+                    payload = json.dumps(body).encode()
+                    content_type = "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *_):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def fake_server() -> Iterator[Callable[[Handler], FakeServer]]:
+    servers: List[FakeServer] = []
+
+    def serve(handler: Handler) -> FakeServer:
+        servers.append(FakeServer(handler))
+        return servers[-1]
+
+    yield serve
+    for server in servers:
+        server.close()
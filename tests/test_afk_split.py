@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta, timezone
+import json
+from typing import List, Tuple
+
+import polars as pl
+import pytest
+
+from benchmarks.synthetic import SyntheticData, StubClient
+from src.afk_split import afk_split, bucket_merge_df, events_to_frame, merged_schema
+from src.aw_merge import afk_gen, bucket_merge, event_iter
+from src.intervals import IntervalTable
+
+app_map = {"google-chrome": "aw-watcher-web-chrome"}
+Interval = Tuple[datetime, datetime]
+
+
+def frame(rows: List[Tuple[str, datetime, datetime, dict]]) -> pl.DataFrame:
+    return pl.DataFrame(
+        [
+            (category, start, end, json.dumps(data))
+            for category, start, end, data in rows
+        ],
+        schema=merged_schema,
+        orient="row",
+    )
+
+
+def assert_close(
+    merged: pl.DataFrame,
+    expected: pl.DataFrame,
+    tolerance: timedelta = timedelta(milliseconds=1),
+):
+    """aw_core truncates the timestamps of new Events to milliseconds while the columnar
+    path keeps microseconds, so the bounds of the Event loop are off by up to 1 ms and
+    slivers shorter than that are left out"""
+    merged, expected = (
+        merged.filter(pl.col("end") - pl.col("timestamp") > tolerance).sort("timestamp")
+        for merged in (merged, expected)
+    )
+    assert merged.select("category", "data").frame_equal(
+        expected.select("category", "data")
+    )
+    for column in ("timestamp", "end"):
+        assert (merged[column] - expected[column]).abs().max() <= tolerance
+
+
+def overlapping(merged: pl.DataFrame, excluded: List[Interval]) -> pl.Series:
+    mask = pl.Series([False] * len(merged))
+    for start, end in excluded:
+        mask = mask | ((merged["timestamp"] < end) & (merged["end"] > start))
+    return mask
+
+
+def brute_force_split(windows: pl.DataFrame, afk: pl.DataFrame) -> pl.DataFrame:
+    """subtracts every afk interval from every window event it overlaps"""
+    afk_rows = list(afk.iter_rows())
+    rows = []
+    for category, start, end, data in windows.iter_rows():
+        overlaps = [
+            (afk_start, afk_end)
+            for _, afk_start, afk_end, _ in afk_rows
+            if afk_end > start and afk_start < end
+        ]
+        if not overlaps:
+            rows.append((category, start, end, data))
+            continue
+        time = start
+        for afk_start, afk_end in overlaps:
+            if afk_start > time:
+                rows.append((category, time, afk_start, data))
+            time = max(time, afk_end)
+        if end > time:
+            rows.append((category, time, end, data))
+    return pl.concat(
+        [pl.DataFrame(rows, schema=merged_schema, orient="row"), afk]
+    ).sort(["timestamp", "end", "category"])
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("afk_noise", [0.0, 2.0])
+def test_matches_bucket_merge(seed: int, afk_noise: float):
+    data = SyntheticData(days=2, seed=seed, afk_noise=afk_noise)
+    client = StubClient(data)
+    events, categories = bucket_merge(
+        client, data.hostname, app_map, data.start, data.end, batched=True
+    )
+    expected = events_to_frame(events, categories)
+    merged = bucket_merge_df(client, data.hostname, app_map, data.start, data.end)
+
+    # the Event loop only cuts a window event around one afk interval and its cursor
+    # then lags behind, which also stretches the next window event back to the end
+    # of the stale afk interval. Those two events are compared to the brute force
+    # below instead. It also leaves out the afk intervals after the last window event
+    afk = list(afk_gen(client, data.hostname, data.start, data.end))
+    excluded = [(events[-1].timestamp + events[-1].duration, data.end)]
+    windows = [
+        (event.timestamp, event.timestamp + event.duration)
+        for _, event in event_iter(
+            client, data.hostname, app_map, data.start, data.end, batched=True
+        )
+    ]
+    for (start, end), (_, next_end) in zip(windows, windows[1:] + windows[-1:]):
+        if sum(a.timestamp + a.duration > start and a.timestamp < end for a in afk) > 1:
+            excluded.append((start, next_end))
+    expected = expected.filter(~overlapping(expected, excluded))
+    merged = merged.filter(~overlapping(merged, excluded))
+
+    assert len(merged) > 0.9 * len(events)
+    assert_close(merged, expected)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_matches_brute_force_on_synthetic_data(seed: int):
+    data = SyntheticData(days=2, seed=seed)
+    client = StubClient(data)
+    windows = IntervalTable.from_pairs(
+        event_iter(client, data.hostname, app_map, data.start, data.end, batched=True)
+    ).to_polars(categorical=False)
+    afk = IntervalTable.from_events(
+        afk_gen(client, data.hostname, data.start, data.end), "afk"
+    ).to_polars(categorical=False)
+
+    merged = afk_split(windows, afk).sort(["timestamp", "end", "category"])
+    assert merged.frame_equal(brute_force_split(windows, afk))
+
+
+def test_splits_around_several_afk_intervals():
+    at = lambda minute: datetime(2023, 5, 1, 9, tzinfo=timezone.utc) + timedelta(
+        minutes=minute
+    )
+    afk = frame(
+        [
+            ("afk", at(10), at(20), {"status": "afk"}),
+            ("afk", at(30), at(40), {"status": "afk"}),
+            ("afk", at(50), at(60), {"status": "afk"}),
+        ]
+    )
+    windows = frame(
+        [
+            # spans all three afk intervals
+            ("window", at(0), at(70), {"app": "kitty"}),
+            # starts inside one and ends inside the next
+            ("window", at(15), at(35), {"app": "code"}),
+            # touches two without overlapping them
+            ("window", at(20), at(30), {"app": "firefox"}),
+            # inside one afk interval
+            ("window", at(52), at(55), {"app": "Signal"}),
+        ]
+    )
+
+    merged = afk_split(windows, afk).sort(["timestamp", "end", "category"])
+    expected = brute_force_split(windows, afk)
+    assert merged.frame_equal(expected)
+    kitty = merged.filter(pl.col("data") == json.dumps({"app": "kitty"}))
+    assert kitty.select("timestamp", "end").rows() == [
+        (at(0), at(10)),
+        (at(20), at(30)),
+        (at(40), at(50)),
+        (at(60), at(70)),
+    ]
+    assert merged.filter(pl.col("data").str.contains("Signal")).is_empty()
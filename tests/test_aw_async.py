@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator, List
+
+import pytest
+
+from benchmarks.synthetic import SyntheticData, StubClient
+from src.aw_async import AsyncActivityWatchClient, afk_agen, event_aiter, window_agen
+from src.aw_merge import afk_gen, event_iter, window_gen
+from tests.conftest import Request, Response
+
+app_map = {"google-chrome": "aw-watcher-web-chrome"}
+
+
+def aw_server(stub: StubClient):
+    """answers the event queries of the aw-server REST API from a `StubClient`"""
+
+    def handle(request: Request) -> Response:
+        parts = request.path.strip("/").split("/")
+        if parts[:3] != ["api", "0", "buckets"] or parts[4:] != ["events"]:
+            return 404, {"message": "not found"}, {}
+        start, end = (
+            datetime.fromisoformat(request.query[bound])
+            if bound in request.query
+            else None
+            for bound in ("start", "end")
+        )
+        events = stub.get_events(
+            parts[3], int(request.query.get("limit", -1)), start, end
+        )
+        return 200, [event.to_json_dict() for event in events], {}
+
+    return handle
+
+
+async def collect(events: AsyncIterator) -> List:
+    return [event async for event in events]
+
+
+@pytest.fixture
+def data() -> SyntheticData:
+    return SyntheticData(days=2, seed=1)
+
+
+@pytest.fixture
+def server(fake_server, data):
+    return fake_server(aw_server(StubClient(data)))
+
+
+def run(coroutine_function, server_url: str, *args):
+    """runs an async generator function against the server and collects its output"""
+
+    async def main():
+        async with AsyncActivityWatchClient(server_url, max_concurrency=4) as client:
+            return await collect(coroutine_function(client, *args))
+
+    return asyncio.run(main())
+
+
+def test_afk_agen_matches_afk_gen(server, data):
+    stub = StubClient(data)
+    start, end = data.start, data.end
+    expected = list(afk_gen(stub, data.hostname, start, end))
+    assert expected
+    assert run(afk_agen, server.url, data.hostname, start, end) == expected
+
+
+def test_window_agen_matches_window_gen(server, data):
+    stub = StubClient(data)
+    start, end = data.start, data.end
+    expected = list(window_gen(stub, data.hostname, start, end))
+    assert expected
+    assert run(window_agen, server.url, data.hostname, start, end) == expected
+
+
+def test_event_aiter_matches_event_iter(server, data):
+    stub = StubClient(data)
+    start, end = data.start, data.end
+    expected = list(event_iter(stub, data.hostname, app_map, start, end, batched=True))
+    merged = run(event_aiter, server.url, data.hostname, app_map, start, end)
+    assert merged == expected
+    assert {category for category, _ in merged} == {"window", "google-chrome"}
+    # the window bucket and the web bucket, fetched concurrently
+    assert len(server.requests) == 2
+
+
+def test_get_many_keeps_the_order_of_the_queries(server, data):
+    async def main():
+        async with AsyncActivityWatchClient(server.url, max_concurrency=2) as client:
+            return await client.get_many(
+                [
+                    (data.window_bucket, data.start, data.end),
+                    (data.afk_bucket, data.start, data.end),
+                    (data.web_bucket, data.start, data.end),
+                ]
+            )
+
+    stub = StubClient(data)
+    assert asyncio.run(main()) == [
+        stub.get_events(bucket, start=data.start, end=data.end)
+        for bucket in (data.window_bucket, data.afk_bucket, data.web_bucket)
+    ]
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from aw_core.models import Event
+
+from src.aw_merge import afk_gen
+
+
+def at(minute: int) -> datetime:
+    return datetime(2023, 5, 1, 9, tzinfo=timezone.utc) + timedelta(minutes=minute)
+
+
+class AfkClient:
+    """serves a fixed afk bucket, newest first like aw-server"""
+
+    def __init__(self, events: List[Event]):
+        self.events = events
+
+    def get_events(self, bucket_id: str, limit: int = -1, start=None, end=None):
+        return self.events[::-1]
+
+
+def afk(start: int, end: int, status: str = "afk") -> Event:
+    return Event(
+        timestamp=at(start), duration=at(end) - at(start), data={"status": status}
+    )
+
+
+def test_afk_events_merge_across_gaps_under_8_minutes():
+    client = AfkClient(
+        [
+            afk(0, 10),
+            # 3 minutes after the previous one, merged
+            afk(13, 20),
+            # 10 minutes after the previous one, kept apart
+            afk(30, 40),
+            afk(40, 50, "not-afk"),
+            afk(50, 60),
+            afk(60, 70),
+        ]
+    )
+
+    merged = afk_gen(client, "laptop", at(0), at(70))
+
+    assert [
+        (event.timestamp, event.timestamp + event.duration) for event in merged
+    ] == [
+        (at(0), at(20)),
+        (at(30), at(40)),
+        (at(50), at(70)),
+    ]
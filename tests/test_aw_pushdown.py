@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from aw_core.models import Event
+from aw_datastore import Datastore
+from aw_datastore.storages import MemoryStorage
+from aw_query import query
+import polars as pl
+import pytest
+from requests import RequestException
+
+from benchmarks.synthetic import SyntheticData, StubClient
+from src.afk_split import events_to_frame
+from src.aw_merge import afk_gen, bucket_merge_iter, event_iter
+from src.aw_pushdown import pushdown_merge_iter
+from tests.test_afk_split import app_map, assert_close, overlapping
+
+
+class TrimmedStorage(MemoryStorage):
+    """trims the events to the requested interval, like aw-server and `StubClient`"""
+
+    def get_events(
+        self,
+        bucket: str,
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        events = super().get_events(bucket, limit, starttime, endtime)
+        for event in events:
+            end = event.timestamp + event.duration
+            if starttime is not None and event.timestamp < starttime:
+                event.timestamp = starttime
+            if endtime is not None and end > endtime:
+                end = endtime
+            event.duration = end - event.timestamp
+        return events
+
+
+class QueryClient(StubClient):
+    """StubClient that also answers `query` like aw-server, by running the query with
+    aw-core's query2 engine over an in-memory datastore holding the same events"""
+
+    def __init__(self, data: SyntheticData):
+        super().__init__(data)
+        self.db = Datastore(TrimmedStorage, testing=True)
+        for bucket, events in data.buckets.items():
+            self.db.create_bucket(bucket, "test", "stub", data.hostname)
+            for event in events:
+                # events with an id are taken as updates of stored ones
+                self.db[bucket].insert(
+                    Event(
+                        timestamp=event.timestamp,
+                        duration=event.duration,
+                        data=event.data,
+                    )
+                )
+
+    def query(self, query2: str, timeperiods: List[Tuple[datetime, datetime]], **_):
+        self.requests += 1
+        # aw-server joins the lines of the query before running it
+        return [
+            {
+                key: [event.to_json_dict() for event in events]
+                for key, events in query(
+                    "test", "".join(query2.split("\n")), start, end, self.db
+                ).items()
+            }
+            for start, end in timeperiods
+        ]
+
+
+def with_gaps(data: SyntheticData) -> SyntheticData:
+    """opens gaps inside long afk bucket events: short ones in events of both statuses,
+    which the 8 minute merge closes again, and long ones in afk events, which it keeps
+    """
+    events = []
+    for n, event in enumerate(data.buckets[data.afk_bucket]):
+        end = event.timestamp + event.duration
+        gap = None
+        if n % 3 == 0 and event.duration > timedelta(minutes=10):
+            gap = timedelta(minutes=2)
+        elif event.data["status"] == "afk" and event.duration > timedelta(minutes=40):
+            gap = timedelta(minutes=20)
+        if gap is None:
+            events.append((event.timestamp, end, event.data))
+            continue
+        middle = event.timestamp + (event.duration - gap) / 2
+        events += [
+            (event.timestamp, middle, event.data),
+            (middle + gap, end, event.data),
+        ]
+    data.buckets[data.afk_bucket] = [
+        Event(id=i, timestamp=start, duration=end - start, data=status)
+        for i, (start, end, status) in enumerate(events)
+    ]
+    return data
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_matches_bucket_merge(seed: int):
+    data = with_gaps(SyntheticData(days=1, seed=seed))
+    client = QueryClient(data)
+    local = list(
+        bucket_merge_iter(client, data.hostname, app_map, data.start, data.end, True)
+    )
+    pushed = list(
+        pushdown_merge_iter(
+            client, data.hostname, app_map, data.start, data.end, fallback=False
+        )
+    )
+    expected, merged = (
+        events_to_frame(
+            [event for _, event in rows], [category for category, _ in rows]
+        )
+        for rows in (local, pushed)
+    )
+
+    # the server returns the same afk events as afk_gen. Both sides truncate to
+    # milliseconds, so the bounds are off by up to 2 ms
+    tolerance = timedelta(milliseconds=2)
+    afk = list(afk_gen(client, data.hostname, data.start, data.end))
+    assert len(afk) < sum(
+        event.data["status"] == "afk" for event in data.buckets[data.afk_bucket]
+    )
+    assert_close(
+        merged.filter(pl.col("category") == "afk"),
+        events_to_frame(afk, ["afk"] * len(afk)),
+        tolerance,
+    )
+
+    # and the same merged events, leaving out the window events the Event loop cuts
+    # around only one of several afk intervals, see tests/test_afk_split.py, and the
+    # long gaps in the afk bucket, which only the Event loop counts as not afk
+    excluded = [(local[-1][1].timestamp + local[-1][1].duration + tolerance, data.end)]
+    raw_afk = data.buckets[data.afk_bucket]
+    excluded += [
+        (before.timestamp + before.duration, after.timestamp)
+        for before, after in zip(raw_afk, raw_afk[1:])
+        if after.timestamp - (before.timestamp + before.duration) > timedelta(minutes=8)
+    ]
+    windows = [
+        (event.timestamp, event.timestamp + event.duration)
+        for _, event in event_iter(
+            client, data.hostname, app_map, data.start, data.end, batched=True
+        )
+    ]
+    for (start, end), (_, next_end) in zip(windows, windows[1:] + windows[-1:]):
+        if sum(a.timestamp + a.duration > start and a.timestamp < end for a in afk) > 1:
+            excluded.append((start, next_end))
+    expected = expected.filter(~overlapping(expected, excluded))
+    merged = merged.filter(~overlapping(merged, excluded))
+
+    assert len(merged) > 0.9 * len(local)
+    assert_close(merged, expected, tolerance)
+
+
+class NoQueryClient(StubClient):
+    """an aw-server which can't run query2 programs"""
+
+    def query(self, *_, **__):
+        raise RequestException("query2 is not supported")
+
+
+def test_falls_back_only_when_asked():
+    data = SyntheticData(days=1)
+    client = NoQueryClient(data)
+
+    with pytest.raises(RequestException):
+        list(pushdown_merge_iter(client, data.hostname, app_map, data.start, data.end))
+    merged = list(
+        pushdown_merge_iter(
+            client, data.hostname, app_map, data.start, data.end, fallback=True
+        )
+    )
+
+    local = bucket_merge_iter(
+        client, data.hostname, app_map, data.start, data.end, True
+    )
+    assert [
+        (category, event.timestamp, event.duration) for category, event in merged
+    ] == [(category, event.timestamp, event.duration) for category, event in local]
@@ -0,0 +1,52 @@
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from benchmarks.synthetic import SyntheticData, StubClient
+from src import cli
+from src.export import merged_days
+from src.rollups import RollupStore
+
+app_map = {"google-chrome": "aw-watcher-web-chrome"}
+# far from UTC, so its days never match the machine's
+tz = ZoneInfo("Pacific/Kiritimati")
+
+
+@pytest.mark.parametrize("argv", [["export", "out.xlsx"], ["sync"]])
+def test_empty_range_is_a_usage_error(argv, capsys):
+    with pytest.raises(SystemExit) as exit:
+        cli.main(argv[:1] + ["--start", "2023-05-02", "--end", "2023-05-01"] + argv[1:])
+
+    assert exit.value.code == 2
+    assert "empty range" in capsys.readouterr().err
+
+
+def test_days_are_bounded_by_the_timezone(tmp_path):
+    data = SyntheticData(days=3)
+    client = StubClient(data)
+    first = data.start.astimezone(tz).date() + timedelta(days=1)
+
+    (day, timeline), *_ = merged_days(
+        client, data.hostname, app_map, first, first + timedelta(days=1), tz=tz
+    )
+    store = RollupStore(client, data.hostname, app_map, tmp_path, tz=tz)
+
+    assert day == first
+    assert timeline["timestamp"].min() == datetime.combine(first, time(), tz)
+    assert timeline["end"].max() <= datetime.combine(
+        first + timedelta(days=1), time(), tz
+    )
+    hours = store.hourly(first, first + timedelta(days=1))["hour"]
+    assert hours.min() == datetime.combine(first, time(), tz)
+    assert hours.max() < datetime.combine(first + timedelta(days=1), time(), tz)
+    assert store.daily(first, first + timedelta(days=1))["day"].to_list() == [first]
+
+
+@pytest.mark.parametrize("name", ["Europe/Berlin", ":Europe/Berlin"])
+def test_local_zone_follows_daylight_saving(name, monkeypatch):
+    monkeypatch.setenv("TZ", name)
+    local = cli.zone(None)
+
+    assert datetime(2023, 1, 15, tzinfo=local).utcoffset() == timedelta(hours=1)
+    assert datetime(2023, 7, 15, tzinfo=local).utcoffset() == timedelta(hours=2)
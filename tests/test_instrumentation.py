@@ -0,0 +1,53 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from src.instrumentation import instrumented, recording
+
+
+@instrumented("lookup", len)
+def lookup(fail: bool):
+    if fail:
+        raise TimeoutError("aw-server did not answer")
+    return [1, 2, 3]
+
+
+@instrumented("pages")
+def pages(fail_after: int):
+    for page in range(fail_after):
+        yield page
+    raise ConnectionError("connection reset")
+
+
+def test_failing_calls_are_recorded(tmp_path: Path):
+    with recording() as recorder:
+        lookup(False)
+        with pytest.raises(TimeoutError):
+            lookup(True)
+        with pytest.raises(ConnectionError):
+            list(pages(2))
+
+    assert recorder.stats["lookup"].calls == 2
+    assert recorder.stats["lookup"].errors == 1
+    assert recorder.stats["lookup"].events == 3
+    assert recorder.stats["pages"].errors == 1
+    assert recorder.stats["pages"].events == 2
+    assert [(span["name"], span["error"]) for span in recorder.spans] == [
+        ("lookup", None),
+        ("lookup", "TimeoutError"),
+        ("pages", "ConnectionError"),
+    ]
+
+    recorder.write_chrome_trace(tmp_path / "trace.json")
+    trace = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [event["args"].get("error") for event in trace if "args" in event] == [
+        None,
+        "TimeoutError",
+        "ConnectionError",
+    ]
+    recorder.write_otlp(tmp_path / "otlp.json")
+    spans = json.loads((tmp_path / "otlp.json").read_text())["resourceSpans"][0][
+        "scopeSpans"
+    ][0]["spans"]
+    assert [span["status"].get("code") for span in spans] == [None, 2, 2]
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from aw_core.models import Event
+
+from src.multi_host import last_input_wins, multi_host_merge
+
+
+def at(minute: int) -> datetime:
+    return datetime(2023, 5, 1, 9, tzinfo=timezone.utc) + timedelta(minutes=minute)
+
+
+def event(start: int, end: int, app: str) -> Event:
+    return Event(timestamp=at(start), duration=at(end) - at(start), data={"app": app})
+
+
+def test_latest_started_event_wins():
+    merged = last_input_wins(
+        {
+            # one long window, used the whole time
+            "desktop": [("window", event(0, 60, "code"))],
+            "laptop": [
+                ("window", event(10, 20, "Signal")),
+                ("afk", event(20, 40, "")),
+                ("window", event(40, 50, "firefox")),
+            ],
+        }
+    )
+
+    assert [
+        (hostname, event.data["app"], event.timestamp, event.timestamp + event.duration)
+        for hostname, _, event in merged
+    ] == [
+        ("desktop", "code", at(0), at(10)),
+        ("laptop", "Signal", at(10), at(20)),
+        # afk only wins where no host has any other event
+        ("desktop", "code", at(20), at(40)),
+        ("laptop", "firefox", at(40), at(50)),
+        ("desktop", "code", at(50), at(60)),
+    ]
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError, match="unknown policy"):
+        multi_host_merge(None, {}, hostnames=["laptop"], policy="first-input")  # type: ignore
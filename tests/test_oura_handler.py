@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import List
+
+import pytest
+import requests
+
+from src.oura_handler import HeartRateStore, create_session, heartrate_pages
+from tests.conftest import Request, Response
+
+start = datetime(2023, 5, 1, tzinfo=timezone.utc)
+
+
+def samples(first: datetime, count: int, step: timedelta) -> List[dict]:
+    return [
+        {
+            "bpm": 60 + n % 40,
+            "source": "awake",
+            "timestamp": (first + n * step).isoformat(),
+        }
+        for n in range(count)
+    ]
+
+
+def paginated(data: List[dict], page_size: int):
+    """answers heart rate queries like the Oura API, `page_size` samples per page"""
+
+    def handle(request: Request) -> Response:
+        low = datetime.fromisoformat(request.query["start_datetime"])
+        high = datetime.fromisoformat(request.query["end_datetime"])
+        matching = [
+            sample
+            for sample in data
+            if low <= datetime.fromisoformat(sample["timestamp"]) < high
+        ]
+        offset = int(request.query.get("next_token", 0))
+        page = matching[offset : offset + page_size]
+        next_token = offset + page_size if offset + page_size < len(matching) else None
+        return 200, {"data": page, "next_token": next_token and str(next_token)}, {}
+
+    return handle
+
+
+def test_pages_follow_next_token(fake_server):
+    data = samples(start, 25, timedelta(minutes=5))
+    server = fake_server(paginated(data, page_size=10))
+
+    pages = list(
+        heartrate_pages(
+            "token", start, start + timedelta(days=1), create_session(), server.url
+        )
+    )
+
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [sample for page in pages for sample in page] == data
+    assert [request.query.get("next_token") for request in server.requests] == [
+        None,
+        "10",
+        "20",
+    ]
+    assert all(
+        request.headers["Authorization"] == "Bearer token"
+        and request.query["start_datetime"] == start.isoformat()
+        for request in server.requests
+    )
+
+
+def test_rate_limited_requests_are_retried(fake_server):
+    data = samples(start, 3, timedelta(minutes=5))
+    pages = paginated(data, page_size=10)
+    calls = []
+
+    def handle(request: Request) -> Response:
+        calls.append(request)
+        if len(calls) < 3:
+            return 429, {"detail": "rate limited"}, {"Retry-After": "0"}
+        return pages(request)
+
+    server = fake_server(handle)
+    pages_seen = list(
+        heartrate_pages(
+            "token",
+            start,
+            start + timedelta(days=1),
+            create_session(backoff=0),
+            server.url,
+        )
+    )
+
+    assert pages_seen == [data]
+    assert len(server.requests) == 3
+
+
+def test_exhausted_retries_raise_http_error(fake_server):
+    server = fake_server(lambda request: (503, {"detail": "unavailable"}, {}))
+
+    with pytest.raises(requests.HTTPError):
+        list(
+            heartrate_pages(
+                "token",
+                start,
+                start + timedelta(days=1),
+                create_session(retries=2, backoff=0),
+                server.url,
+            )
+        )
+    assert len(server.requests) == 3
+
+
+def test_store_serves_complete_days_from_disk(fake_server, tmp_path: Path):
+    data = samples(start, 3 * 24 * 6, timedelta(minutes=10))
+    server = fake_server(paginated(data, page_size=100))
+    end = start + timedelta(days=3)
+
+    first = HeartRateStore(
+        "token", tmp_path, session=create_session(), api_url=server.url
+    ).load(start, end)
+    requests_made = len(server.requests)
+    again = HeartRateStore(
+        "token", tmp_path, session=create_session(), api_url=server.url
+    ).load(start + timedelta(hours=12), end)
+
+    # the three days are one run of missing days, pulled in pages of 100 samples
+    assert requests_made == 5
+    assert len(server.requests) == requests_made
+    assert len(first) == len(data)
+    assert first.get_column("bpm").to_list() == [sample["bpm"] for sample in data]
+    assert again.frame_equal(
+        first.filter(first.get_column("timestamp") >= start + timedelta(hours=12))
+    )
+    assert sorted(path.name for path in tmp_path.glob("*.parquet")) == [
+        "2023-05-01.parquet",
+        "2023-05-02.parquet",
+        "2023-05-03.parquet",
+    ]
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+import json
+
+import numpy as np
+import polars as pl
+
+from src.afk_split import merged_schema
+from src.timeline_plot import coalesce_segments, minmax_downsample
+
+
+def at(minute: int) -> datetime:
+    return datetime(2023, 5, 1, 9, tzinfo=timezone.utc) + timedelta(minutes=minute)
+
+
+def test_adjacent_apps_stay_apart():
+    timeline = pl.DataFrame(
+        [
+            ("window", at(0), at(10), json.dumps({"app": "code"})),
+            ("window", at(10), at(20), json.dumps({"app": "kitty"})),
+            # touches the previous one, same app
+            ("window", at(20), at(25), json.dumps({"app": "kitty"})),
+            ("afk", at(25), at(40), json.dumps({"status": "afk"})),
+        ],
+        schema=merged_schema,
+        orient="row",
+    )
+
+    segments = coalesce_segments(timeline, timedelta(minutes=1)).filter(
+        pl.col("category") == "window"
+    )
+
+    assert segments.select("timestamp", "end", "data", "count").rows() == [
+        (at(0), at(10), json.dumps({"app": "code"}), 1),
+        (at(10), at(25), json.dumps({"app": "kitty"}), 2),
+    ]
+
+
+def test_minmax_buckets_are_equally_wide():
+    # a dense burst at the start and sparse samples after it
+    x = np.concatenate([np.linspace(0, 1, 10_000), np.linspace(2, 100, 99)])
+    y = np.arange(len(x), dtype=np.float64)
+
+    kept_x, kept_y = minmax_downsample(x, y, 50)
+
+    # the burst falls into one bucket and keeps two points
+    assert (kept_x <= 1).sum() == 2
+    assert len(kept_x) <= 100
+    assert np.all(np.diff(kept_x) > 0)
+    assert kept_y[-1] == y[-1]
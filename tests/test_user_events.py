@@ -0,0 +1,63 @@
+from datetime import timedelta
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+from benchmarks.synthetic import SyntheticData, StubClient
+from src.user_events import build_day_df, build_event_df
+
+
+def strings(frame: pl.DataFrame) -> pl.DataFrame:
+    """categoricals built without a shared string cache don't compare equal"""
+    return frame.with_columns(pl.col("Category").cast(pl.Utf8))
+
+
+@pytest.fixture
+def data() -> SyntheticData:
+    return SyntheticData(days=4, seed=3)
+
+
+@pytest.fixture
+def history_db(data: SyntheticData, tmp_path: Path) -> Path:
+    return data.write_atuin_db(tmp_path / "history.db")
+
+
+def test_repeated_builds_are_identical(data: SyntheticData, history_db: Path):
+    client = StubClient(data)
+    first_day = data.start.replace(hour=6)
+    second_day = first_day + timedelta(days=1)
+
+    first = build_day_df(client, data.hostname, first_day, history_db)
+    other = build_day_df(client, data.hostname, second_day, history_db)
+    again = build_day_df(client, data.hostname, first_day, history_db)
+
+    assert first is not None and other is not None and again is not None
+    # nothing carried over from the previous builds, in either direction
+    assert strings(again).frame_equal(strings(first))
+    assert strings(other).frame_equal(
+        strings(build_day_df(client, data.hostname, second_day, history_db))
+    )
+    assert first.filter(pl.col("Start") >= second_day).is_empty()
+    assert strings(first).get_column("Category").is_in(["Terminal"]).any()
+
+
+def test_thread_workers_match_sequential_build(data: SyntheticData, history_db: Path):
+    client = StubClient(data)
+    sequential = build_event_df(
+        client, data.hostname, data.start, data.end, history_db=history_db
+    )
+    threaded = build_event_df(
+        client,
+        data.hostname,
+        data.start,
+        data.end,
+        max_workers=4,
+        executor="thread",
+        history_db=history_db,
+    )
+
+    assert len(sequential) == 4
+    assert list(threaded) == list(sequential)
+    for day, frame in sequential.items():
+        assert strings(threaded[day]).frame_equal(strings(frame))
@@ -0,0 +1,145 @@
+from datetime import date, datetime, timedelta, timezone
+import json
+from pathlib import Path
+from typing import Dict, List
+from urllib.parse import parse_qsl, urlencode
+
+import pytest
+
+from src import wakatime_handler
+from src.wakatime_handler import HeartbeatStore, initialize_session
+from tests.conftest import Request, Response
+
+days = [date(2023, 5, 1), date(2023, 5, 2)]
+
+
+def heartbeats_of(day: date) -> List[dict]:
+    midnight = datetime(day.year, day.month, day.day, 9, tzinfo=timezone.utc)
+    return [
+        {
+            "time": (midnight + timedelta(minutes=2 * n)).timestamp(),
+            "entity": f"/home/user/project/file_{n % 3}.py",
+            "type": "file",
+            "category": "coding",
+            "project": "project",
+            "language": "Python",
+            "branch": "main",
+            "is_write": n % 4 == 0,
+        }
+        for n in range(30)
+    ]
+
+
+class WakaTime:
+    """answers the token and heartbeat endpoints like the WakaTime API"""
+
+    def __init__(self, token: Dict[str, str]):
+        # form fields of every token response
+        self.token = token
+        self.issued = 0
+
+    def __call__(self, request: Request) -> Response:
+        if request.path == "/oauth/token":
+            self.issued += 1
+            form = dict(parse_qsl(request.body.decode()))
+            assert form["grant_type"] == "refresh_token"
+            assert form["refresh_token"] == "refresh-1"
+            access_token = f"access-{self.issued + 1}"
+            return 200, urlencode({"access_token": access_token} | self.token), {}
+        if request.path == "/api/v1/users/current/heartbeats":
+            day = date.fromisoformat(request.query["date"])
+            return 200, {"data": heartbeats_of(day)}, {}
+        return 404, {"error": "not found"}, {}
+
+
+@pytest.fixture
+def wakatime(fake_server, monkeypatch):
+    def serve(token: Dict[str, str]):
+        api = WakaTime(token)
+        server = fake_server(api)
+        monkeypatch.setattr(wakatime_handler, "wakatime_url", server.url)
+        return api, server
+
+    return serve
+
+
+def write_config(path: Path, expires_at: datetime) -> Path:
+    path.write_text(
+        json.dumps(
+            {
+                "app_id": "app",
+                "app_secret": "secret",
+                "redirect_uri": "https://localhost/callback",
+                "access_token": "access-1",
+                "refresh_token": "refresh-1",
+                "expires_at": expires_at.isoformat(),
+            }
+        )
+    )
+    return path
+
+
+def test_valid_token_is_reused(wakatime, tmp_path: Path):
+    _, server = wakatime({"refresh_token": "refresh-1", "expires_in": "3600"})
+    config = write_config(
+        tmp_path / "wakatime.json", datetime.now(timezone.utc) + timedelta(hours=1)
+    )
+
+    session = initialize_session(config, "state")
+
+    assert session.access_token == "access-1"
+    assert server.requests == []
+
+
+def test_expiring_token_is_refreshed(wakatime, tmp_path: Path):
+    _, server = wakatime({"refresh_token": "refresh-1", "expires_in": "3600"})
+    config = write_config(
+        tmp_path / "wakatime.json", datetime.now(timezone.utc) + timedelta(minutes=1)
+    )
+
+    session = initialize_session(config, "state")
+    stored = json.loads(config.read_text())
+
+    assert session.access_token == "access-2"
+    assert len(server.requests) == 1
+    assert stored["access_token"] == "access-2"
+    assert stored["refresh_token"] == "refresh-1"
+    expires_at = datetime.fromisoformat(stored["expires_at"])
+    assert abs(
+        expires_at - (datetime.now(timezone.utc) + timedelta(hours=1))
+    ) < timedelta(minutes=1)
+    # the refreshed token is reused from then on
+    assert initialize_session(config, "state").access_token == "access-2"
+    assert len(server.requests) == 1
+
+
+def test_token_without_expiry_is_refreshed_next_time(wakatime, tmp_path: Path):
+    api, _ = wakatime({"refresh_token": "refresh-1"})
+    config = write_config(
+        tmp_path / "wakatime.json", datetime.now(timezone.utc) - timedelta(hours=1)
+    )
+
+    assert initialize_session(config, "state").access_token == "access-2"
+    assert initialize_session(config, "state").access_token == "access-3"
+    assert api.issued == 2
+
+
+def test_heartbeat_store_reloads_from_disk(wakatime, tmp_path: Path):
+    _, server = wakatime({"refresh_token": "refresh-1", "expires_in": "3600"})
+    config = write_config(
+        tmp_path / "wakatime.json", datetime.now(timezone.utc) + timedelta(hours=1)
+    )
+    store_dir = tmp_path / "heartbeats"
+
+    first = HeartbeatStore(initialize_session(config, "state"), store_dir).load(days)
+    requests_made = len(server.requests)
+    again = HeartbeatStore(initialize_session(config, "state"), store_dir).load(days)
+
+    assert requests_made == len(days)
+    assert len(server.requests) == requests_made
+    assert len(first) == sum(len(heartbeats_of(day)) for day in days)
+    assert first.get_column("time").is_sorted()
+    assert again.frame_equal(first)
+    assert {request.query["date"] for request in server.requests} == {
+        day.isoformat() for day in days
+    }